@@ -1,5 +1,12 @@
 import os
 import re
+import json
+import shlex
+import hashlib
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from pathlib import Path
 import argparse
@@ -24,6 +31,22 @@ def sdf_to_pdbqt(sdf_file, pdbqt_outfile, mol_id):
     return pdbqt_outfile
 
 
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def parse_qvina_output(out):
+    """
+    Returns the affinity (kcal/mol) of the best pose in QuickVina's stdout.
+    """
+    out_split = out.splitlines()
+    best_idx = out_split.index('-----+------------+----------+----------') + 1
+    best_line = out_split[best_idx].split()
+    assert best_line[0] == '1'
+    return float(best_line[1])
+
+
 def calculate_qvina2_score(receptor_file, sdf_file, out_dir, size=20,
                            exhaustiveness=16, return_rdmol=False):
 
@@ -68,11 +91,7 @@ def calculate_qvina2_score(receptor_file, sdf_file, out_dir, size=20,
                 f'--exhaustiveness {exhaustiveness}'
             ).read()
 
-            out_split = out.splitlines()
-            best_idx = out_split.index('-----+------------+----------+----------') + 1
-            best_line = out_split[best_idx].split()
-            assert best_line[0] == '1'
-            scores.append(float(best_line[1]))
+            scores.append(parse_qvina_output(out))
 
             out_pdbqt_file = Path(out_dir, ligand_name + '_out.pdbqt')
             if out_pdbqt_file.exists():
@@ -88,6 +107,288 @@ def calculate_qvina2_score(receptor_file, sdf_file, out_dir, size=20,
         return scores
 
 
+# failures of single receptors or ligands that do not stop an evaluation
+DOCKING_ERRORS = (ValueError, AttributeError, OSError,
+                  subprocess.CalledProcessError)
+
+
+class ReceptorCache:
+    """
+    Converts every receptor PDB file to PDBQT only once. Files are stored
+    under the hash of the PDB content, so they are reused across runs.
+    """
+    def __init__(self, out_dir, prepare_cmd='prepare_receptor4.py'):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.prepare_cmd = prepare_cmd
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    def get(self, receptor_file):
+        """
+        Returns (PDBQT file, receptor hash).
+        """
+        receptor_file = Path(receptor_file)
+        receptor_hash = file_hash(receptor_file)
+        if receptor_file.suffix != '.pdb':
+            return receptor_file, receptor_hash
+
+        pdbqt_file = Path(self.out_dir,
+                          f'{receptor_file.stem}_{receptor_hash}.pdbqt')
+        with self.lock:
+            lock = self.locks.setdefault(pdbqt_file, threading.Lock())
+        with lock:
+            if not pdbqt_file.exists():
+                # prepare receptor, requires Python 2.7
+                tmp_file = pdbqt_file.with_suffix('.tmp.pdbqt')
+                subprocess.run(
+                    shlex.split(self.prepare_cmd) +
+                    ['-r', str(receptor_file), '-o', str(tmp_file)],
+                    check=True, capture_output=True)
+                tmp_file.rename(pdbqt_file)
+        return pdbqt_file, receptor_hash
+
+
+class DockingResultStore:
+    """
+    Persistent docking results. Every finished job is appended to a JSON
+    lines file immediately, so interrupted runs can be resumed.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.results = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # incomplete last line of an interrupted run
+                    self.results[entry['key']] = entry
+
+    @staticmethod
+    def make_key(receptor_hash, ligand_hash, center, size, exhaustiveness):
+        box = ','.join(f'{c:.4f}' for c in center) + f',{size}'
+        return hashlib.sha1(
+            f'{receptor_hash}|{ligand_hash}|{box}|{exhaustiveness}'.encode()
+        ).hexdigest()
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def put(self, key, score, pose_file):
+        entry = {'key': key, 'score': score,
+                 'pose': None if pose_file is None else str(pose_file)}
+        with self.lock:
+            self.results[key] = entry
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        return entry
+
+
+class DockingScheduler:
+    """
+    Docks ligands with QuickVina 2 (or any program with the same command line
+    interface and output, e.g. analysis/fake_qvina.py) in a bounded pool of
+    workers. Receptors are converted once and results are cached on disk.
+    """
+    def __init__(self, out_dir, n_workers=1, size=20, exhaustiveness=16,
+                 qvina_cmd='qvina2.1', obabel_cmd='obabel', cpus_per_job=None,
+                 prepare_cmd='prepare_receptor4.py'):
+        """
+        Args:
+            out_dir: directory for receptor PDBQT files, poses and results
+            n_workers: number of docking jobs running at the same time
+            size: edge length of the search box (A)
+            exhaustiveness: QuickVina exhaustiveness
+            qvina_cmd: docking command
+            obabel_cmd: OpenBabel command for ligand conversions
+            cpus_per_job: passed to QuickVina as --cpu, all CPUs if None
+            prepare_cmd: MGLTools receptor preparation command
+        """
+        self.out_dir = Path(out_dir)
+        self.pose_dir = Path(out_dir, 'poses')
+        self.pose_dir.mkdir(parents=True, exist_ok=True)
+        self.size = size
+        self.exhaustiveness = exhaustiveness
+        self.qvina_cmd = shlex.split(qvina_cmd)
+        self.obabel_cmd = shlex.split(obabel_cmd)
+        self.cpus_per_job = cpus_per_job
+        self.receptors = ReceptorCache(Path(out_dir, 'receptors'), prepare_cmd)
+        self.store = DockingResultStore(Path(out_dir, 'docking_results.jsonl'))
+        self.executor = ThreadPoolExecutor(n_workers)
+
+    def dock(self, receptor_pdbqt, receptor_hash, mol_block):
+        """
+        Dock a single ligand given as mol block, with the box centered at its
+        center of mass. Returns the result entry {'key', 'score', 'pose'}.
+        """
+        mol = Chem.MolFromMolBlock(mol_block, sanitize=False)
+        center = mol.GetConformer().GetPositions().mean(0)
+        ligand_hash = hashlib.sha1(mol_block.encode()).hexdigest()
+        key = DockingResultStore.make_key(receptor_hash, ligand_hash, center,
+                                          self.size, self.exhaustiveness)
+        if self.store.get(key) is not None:
+            return self.store.get(key)
+
+        with tempfile.TemporaryDirectory(dir=self.out_dir) as tmp_dir:
+            ligand_sdf_file = Path(tmp_dir, 'ligand.sdf')
+            ligand_pdbqt_file = Path(tmp_dir, 'ligand.pdbqt')
+            out_pdbqt_file = Path(tmp_dir, 'ligand_out.pdbqt')
+            ligand_sdf_file.write_text(mol_block + '$$$$\n')
+            subprocess.run(self.obabel_cmd + [str(ligand_sdf_file), '-O',
+                                              str(ligand_pdbqt_file)],
+                           check=True, capture_output=True)
+
+            cmd = self.qvina_cmd + [
+                '--receptor', str(receptor_pdbqt),
+                '--ligand', str(ligand_pdbqt_file),
+                '--out', str(out_pdbqt_file),
+                '--center_x', f'{center[0]:.4f}',
+                '--center_y', f'{center[1]:.4f}',
+                '--center_z', f'{center[2]:.4f}',
+                '--size_x', str(self.size), '--size_y', str(self.size),
+                '--size_z', str(self.size),
+                '--exhaustiveness', str(self.exhaustiveness)]
+            if self.cpus_per_job is not None:
+                cmd += ['--cpu', str(self.cpus_per_job)]
+            out = subprocess.run(cmd, check=True, capture_output=True,
+                                 text=True).stdout
+            score = parse_qvina_output(out)
+
+            pose_file = None
+            if out_pdbqt_file.exists():
+                pose_file = Path(self.pose_dir, f'{key}.sdf')
+                subprocess.run(self.obabel_cmd + [str(out_pdbqt_file), '-O',
+                                                  str(pose_file)],
+                               check=True, capture_output=True)
+
+        return self.store.put(key, score, pose_file)
+
+    def submit(self, receptor_file, sdf_file):
+        """
+        Schedule docking of all ligands in an SDF file.
+        Returns:
+            list of futures, one per ligand, each resolving to a result entry
+        """
+        receptor_pdbqt, receptor_hash = self.receptors.get(receptor_file)
+        futures = []
+        suppl = Chem.SDMolSupplier(str(sdf_file), sanitize=False)
+        for i, mol in enumerate(suppl):  # sdf file may contain several ligands
+            if mol is None:
+                raise ValueError(f'Could not read ligand {i} in {sdf_file}')
+            futures.append(self.executor.submit(
+                self.dock, receptor_pdbqt, receptor_hash,
+                Chem.MolToMolBlock(mol, kekulize=False)))
+        return futures
+
+    def score(self, receptor_file, sdf_file, return_rdmol=False):
+        """
+        Blocking equivalent of calculate_qvina2_score.
+        """
+        return self.collect(self.submit(receptor_file, sdf_file), return_rdmol)
+
+    @staticmethod
+    def collect(futures, return_rdmol=False, errors=None):
+        """
+        Wait for the docking results of submit.
+        Args:
+            futures: output of submit
+            return_rdmol: also return the docked poses
+            errors: if a list is given, failed ligands get a NaN score and no
+                pose, and their exceptions are appended to it instead of
+                being raised
+        """
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except DOCKING_ERRORS as e:
+                if errors is None:
+                    raise
+                errors.append(e)
+                results.append({'score': float('nan'), 'pose': None})
+        scores = [r['score'] for r in results]
+        if not return_rdmol:
+            return scores
+        rdmols = [None if r['pose'] is None else
+                  Chem.SDMolSupplier(r['pose'])[0] for r in results]
+        return scores, rdmols
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def get_receptor_file(sdf_file, pdbqt_dir, dataset='moad'):
+    """
+    Returns the receptor name and PDBQT file of a ligand SDF file.
+    """
+    if dataset == 'moad':
+        """
+        Ligand file names should be of the following form:
+        <receptor-name>_<pocket-id>_<some-suffix>.sdf
+        where <receptor-name> and <pocket-id> cannot contain any 
+        underscores, e.g.: 1abc-bio1_pocket0_gen.sdf
+        """
+        ligand_name = sdf_file.stem
+        receptor_name, pocket_id, *suffix = ligand_name.split('_')
+        suffix = '_'.join(suffix)
+        receptor_file = Path(pdbqt_dir, receptor_name + '.pdbqt')
+    elif dataset == 'crossdocked':
+        ligand_name = sdf_file.stem
+        receptor_name = ligand_name[:-4]
+        receptor_file = Path(pdbqt_dir, receptor_name + '.pdbqt')
+    return receptor_name, receptor_file
+
+
+def dock_sdf_files(scheduler, sdf_files, pdbqt_dir, dataset='moad'):
+    """
+    Docks the ligands of every SDF file into its receptor. Failures do not
+    stop the evaluation: a ligand that could not be docked gets a NaN score
+    (a single NaN if the whole file failed, e.g. because the receptor is
+    missing) and the error messages are recorded.
+    Returns:
+        dict with 'receptor', 'ligand', 'scores' and 'error' lists (error is
+        None for files without failures), dict of receptor name to
+        [scores, rdmols]
+    """
+    results = {'receptor': [], 'ligand': [], 'scores': [], 'error': []}
+    results_dict = {}
+
+    # Submit all ligands first so that the workers are always busy
+    jobs = []
+    for sdf_file in sdf_files:
+        receptor_name, receptor_file = get_receptor_file(sdf_file, pdbqt_dir,
+                                                         dataset)
+        try:
+            futures, error = scheduler.submit(receptor_file, sdf_file), None
+        except DOCKING_ERRORS as e:
+            futures, error = None, e
+        jobs.append((sdf_file, receptor_name, receptor_file, futures, error))
+
+    pbar = tqdm(jobs)
+    for sdf_file, receptor_name, receptor_file, futures, error in pbar:
+        pbar.set_description(f'Processing {sdf_file.name}')
+
+        if futures is None:
+            scores, rdmols, errors = [float('nan')], [None], [error]
+        else:
+            errors = []
+            scores, rdmols = scheduler.collect(futures, return_rdmol=True,
+                                               errors=errors)
+        for e in errors:
+            tqdm.write(f'{sdf_file}: {e}')
+
+        results['receptor'].append(str(receptor_file))
+        results['ligand'].append(str(sdf_file))
+        results['scores'].append(scores)
+        results['error'].append('; '.join(str(e) for e in errors) or None)
+        results_dict[receptor_name] = [scores, rdmols]
+
+    return results, results_dict
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('QuickVina evaluation')
     parser.add_argument('--pdbqt_dir', type=Path,
@@ -99,46 +400,26 @@ if __name__ == '__main__':
     parser.add_argument('--write_csv', action='store_true')
     parser.add_argument('--write_dict', action='store_true')
     parser.add_argument('--dataset', type=str, default='moad')
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='number of docking jobs running in parallel')
+    parser.add_argument('--cpus_per_job', type=int, default=None)
+    parser.add_argument('--size', type=int, default=20)
+    parser.add_argument('--exhaustiveness', type=int, default=16)
+    parser.add_argument('--qvina_cmd', type=str, default='qvina2.1',
+                        help="e.g. 'python analysis/fake_qvina.py' for tests")
     args = parser.parse_args()
 
     assert (args.sdf_dir is not None) ^ (args.sdf_files is not None)
 
-    results = {'receptor': [], 'ligand': [], 'scores': []}
-    results_dict = {}
     sdf_files = list(args.sdf_dir.glob('[!.]*.sdf')) \
         if args.sdf_dir is not None else args.sdf_files
-    pbar = tqdm(sdf_files)
-    for sdf_file in pbar:
-        pbar.set_description(f'Processing {sdf_file.name}')
-
-        if args.dataset == 'moad':
-            """
-            Ligand file names should be of the following form:
-            <receptor-name>_<pocket-id>_<some-suffix>.sdf
-            where <receptor-name> and <pocket-id> cannot contain any 
-            underscores, e.g.: 1abc-bio1_pocket0_gen.sdf
-            """
-            ligand_name = sdf_file.stem
-            receptor_name, pocket_id, *suffix = ligand_name.split('_')
-            suffix = '_'.join(suffix)
-            receptor_file = Path(args.pdbqt_dir, receptor_name + '.pdbqt')
-        elif args.dataset == 'crossdocked':
-            ligand_name = sdf_file.stem
-            receptor_name = ligand_name[:-4]
-            receptor_file = Path(args.pdbqt_dir, receptor_name + '.pdbqt')
-
-        try:
-            scores, rdmols = calculate_qvina2_score(
-                receptor_file, sdf_file, args.out_dir, return_rdmol=True)
-        except (ValueError, AttributeError) as e:
-            print(e)
-            continue
-        results['receptor'].append(str(receptor_file))
-        results['ligand'].append(str(sdf_file))
-        results['scores'].append(scores)
-
-        if args.write_dict:
-            results_dict[receptor_name] = [scores, rdmols]
+    scheduler = DockingScheduler(
+        args.out_dir, n_workers=args.n_workers, size=args.size,
+        exhaustiveness=args.exhaustiveness, qvina_cmd=args.qvina_cmd,
+        cpus_per_job=args.cpus_per_job)
+    results, results_dict = dock_sdf_files(scheduler, sdf_files,
+                                           args.pdbqt_dir, args.dataset)
+    scheduler.close()
 
     if args.write_csv:
         df = pd.DataFrame.from_dict(results)
@@ -0,0 +1,52 @@
+"""
+Stand-in for the qvina2.1 binary with the same command line interface and
+output format. It does not dock anything: the ligand is returned as the only
+pose and the affinity is derived from a hash of the inputs, so results are
+deterministic. Useful for testing the docking pipeline without QuickVina:
+
+    python analysis/docking.py ... --qvina_cmd 'python analysis/fake_qvina.py'
+"""
+import argparse
+import hashlib
+import time
+from pathlib import Path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Fake QuickVina 2')
+    parser.add_argument('--receptor', type=Path, required=True)
+    parser.add_argument('--ligand', type=Path, required=True)
+    parser.add_argument('--out', type=Path, default=None)
+    for axis in 'xyz':
+        parser.add_argument(f'--center_{axis}', type=float, required=True)
+        parser.add_argument(f'--size_{axis}', type=float, required=True)
+    parser.add_argument('--exhaustiveness', type=int, default=8)
+    parser.add_argument('--cpu', type=int, default=None)
+    parser.add_argument('--seconds', type=float, default=0.0,
+                        help='simulated run time')
+    args = parser.parse_args()
+
+    receptor = args.receptor.read_bytes()
+    ligand = args.ligand.read_text()
+    key = hashlib.sha1(
+        receptor + ligand.encode() +
+        f'{args.center_x}{args.center_y}{args.center_z}'
+        f'{args.exhaustiveness}'.encode()
+    ).hexdigest()
+    score = -3.0 - int(key[:8], 16) % 9000 / 1000
+    time.sleep(args.seconds)
+
+    out = args.out
+    if out is None:
+        out = Path(args.ligand.parent, args.ligand.stem + '_out.pdbqt')
+    with open(out, 'w') as f:
+        f.write('MODEL 1\n')
+        f.write(f'REMARK VINA RESULT: {score:8.1f}      0.000      0.000\n')
+        f.write(ligand)
+        f.write('ENDMDL\n')
+
+    print('mode |   affinity | dist from best mode')
+    print('     | (kcal/mol) | rmsd l.b.| rmsd u.b.')
+    print('-----+------------+----------+----------')
+    print(f'   1 {score:12.1f}      0.000      0.000')
+    print('Writing output ... done.')
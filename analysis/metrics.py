@@ -1,5 +1,6 @@
 import numpy as np
 from scipy.spatial.distance import cdist
+import torch
 from tqdm import tqdm
 from rdkit import Chem, DataStructs
 from rdkit.Chem import Descriptors, Crippen, Lipinski, QED
@@ -63,6 +64,76 @@ def check_stability(positions, atom_type, dataset_info, debug=False):
     return molecule_stable, nr_stable_bonds, n
 
 
+def get_valence_table(atom_decoder):
+    """
+    Boolean lookup table (n_atom_types, max_valence + 1) that is True where
+    the number of bonds is allowed for the atom type. The rows of types
+    without an entry in allowed_bonds are all False.
+    """
+    valences = [allowed_bonds.get(atom, []) for atom in atom_decoder]
+    valences = [[v] if isinstance(v, int) else list(v) for v in valences]
+    max_valence = max(max(v, default=0) for v in valences)
+    table = torch.zeros(len(atom_decoder), max_valence + 1, dtype=torch.bool)
+    for i, v in enumerate(valences):
+        table[i, v] = True
+    return table
+
+
+def check_stability_batch(positions, atom_type, batch_mask, dataset_info):
+    """
+    Batched version of check_stability for all molecules of a sampled batch.
+    Bond orders are only computed for atom pairs within the same molecule
+    (block-diagonal) and valences are checked with a lookup table.
+    :param positions: (n_atoms, 3) concatenated coordinates
+    :param atom_type: (n_atoms,) atom type indices
+    :param batch_mask: (n_atoms,) sorted molecule index of every atom
+    :return: per-molecule (n_molecules,) and per-atom (n_atoms,) boolean
+        stability arrays. As in check_stability, a KeyError is raised for
+        atom types without an entry in allowed_bonds.
+    """
+    positions = torch.as_tensor(positions).detach().cpu().double()
+    atom_type = torch.as_tensor(atom_type).detach().cpu().long()
+    batch_mask = torch.as_tensor(batch_mask).detach().cpu().long()
+    assert positions.ndim == 2 and positions.shape[1] == 3
+    assert torch.all(batch_mask[1:] >= batch_mask[:-1]), "mask must be sorted"
+
+    atom_decoder = dataset_info["atom_decoder"]
+    for i in torch.unique(atom_type).tolist():
+        if atom_decoder[i] not in allowed_bonds:
+            raise KeyError(atom_decoder[i])
+
+    n_molecules = int(batch_mask.max()) + 1 if len(batch_mask) > 0 else 0
+    sizes = torch.bincount(batch_mask, minlength=n_molecules)
+    offsets = torch.cumsum(sizes, 0) - sizes
+
+    # all ordered atom pairs (i, j) within every molecule
+    n_pairs = sizes ** 2
+    pair_mol = torch.repeat_interleave(torch.arange(n_molecules), n_pairs)
+    local = torch.arange(int(n_pairs.sum())) - torch.repeat_interleave(
+        torch.cumsum(n_pairs, 0) - n_pairs, n_pairs
+    )
+    rows = offsets[pair_mol] + local // sizes[pair_mol]
+    cols = offsets[pair_mol] + local % sizes[pair_mol]
+    off_diagonal = rows != cols
+    rows, cols = rows[off_diagonal], cols[off_diagonal]
+
+    dists = torch.linalg.norm(positions[rows] - positions[cols], dim=1)
+    order = get_bond_order_batch(atom_type[rows], atom_type[cols], dists, dataset_info)
+    nr_bonds = torch.zeros(len(positions), dtype=torch.long)
+    nr_bonds.index_add_(0, rows, order.long())
+
+    table = get_valence_table(atom_decoder)
+    atom_stable = torch.zeros(len(positions), dtype=torch.bool)
+    in_table = nr_bonds < table.shape[1]
+    atom_stable[in_table] = table[atom_type[in_table], nr_bonds[in_table]]
+
+    n_stable = torch.zeros(n_molecules, dtype=torch.long)
+    n_stable.index_add_(0, batch_mask, atom_stable.long())
+    molecule_stable = n_stable == sizes
+
+    return molecule_stable.numpy(), atom_stable.numpy()
+
+
 class BasicMolecularMetrics(object):
     def __init__(self, dataset_info, dataset_smiles_list=None,
                  connectivity_thresh=1.0):
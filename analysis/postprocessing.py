@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+
+import torch
+from rdkit import Chem
+
+import utils
+from analysis.molecule_builder import build_molecule, process_molecule
+
+
+def mol_to_block(mol):
+    """
+    Serialize an RDKit molecule (including its conformers in double precision
+    and all properties) to picklable bytes. Returns None for missing molecules.
+    """
+    if mol is None:
+        return None
+    return mol.ToBinary(Chem.PropertyPickleOptions.AllProps
+                        | Chem.PropertyPickleOptions.CoordsAsDouble)
+
+
+def mol_from_block(block):
+    return None if block is None else Chem.Mol(block)
+
+
+def build_and_process(positions, atom_types, dataset_info, process_kwargs):
+    """
+    Build a single molecule from its point cloud and apply the RDKit filters.
+    Args:
+        positions: N x 3 NumPy array
+        atom_types: N NumPy array
+        dataset_info: dict
+        process_kwargs: keyword arguments for process_molecule
+    Returns:
+        serialized raw molecule, serialized processed molecule (None if it
+        does not pass the filters)
+    """
+    mol = build_molecule(torch.from_numpy(positions),
+                         torch.from_numpy(atom_types), dataset_info,
+                         add_coords=True)
+    processed = process_molecule(mol, **process_kwargs)
+    return mol_to_block(mol), mol_to_block(processed)
+
+
+def _build_and_process_task(task, dataset_info, process_kwargs):
+    return build_and_process(*task, dataset_info, process_kwargs)
+
+
+class PendingMolecules:
+    """
+    Handle for a batch of molecules that is being post-processed.
+    """
+    def __init__(self, async_result):
+        self.async_result = async_result
+
+    def ready(self):
+        return self.async_result.ready()
+
+    def get(self):
+        """
+        Wait for the batch to finish.
+        Returns:
+            list of raw molecules, list of processed molecules (None where the
+            molecule did not pass the filters), both in sampling order
+        """
+        blocks = self.async_result.get()
+        raw = [mol_from_block(r) for r, _ in blocks]
+        processed = [mol_from_block(p) for _, p in blocks]
+        return raw, processed
+
+
+class _DoneResult:
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+class _FutureResult:
+    def __init__(self, future):
+        self.future = future
+
+    def ready(self):
+        return self.future.done()
+
+    def get(self):
+        return self.future.result()
+
+
+def _map(fn, tasks):
+    return [fn(t) for t in tasks]
+
+
+class PostProcessor:
+    """
+    Runs build_molecule and process_molecule for sampled point clouds in the
+    current process. Subclasses only need to override `map_async`.
+    """
+    def submit(self, x, atom_type, lig_mask, dataset_info, **process_kwargs):
+        """
+        Schedule post-processing of a sampled batch.
+        Args:
+            x: (n_atoms, 3) coordinates of all ligands
+            atom_type: (n_atoms,) atom type indices
+            lig_mask: (n_atoms,) batch mask
+            dataset_info: dict
+            process_kwargs: keyword arguments for process_molecule
+        Returns:
+            PendingMolecules
+        """
+        tasks = [
+            (pos.numpy(), types.numpy()) for pos, types in zip(
+                utils.batch_to_list(x.detach().cpu(), lig_mask),
+                utils.batch_to_list(atom_type.detach().cpu(), lig_mask))
+        ]
+        fn = partial(_build_and_process_task, dataset_info=dataset_info,
+                     process_kwargs=process_kwargs)
+        return PendingMolecules(self.map_async(fn, tasks))
+
+    def map_async(self, fn, tasks):
+        return _DoneResult(_map(fn, tasks))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ThreadPostProcessor(PostProcessor):
+    """
+    Post-processes molecules in a background thread of the current process,
+    so `submit` returns immediately. The batches are processed one after the
+    other, while the main thread samples (PyTorch releases the GIL inside its
+    operators).
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def map_async(self, fn, tasks):
+        return _FutureResult(self.executor.submit(_map, fn, tasks))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class PoolPostProcessor(PostProcessor):
+    """
+    Post-processes molecules in a pool of worker processes. Molecules are sent
+    to the workers in chunks and returned as binary mol blocks, so `submit`
+    returns immediately and the next batch can be sampled in the meantime.
+    """
+    def __init__(self, n_workers=None, chunksize=4, start_method='spawn'):
+        """
+        Args:
+            n_workers: number of processes, defaults to the number of CPUs
+            chunksize: number of molecules sent to a worker at once
+            start_method: 'spawn' avoids forking a process that already holds
+                CUDA or OpenMP state
+        """
+        self.chunksize = chunksize
+        self.pool = get_context(start_method).Pool(n_workers)
+
+    def map_async(self, fn, tasks):
+        return self.pool.map_async(fn, tasks, chunksize=self.chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def get_postprocessor(n_workers=0, background=False, **kwargs):
+    """
+    Serial post-processing for n_workers <= 1, a process pool otherwise.
+    Args:
+        n_workers: number of processes, None for the number of CPUs
+        background: run serial post-processing in a background thread
+            instead of on `submit`, so that sampling can continue
+        kwargs: arguments of PoolPostProcessor
+    """
+    if n_workers is not None and n_workers <= 1:
+        return ThreadPostProcessor() if background else PostProcessor()
+    return PoolPostProcessor(n_workers, **kwargs)
@@ -0,0 +1,280 @@
+import argparse
+from argparse import Namespace
+import io
+from pathlib import Path
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import yaml
+
+from dataset import load_processed_dataset, ProcessedLigandPocketDataset
+from dataset_pmhc import process_pmhc_pdb_file
+from equivariant_diffusion.dynamics import EGNNDynamics
+from equivariant_diffusion.conditional_model import ConditionalDDPM
+from equivariant_diffusion.inference import CompiledReverseStep
+
+
+def build_ddpm(config, n_types):
+    """Randomly initialized conditional model with the architecture of a
+    training config (timings do not depend on the weights)."""
+    egnn_params = Namespace(**config["egnn_params"])
+    diffusion_params = Namespace(**config["diffusion_params"])
+    dynamics = EGNNDynamics(
+        atom_nf=n_types,
+        residue_nf=n_types,
+        n_dims=3,
+        joint_nf=egnn_params.joint_nf,
+        hidden_nf=egnn_params.hidden_nf,
+        n_layers=egnn_params.n_layers,
+        attention=egnn_params.attention,
+        tanh=egnn_params.tanh,
+        norm_constant=egnn_params.norm_constant,
+        inv_sublayers=egnn_params.inv_sublayers,
+        sin_embedding=egnn_params.sin_embedding,
+        sin_encoding=egnn_params.sin_encoding,
+        normalization_factor=egnn_params.normalization_factor,
+        aggregation_method=egnn_params.aggregation_method,
+        edge_cutoff=egnn_params.__dict__.get("edge_cutoff"),
+        edge_max_neighbors=egnn_params.__dict__.get("edge_max_neighbors"),
+        update_pocket_coords=False,
+    )
+    return ConditionalDDPM(
+        dynamics=dynamics,
+        atom_nf=n_types,
+        residue_nf=n_types,
+        n_dims=3,
+        timesteps=diffusion_params.diffusion_steps,
+        noise_schedule=diffusion_params.diffusion_noise_schedule,
+        noise_precision=diffusion_params.diffusion_noise_precision,
+        loss_type=diffusion_params.diffusion_loss_type,
+        norm_values=diffusion_params.normalize_factors,
+        size_histogram=[[1]],
+    )
+
+
+def random_complexes(n_samples, peptide_size, pocket_size, n_types, radius=15.0):
+    """Peptides and pockets with random types and coordinates in a sphere."""
+
+    def part(n):
+        x = F.normalize(torch.randn(n_samples * n, 3), dim=1)
+        x = x * radius * torch.rand(n_samples * n, 1) ** (1 / 3)
+        return {
+            "x": x,
+            "one_hot": F.one_hot(
+                torch.randint(n_types, (n_samples * n,)), n_types
+            ).float(),
+            "size": torch.full((n_samples,), n),
+            "mask": torch.arange(n_samples).repeat_interleave(n),
+        }
+
+    return part(peptide_size), part(pocket_size)
+
+
+def benchmark_sampling(args):
+    torch.manual_seed(args.seed)
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+    ddpm = build_ddpm(config, args.n_types).eval()
+    peptide, pocket = random_complexes(
+        args.n_samples, args.peptide_size, args.pocket_size, args.n_types
+    )
+
+    def run(reverse_step):
+        start = time.time()
+        ddpm.sample_given_pocket(
+            {k: v.clone() for k, v in pocket.items()},
+            peptide["one_hot"],
+            peptide["mask"],
+            timesteps=args.timesteps,
+            fast_sampling=True,
+            reverse_step=reverse_step,
+        )
+        return time.time() - start
+
+    # warm-up (and compilation for the compiled variant)
+    compiled_step = CompiledReverseStep(ddpm, backend=args.backend)
+    results = {}
+    for name, step in [("eager", None), ("compiled", compiled_step)]:
+        start = time.time()
+        run(step)
+        warmup = time.time() - start
+        times = [run(step) for _ in range(args.repeats)]
+        results[name] = min(times) / args.timesteps
+        print(
+            f"{name:>8}: {1000 * results[name]:.2f} ms/step "
+            f"(first run incl. warm-up {warmup:.1f} s)"
+        )
+    print(f"speedup: {results['eager'] / results['compiled']:.2f}x")
+
+
+
+def collate_loop(batch):
+    """Reference collate with per-sample loops and float masks."""
+    out = {}
+    for prop in batch[0].keys():
+        if prop == "names":
+            out[prop] = [x[prop] for x in batch]
+        elif prop == "num_lig_atoms" or prop == "num_pocket_nodes":
+            out[prop] = torch.tensor([x[prop] for x in batch])
+        elif "mask" in prop:
+            out[prop] = torch.cat(
+                [i * torch.ones(len(x[prop])) for i, x in enumerate(batch)], dim=0
+            )
+        else:
+            out[prop] = torch.cat([x[prop] for x in batch], dim=0)
+    return out
+
+
+def write_random_split(path, n_complexes, peptide_size, pocket_size, n_types):
+    """Random processed split in the .npz format of process_pmhc.py."""
+    peptide, pocket = random_complexes(n_complexes, peptide_size, pocket_size, n_types)
+    np.savez(
+        path,
+        names=[f"complex_{i}" for i in range(n_complexes)],
+        lig_coords=peptide["x"].numpy(),
+        lig_one_hot=peptide["one_hot"].numpy(),
+        lig_mask=peptide["mask"].numpy(),
+        pocket_c_alpha=pocket["x"].numpy(),
+        pocket_one_hot=pocket["one_hot"].numpy(),
+        pocket_mask=pocket["mask"].numpy(),
+    )
+
+
+def benchmark_collate(args):
+    torch.manual_seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.data is None:
+            args.data = Path(tmp_dir, "random.npz")
+            write_random_split(
+                args.data,
+                max(args.batch_sizes),
+                args.peptide_size,
+                args.pocket_size,
+                args.n_types,
+            )
+        dataset = load_processed_dataset(args.data)
+
+    pin_memory = args.pin_memory and torch.cuda.is_available()
+    collate_fns = {
+        "loop": collate_loop,
+        "vectorized": lambda batch: ProcessedLigandPocketDataset.collate_fn(
+            batch, pin_memory=pin_memory
+        ),
+    }
+    for batch_size in args.batch_sizes:
+        batch = [dataset[i % len(dataset)] for i in range(batch_size)]
+        results = {}
+        for name, collate_fn in collate_fns.items():
+            collate_fn(batch)
+            start = time.time()
+            for _ in range(args.repeats):
+                collate_fn(batch)
+            results[name] = (time.time() - start) / args.repeats
+        print(
+            f"batch size {batch_size:>4}: "
+            + ", ".join(f"{k} {1000 * v:.3f} ms" for k, v in results.items())
+            + f", speedup {results['loop'] / results['vectorized']:.2f}x"
+        )
+
+
+
+def random_pmhc_pdb(n_mhc, n_peptide, rng, atoms=("N", "CA", "C", "O", "CB")):
+    """PDB string of an MHC chain M and a peptide chain P of random residues
+    (a few atoms scattered around every residue centre)."""
+    lines = []
+    for chain, n_residues, scale in (("M", n_mhc, 20.0), ("P", n_peptide, 6.0)):
+        for resseq in range(1, n_residues + 1):
+            centre = rng.normal(size=3) * scale
+            for name in atoms:
+                x, y, z = centre + rng.normal(size=3)
+                lines.append(
+                    f"ATOM  {len(lines) + 1:5d}  {name:<3s} ALA {chain}{resseq:4d}    "
+                    f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00           {name[0]}  "
+                )
+    lines.append("END")
+    return "\n".join(lines)
+
+
+def benchmark_interface(args):
+    if args.pdb_dir is None:
+        rng = np.random.default_rng(args.seed)
+        pdb_strings = [
+            random_pmhc_pdb(args.mhc_size, args.peptide_size, rng)
+            for _ in range(args.n_structures)
+        ]
+    else:
+        from process_pmhc import close_hdf5_handles, list_structures, read_structure
+
+        structures = list_structures(args.pdb_dir)[: args.n_structures]
+        pdb_strings = [read_structure(*structure) for structure in structures]
+        close_hdf5_handles()
+
+    results = {}
+    for backend in ["pdb2sql", "kdtree"]:
+        start = time.time()
+        results[backend] = [
+            process_pmhc_pdb_file(
+                io.StringIO(pdb_string),
+                atom_level=False,
+                select_interface=True,
+                pdb_string=pdb_string,
+                interface_backend=backend,
+            )[1]["types"]
+            for pdb_string in pdb_strings
+        ]
+        elapsed = (time.time() - start) / len(pdb_strings)
+        print(f"{backend:>8}: {1000 * elapsed:.2f} ms/structure")
+        results[f"{backend}_time"] = elapsed
+
+    n_equal = sum(a == b for a, b in zip(results["pdb2sql"], results["kdtree"]))
+    print(f"identical interface residues: {n_equal}/{len(pdb_strings)}")
+    print(f"speedup: {results['pdb2sql_time'] / results['kdtree_time']:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser(
+        "sampling", help="eager vs. compiled reverse diffusion steps"
+    )
+    p.add_argument("--config", type=Path, default="configs/pmhc_ca_cond.yml")
+    p.add_argument("--n_types", type=int, default=20)
+    p.add_argument("--n_samples", type=int, default=8)
+    p.add_argument("--peptide_size", type=int, default=9)
+    p.add_argument("--pocket_size", type=int, default=180)
+    p.add_argument("--timesteps", type=int, default=50)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--backend", type=str, default="inductor")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=benchmark_sampling)
+
+    p = subparsers.add_parser("collate", help="loop vs. vectorized collate_fn")
+    p.add_argument("--data", type=Path, default=None,
+                   help="processed split (.npz or directory), random if omitted")
+    p.add_argument("--batch_sizes", type=int, nargs="+",
+                   default=[32, 64, 128, 256, 512])
+    p.add_argument("--n_types", type=int, default=20)
+    p.add_argument("--peptide_size", type=int, default=9)
+    p.add_argument("--pocket_size", type=int, default=180)
+    p.add_argument("--repeats", type=int, default=100)
+    p.add_argument("--pin_memory", action="store_true")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=benchmark_collate)
+
+    p = subparsers.add_parser(
+        "interface", help="pdb2sql vs. KD-tree interface residue selection"
+    )
+    p.add_argument("--pdb_dir", type=Path, default=None,
+                   help="directory with pdb/hdf5 files, random if omitted")
+    p.add_argument("--n_structures", type=int, default=50)
+    p.add_argument("--mhc_size", type=int, default=180)
+    p.add_argument("--peptide_size", type=int, default=9)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=benchmark_interface)
+
+    args = parser.parse_args()
+    args.func(args)
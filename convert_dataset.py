@@ -0,0 +1,39 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from dataset import write_memmap_dataset
+
+
+def convert_npz_dataset(npz_path, out_dir=None):
+    """
+    Converts a processed .npz split to the memory-mappable directory format
+    (one contiguous .npy file per field plus ligand and pocket offsets).
+    By default 'train.npz' is written to 'train/' next to it.
+    """
+    npz_path = Path(npz_path)
+    out_dir = npz_path.with_suffix("") if out_dir is None else Path(out_dir)
+
+    with np.load(npz_path, allow_pickle=True) as f:
+        data = {key: val for key, val in f.items()}
+    names = data.pop("names")
+
+    write_memmap_dataset(out_dir, names, **data)
+    return out_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("datadir", type=Path)
+    parser.add_argument("--splits", type=str, nargs="+",
+                        default=["train", "val", "test"])
+    args = parser.parse_args()
+
+    for split in args.splits:
+        npz_path = Path(args.datadir, f"{split}.npz")
+        if not npz_path.exists():
+            print(f"{npz_path} not found, skipping")
+            continue
+        out_dir = convert_npz_dataset(npz_path)
+        print(f"{npz_path} -> {out_dir}")
@@ -1,76 +1,560 @@
+import json
 import os
+from pathlib import Path
+
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+
+
+def get_offsets(mask):
+    """Start index of every sample in a sorted mask, followed by its length."""
+    if len(mask) == 0:
+        return np.zeros(1, dtype=np.int64)
+    sections = np.where(np.diff(mask))[0] + 1
+    return np.concatenate(([0], sections, [len(mask)])).astype(np.int64)
+
+
+# per-sample statistics stored next to the per-node fields
+SAMPLE_STATS = (
+    "center_of_mass",
+    "num_lig_atoms",
+    "num_pocket_nodes",
+    "radius_of_gyration",
+)
+
+
+def compute_sample_stats(lig_coords, lig_mask, pocket_c_alpha, pocket_mask):
+    """
+    Center of mass (unweighted mean of the ligand and pocket nodes), sizes
+    and radius of gyration of every complex, computed without a Python loop.
+    :return: dict with the keys in SAMPLE_STATS
+    """
+    num_lig_atoms = np.diff(get_offsets(lig_mask))
+    num_pocket_nodes = np.diff(get_offsets(pocket_mask))
+    n_samples = len(num_lig_atoms)
+    lig_idx = np.repeat(np.arange(n_samples), num_lig_atoms)
+    pocket_idx = np.repeat(np.arange(n_samples), num_pocket_nodes)
+    n_nodes = num_lig_atoms + num_pocket_nodes
+
+    def segment_sum(idx, values):
+        return np.bincount(idx, weights=values, minlength=n_samples)
+
+    center_of_mass = np.stack(
+        [
+            segment_sum(lig_idx, lig_coords[:, d])
+            + segment_sum(pocket_idx, pocket_c_alpha[:, d])
+            for d in range(lig_coords.shape[1])
+        ],
+        axis=1,
+    ) / n_nodes[:, None]
+
+    squared_dist = segment_sum(
+        lig_idx, ((lig_coords - center_of_mass[lig_idx]) ** 2).sum(1)
+    ) + segment_sum(
+        pocket_idx, ((pocket_c_alpha - center_of_mass[pocket_idx]) ** 2).sum(1)
+    )
+
+    return {
+        "center_of_mass": center_of_mass.astype(lig_coords.dtype),
+        "num_lig_atoms": num_lig_atoms,
+        "num_pocket_nodes": num_pocket_nodes,
+        "radius_of_gyration": np.sqrt(squared_dist / n_nodes).astype(
+            lig_coords.dtype
+        ),
+    }
+
+
+def write_memmap_dataset(out_dir, names, **arrays):
+    """
+    Writes a processed split in the memory-mappable format read by
+    MemmapLigandPocketDataset: one uncompressed .npy file per field plus the
+    ligand and pocket offsets and the statistics (SAMPLE_STATS) of every
+    sample.
+    :param out_dir: output directory
+    :param names: sample names
+    :param arrays: concatenated fields as in the .npz files, must contain the
+        ligand and pocket masks
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    lig_offsets = get_offsets(arrays["lig_mask"])
+    pocket_offsets = get_offsets(arrays["pocket_mask"])
+    assert len(lig_offsets) == len(pocket_offsets) == len(names) + 1
+
+    arrays = {k: v for k, v in arrays.items() if k not in SAMPLE_STATS}
+    stats = compute_sample_stats(
+        arrays["lig_coords"],
+        arrays["lig_mask"],
+        arrays["pocket_c_alpha"],
+        arrays["pocket_mask"],
+    )
+
+    for key, value in arrays.items():
+        np.save(out_dir / f"{key}.npy", np.ascontiguousarray(value))
+    np.save(out_dir / "lig_offsets.npy", lig_offsets)
+    np.save(out_dir / "pocket_offsets.npy", pocket_offsets)
+    np.save(out_dir / "names.npy", np.array(names, dtype=str))
+    np.savez(out_dir / "stats.npz", **stats)
+
+    with open(out_dir / "fields.json", "w") as f:
+        json.dump(sorted(arrays.keys()), f)
+
+
+def load_processed_dataset(path, center=True):
+    """
+    Opens a processed split. Directories written by ShardWriter or
+    write_memmap_dataset are memory-mapped, everything else is read as .npz
+    file. A path 'train.npz' is resolved to the directory 'train' if it
+    exists.
+    """
+    path = Path(path)
+    if not path.is_dir() and path.suffix == ".npz" and path.with_suffix("").is_dir():
+        path = path.with_suffix("")
+    if Path(path, "manifest.json").exists():
+        return ShardedLigandPocketDataset(path, center=center)
+    if path.is_dir():
+        return MemmapLigandPocketDataset(path, center=center)
+    return ProcessedLigandPocketDataset(path, center=center)
 
 
 class ProcessedLigandPocketDataset(Dataset):
+    """
+    Every field is stored as one contiguous tensor, samples are located by the
+    int64 ligand and pocket offsets and __getitem__ returns views. Per-sample
+    statistics (SAMPLE_STATS) are available in self.stats.
+    """
+
     def __init__(self, npz_path, center=True):
 
         with np.load(npz_path, allow_pickle=True) as f:
             data = {key: val for key, val in f.items()}
 
-        # split data based on mask
-        self.data = {}
-        for (k, v) in data.items():
-            if k == "names":
-                self.data[k] = v
-                continue
+        self.names = data.pop("names")
+        self.lig_offsets = get_offsets(data["lig_mask"])
+        self.pocket_offsets = get_offsets(data["pocket_mask"])
 
-            # mask = data['lig_mask'] if 'lig' in k else data['pocket_mask']
-            # self.data[k] = [torch.from_numpy(v[mask == i])
-            #                 for i in np.unique(mask)]
-            sections = (
-                np.where(np.diff(data["lig_mask"]))[0] + 1
-                if "lig" in k
-                else np.where(np.diff(data["pocket_mask"]))[0] + 1
+        # statistics are computed here for files written without them
+        self.stats = {k: data.pop(k) for k in SAMPLE_STATS if k in data}
+        if len(self.stats) < len(SAMPLE_STATS):
+            self.stats = compute_sample_stats(
+                data["lig_coords"],
+                data["lig_mask"],
+                data["pocket_c_alpha"],
+                data["pocket_mask"],
             )
-            self.data[k] = [torch.from_numpy(x) for x in np.split(v, sections)]
-
-            # add number of nodes for convenience
-            if k == "lig_mask":
-                self.data["num_lig_atoms"] = torch.tensor(
-                    [len(x) for x in self.data["lig_mask"]]
-                )
-            elif k == "pocket_mask":
-                self.data["num_pocket_nodes"] = torch.tensor(
-                    [len(x) for x in self.data["pocket_mask"]]
-                )
+
+        self.data = {k: torch.from_numpy(v) for k, v in data.items()}
 
         if center:
-            for i in range(len(self.data["lig_coords"])):
-                mean = (
-                    self.data["lig_coords"][i].sum(0)
-                    + self.data["pocket_c_alpha"][i].sum(0)
-                ) / (
-                    len(self.data["lig_coords"][i])
-                    + len(self.data["pocket_c_alpha"][i])
-                )
-                self.data["lig_coords"][i] = self.data["lig_coords"][i] - mean
-                self.data["pocket_c_alpha"][i] = self.data["pocket_c_alpha"][i] - mean
+            center_of_mass = torch.from_numpy(self.stats["center_of_mass"])
+            self.data["lig_coords"] -= center_of_mass.repeat_interleave(
+                self.num_lig_atoms, dim=0
+            )
+            self.data["pocket_c_alpha"] -= center_of_mass.repeat_interleave(
+                self.num_pocket_nodes, dim=0
+            )
+
+    @property
+    def num_lig_atoms(self):
+        return torch.from_numpy(np.diff(self.lig_offsets))
+
+    @property
+    def num_pocket_nodes(self):
+        return torch.from_numpy(np.diff(self.pocket_offsets))
+
+    def get_slices(self, idx):
+        """Ligand and pocket node ranges of sample idx."""
+        return (
+            slice(self.lig_offsets[idx], self.lig_offsets[idx + 1]),
+            slice(self.pocket_offsets[idx], self.pocket_offsets[idx + 1]),
+        )
 
     def __len__(self):
-        return len(self.data["names"])
+        return len(self.names)
 
     def __getitem__(self, idx):
-        return {key: val[idx] for key, val in self.data.items()}
+        lig, pocket = self.get_slices(idx)
+        item = {"names": str(self.names[idx])}
+        for key, value in self.data.items():
+            item[key] = torch.as_tensor(value[lig if "lig" in key else pocket])
+        item["num_lig_atoms"] = lig.stop - lig.start
+        item["num_pocket_nodes"] = pocket.stop - pocket.start
+        return item
 
     @staticmethod
-    def collate_fn(batch):
-        out = {}
-        for prop in batch[0].keys():
+    def collate_fn(batch, pin_memory=False):
+        """
+        Concatenates all fields of a list of samples. Batch masks are int64
+        sample indices starting at zero (needed for torch_scatter).
+        :param batch: list of samples returned by __getitem__
+        :param pin_memory: return page-locked tensors (only useful in the main
+            process, DataLoader workers should use DataLoader(pin_memory=True))
+        """
+        out = {
+            "names": [x["names"] for x in batch],
+            "num_lig_atoms": torch.tensor([x["num_lig_atoms"] for x in batch]),
+            "num_pocket_nodes": torch.tensor([x["num_pocket_nodes"] for x in batch]),
+        }
+        sample_idx = torch.arange(len(batch))
 
-            if prop == "names":
-                out[prop] = [x[prop] for x in batch]
-            elif prop == "num_lig_atoms" or prop == "num_pocket_nodes":
-                out[prop] = torch.tensor([x[prop] for x in batch])
-            elif "mask" in prop:
-                # make sure indices in batch start at zero (needed for
-                # torch_scatter)
-                out[prop] = torch.cat(
-                    [i * torch.ones(len(x[prop])) for i, x in enumerate(batch)], dim=0
-                )
+        for prop in batch[0].keys():
+            if prop in out:
+                continue
+            if "mask" in prop:
+                sizes = out["num_lig_atoms" if "lig" in prop else "num_pocket_nodes"]
+                out[prop] = torch.repeat_interleave(sample_idx, sizes)
             else:
                 out[prop] = torch.cat([x[prop] for x in batch], dim=0)
 
+        if pin_memory:
+            out = {
+                k: v.pin_memory() if isinstance(v, torch.Tensor) else v
+                for k, v in out.items()
+            }
+
         return out
+
+
+class MemmapLigandPocketDataset(ProcessedLigandPocketDataset):
+    """
+    Dataset on a directory written by write_memmap_dataset. All fields are
+    memory-mapped (copy-on-write, the files are never modified) and samples
+    are centered in __getitem__ with the stored centers of mass, so opening is
+    O(1) and the data is shared between DataLoader workers through the page
+    cache.
+    """
+
+    def __init__(self, data_dir, center=True):
+        self.data_dir = Path(data_dir)
+        self.center = center
+
+        with open(self.data_dir / "fields.json", "r") as f:
+            fields = json.load(f)
+
+        self.data = {
+            key: np.load(self.data_dir / f"{key}.npy", mmap_mode="c")
+            for key in fields
+        }
+        self.names = np.load(self.data_dir / "names.npy", mmap_mode="r")
+        self.lig_offsets = np.load(self.data_dir / "lig_offsets.npy")
+        self.pocket_offsets = np.load(self.data_dir / "pocket_offsets.npy")
+
+        if (self.data_dir / "stats.npz").exists():
+            with np.load(self.data_dir / "stats.npz") as f:
+                self.stats = {key: val for key, val in f.items()}
+        else:
+            self.stats = compute_sample_stats(
+                self.data["lig_coords"],
+                self.data["lig_mask"],
+                self.data["pocket_c_alpha"],
+                self.data["pocket_mask"],
+            )
+
+    def __getitem__(self, idx):
+        item = super().__getitem__(idx)
+
+        if self.center:
+            center_of_mass = torch.from_numpy(self.stats["center_of_mass"][idx])
+            item["lig_coords"] = item["lig_coords"] - center_of_mass
+            item["pocket_c_alpha"] = item["pocket_c_alpha"] - center_of_mass
+
+        return item
+
+
+def get_size_stats(sizes):
+    return {
+        "min": int(np.min(sizes)),
+        "max": int(np.max(sizes)),
+        "mean": float(np.mean(sizes)),
+        "sum": int(np.sum(sizes)),
+    }
+
+
+class ShardWriter:
+    """
+    Writes a split incrementally as fixed-size shards. Every shard is a
+    directory in the write_memmap_dataset format and manifest.json lists the
+    shards with their sample counts and size statistics. Only one shard is
+    held in memory at a time.
+
+    Usage:
+        with ShardWriter(out_dir, shard_size=10000) as writer:
+            for ...:
+                writer.add(name, lig_coords=..., lig_one_hot=...,
+                           pocket_c_alpha=..., pocket_one_hot=...)
+    """
+
+    def __init__(self, out_dir, shard_size=10000):
+        assert shard_size > 0
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.shards = []
+        self.buffer = []
+
+    def add(self, name, **fields):
+        """
+        Adds one sample. Fields starting with 'lig' have one row per ligand
+        node, all others one row per pocket node. Masks are created here.
+        """
+        self.buffer.append((name, fields))
+        if len(self.buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        names = [name for name, _ in self.buffer]
+        arrays = {
+            key: np.concatenate([fields[key] for _, fields in self.buffer], axis=0)
+            for key in self.buffer[0][1].keys()
+        }
+        lig_key = next(k for k in arrays if k.startswith("lig"))
+        pocket_key = next(k for k in arrays if not k.startswith("lig"))
+        num_lig_atoms = [len(fields[lig_key]) for _, fields in self.buffer]
+        num_pocket_nodes = [len(fields[pocket_key]) for _, fields in self.buffer]
+        sample_idx = np.arange(len(names), dtype=np.int32)
+        arrays["lig_mask"] = np.repeat(sample_idx, num_lig_atoms)
+        arrays["pocket_mask"] = np.repeat(sample_idx, num_pocket_nodes)
+
+        shard_name = f"shard_{len(self.shards):05d}"
+        write_memmap_dataset(self.out_dir / shard_name, names, **arrays)
+        self.shards.append(
+            {
+                "path": shard_name,
+                "n_samples": len(names),
+                "num_lig_atoms": get_size_stats(num_lig_atoms),
+                "num_pocket_nodes": get_size_stats(num_pocket_nodes),
+            }
+        )
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        manifest = {
+            "n_samples": sum(shard["n_samples"] for shard in self.shards),
+            "shards": self.shards,
+        }
+        with open(self.out_dir / "manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class ShardedLigandPocketDataset(Dataset):
+    """
+    Dataset on a directory written by ShardWriter. Shards are memory-mapped
+    on first access, so every process only touches the shards of the samples
+    it actually reads (see ShardShuffleSampler).
+    """
+
+    def __init__(self, data_dir, center=True):
+        self.data_dir = Path(data_dir)
+        self.center = center
+
+        with open(self.data_dir / "manifest.json", "r") as f:
+            self.manifest = json.load(f)
+
+        self.shard_sizes = [shard["n_samples"] for shard in self.manifest["shards"]]
+        self.shard_offsets = np.concatenate(([0], np.cumsum(self.shard_sizes)))
+        self.shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
+
+    def get_shard(self, shard_idx):
+        if shard_idx not in self.shards:
+            path = self.data_dir / self.manifest["shards"][shard_idx]["path"]
+            self.shards[shard_idx] = MemmapLigandPocketDataset(path, center=self.center)
+        return self.shards[shard_idx]
+
+    @property
+    def num_lig_atoms(self):
+        return torch.cat(
+            [self.get_shard(i).num_lig_atoms for i in range(len(self.shard_sizes))]
+        )
+
+    @property
+    def num_pocket_nodes(self):
+        return torch.cat(
+            [self.get_shard(i).num_pocket_nodes for i in range(len(self.shard_sizes))]
+        )
+
+    @property
+    def stats(self):
+        shards = [self.get_shard(i) for i in range(len(self.shard_sizes))]
+        return {
+            key: np.concatenate([shard.stats[key] for shard in shards])
+            for key in SAMPLE_STATS
+        }
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def __getitem__(self, idx):
+        shard_idx = np.searchsorted(self.shard_offsets, idx, side="right") - 1
+        return self.get_shard(shard_idx)[idx - self.shard_offsets[shard_idx]]
+
+    collate_fn = staticmethod(ProcessedLigandPocketDataset.collate_fn)
+
+
+class ShardShuffleSampler(Sampler):
+    """
+    Sampler for ShardedLigandPocketDataset that shuffles the order of the
+    shards and the samples within every shard. Every rank gets a contiguous
+    part of the resulting order (padded by wrapping around so that all ranks
+    have the same length), hence it only reads a few shards per epoch.
+    The order only depends on the seed and the epoch given to set_epoch(),
+    which Lightning calls before every epoch.
+    """
+
+    def __init__(self, shard_sizes, shuffle=True, seed=0, num_replicas=1, rank=0):
+        assert 0 <= rank < num_replicas
+        self.shard_sizes = list(shard_sizes)
+        self.shard_offsets = np.concatenate(([0], np.cumsum(self.shard_sizes)))
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        shard_order = range(len(self.shard_sizes))
+        if self.shuffle:
+            shard_order = torch.randperm(len(self.shard_sizes), generator=g).tolist()
+
+        indices = []
+        for shard_idx in shard_order:
+            size = self.shard_sizes[shard_idx]
+            shard_indices = (
+                torch.randperm(size, generator=g)
+                if self.shuffle
+                else torch.arange(size)
+            )
+            indices.append(shard_indices + int(self.shard_offsets[shard_idx]))
+        indices = torch.cat(indices).tolist()
+
+        n = len(self)
+        indices = (indices * (n * self.num_replicas // len(indices) + 1))[
+            : n * self.num_replicas
+        ]
+        return iter(indices[self.rank * n : (self.rank + 1) * n])
+
+    def __len__(self):
+        return -(-int(self.shard_offsets[-1]) // self.num_replicas)
+
+
+class SizeBucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups samples with the same number of ligand atoms and
+    pocket nodes and fills every batch up to a budget of edges instead of a
+    fixed number of samples. The cost of a sample is the number of edges of
+    the complete graph over its ligand and pocket nodes, which bounds the
+    number of EGNN messages.
+
+    Buckets are visited in order of increasing size and a partially filled
+    batch is continued with the next bucket, hence the partition only depends
+    on the sizes and the number of batches is the same in every epoch.
+    Samples are shuffled within buckets and batches are shuffled across the
+    epoch, depending on the seed and the epoch given to set_epoch(). With
+    num_replicas > 1 every rank gets an equal share of the batches (wrapping
+    around if necessary).
+    """
+
+    def __init__(
+        self,
+        num_lig_atoms,
+        num_pocket_nodes,
+        edge_budget,
+        max_batch_size=None,
+        shuffle=True,
+        seed=0,
+        num_replicas=1,
+        rank=0,
+    ):
+        assert edge_budget > 0
+        assert 0 <= rank < num_replicas
+        self.num_lig_atoms = torch.as_tensor(num_lig_atoms).long()
+        self.num_pocket_nodes = torch.as_tensor(num_pocket_nodes).long()
+        self.edge_budget = edge_budget
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        self.cost = (self.num_lig_atoms + self.num_pocket_nodes) ** 2
+
+        # samples grouped by (num_lig_atoms, num_pocket_nodes)
+        keys = (
+            self.num_lig_atoms * (int(self.num_pocket_nodes.max()) + 1)
+            + self.num_pocket_nodes
+        )
+        order = torch.argsort(keys, stable=True)
+        _, counts = torch.unique_consecutive(keys[order], return_counts=True)
+        self.buckets = list(torch.split(order, counts.tolist()))
+
+        # Batch boundaries in the concatenated buckets. All samples of a
+        # bucket have the same cost, so the boundaries hold for any order
+        # within the buckets and every epoch is packed the same way.
+        self.bounds = self.pack(self.cost[order].tolist())
+        self.num_batches = len(self.bounds)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def pack(self, costs):
+        """
+        Greedily splits a sequence of sample costs into batches.
+        :return: list of (start, end) positions of the batches
+        """
+        bounds, start, batch_cost = [], 0, 0
+        for i, cost in enumerate(costs):
+            full = batch_cost + cost > self.edge_budget or (
+                self.max_batch_size is not None
+                and i - start >= self.max_batch_size
+            )
+            if i > start and full:
+                bounds.append((start, i))
+                start, batch_cost = i, 0
+            batch_cost += cost
+        if len(costs) > start:
+            bounds.append((start, len(costs)))
+        return bounds
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        buckets = self.buckets
+        if self.shuffle:
+            buckets = [b[torch.randperm(len(b), generator=g)] for b in buckets]
+        order = torch.cat(buckets).tolist()
+        batches = [order[start:end] for start, end in self.bounds]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g)]
+
+        # same number of batches on every rank
+        total = len(self) * self.num_replicas
+        batches = (batches * (total // len(batches) + 1))[:total]
+        return iter(batches[self.rank :: self.num_replicas])
+
+    def __len__(self):
+        return -(-self.num_batches // self.num_replicas)
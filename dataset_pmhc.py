@@ -1,3 +1,4 @@
+import hashlib
 import io
 import json
 import os
@@ -10,8 +11,6 @@ from Bio.PDB.Model import Model
 from Bio.PDB.Chain import Chain
 from Bio.PDB.Residue import Residue
 from Bio.PDB.Atom import Atom
-from pdb2sql import pdb2sql
-from pdb2sql import interface as extract_interface
 from Bio import BiopythonDeprecationWarning
 
 import h5py
@@ -20,6 +19,9 @@ import torch
 from torch.utils.data import Dataset
 import torch.nn.functional as F
 from scipy.ndimage import gaussian_filter
+from scipy.spatial import cKDTree
+
+from dataset import ProcessedLigandPocketDataset
 
 warnings.simplefilter(action='ignore', category=BiopythonDeprecationWarning)
 
@@ -88,6 +90,182 @@ def get_coords_and_types(chain, atom_level=True, device="cpu", interface_residue
     return coords, types
 
 
+# fixed columns (start, end) of the fields of PDB ATOM/HETATM records
+PDB_COLUMNS = {
+    "name": (12, 16),
+    "altloc": (16, 17),
+    "resname": (17, 20),
+    "chain": (21, 22),
+    "resseq": (22, 26),
+    "icode": (26, 27),
+    "x": (30, 38),
+    "y": (38, 46),
+    "z": (46, 54),
+}
+
+
+def read_pdb_atoms(pdb):
+    """
+    Read the ATOM/HETATM records of a PDB file into numpy arrays using the
+    fixed PDB columns, without building a Biopython structure. Raises a
+    ValueError for files this reader does not handle (several models,
+    alternate locations, malformed records), callers fall back to Biopython
+    :param pdb: pdb content as str or bytes, or a sequence of lines (e.g. the
+        'complex' dataset of an hdf5 record)
+    :return: dict with coords (n, 3), name, resname, chain, resseq, icode and
+        hetero arrays
+    """
+    if isinstance(pdb, str):
+        pdb = pdb.encode()
+    if isinstance(pdb, bytes):
+        pdb = pdb.splitlines()
+    lines = np.array(pdb, dtype="S80")
+
+    if np.char.startswith(lines, b"MODEL").sum() > 1:
+        raise ValueError("Only PDB files with a single model are supported")
+
+    hetero = np.char.startswith(lines, b"HETATM")
+    is_atom = np.char.startswith(lines, b"ATOM") | hetero
+    records = lines[is_atom]
+    chars = records.view(np.uint8).reshape(len(records), 80)
+
+    def column(key):
+        start, end = PDB_COLUMNS[key]
+        field = np.ascontiguousarray(chars[:, start:end]).view(f"S{end - start}")
+        return np.char.strip(field.ravel())
+
+    if np.any(column("altloc") != b""):
+        raise ValueError("Alternate locations are not supported")
+
+    coords = np.stack([column("x"), column("y"), column("z")], axis=1)
+    return {
+        "coords": coords.astype(np.float32),
+        "name": column("name").astype(str),
+        "resname": column("resname").astype(str),
+        "chain": column("chain").astype(str),
+        "resseq": column("resseq").astype(np.int64),
+        "icode": column("icode").astype(str),
+        "hetero": hetero[is_atom],
+    }
+
+
+def get_residue_index(atoms):
+    """Index of the residue of every atom, residues are consecutive atoms
+    with the same chain, residue number, insertion code and record type"""
+    keys = ("chain", "resseq", "icode", "hetero")
+    new_residue = np.ones(len(atoms["chain"]), dtype=bool)
+    new_residue[1:] = np.any(
+        [atoms[k][1:] != atoms[k][:-1] for k in keys], axis=0
+    )
+    return np.cumsum(new_residue) - 1
+
+
+def get_chain_coords_and_types(
+    atoms, chain, atom_level=True, device="cpu", interface_residue_ids=None
+):
+    """
+    Same as get_coords_and_types for the output of read_pdb_atoms
+    :param atoms: output of read_pdb_atoms
+    :param chain: the chain id
+    :return: coords, types
+    """
+    in_chain = atoms["chain"] == chain
+    if not np.any(in_chain):
+        raise KeyError(chain)
+
+    if atom_level:
+        coords = atoms["coords"][in_chain]
+        types = atoms["name"][in_chain].tolist()
+    else:
+        residue_index = get_residue_index(atoms)
+        selected = in_chain
+        if interface_residue_ids is not None:
+            selected = selected & np.isin(atoms["resseq"], interface_residue_ids)
+
+        # first CA atom of every selected residue
+        is_ca = selected & (atoms["name"] == "CA")
+        _, first = np.unique(residue_index[is_ca], return_index=True)
+        ca_idx = np.flatnonzero(is_ca)[first]
+
+        missing = np.setdiff1d(residue_index[selected], residue_index[ca_idx])
+        for res in missing:
+            i = np.flatnonzero(residue_index == res)[0]
+            print(
+                f"Carbon alpha atom missing in residue {atoms['resname'][i]} "
+                f"{atoms['resseq'][i]}, chain {chain}"
+            )
+
+        coords = atoms["coords"][ca_idx]
+        types = [three_to_one(resname) for resname in atoms["resname"][ca_idx]]
+
+    coords = torch.tensor(coords.reshape(-1, 3), device=device, dtype=FLOAT_TYPE)
+    return coords, types
+
+
+def read_pdb_content(pdb_path_or_stream):
+    if hasattr(pdb_path_or_stream, "read"):
+        return pdb_path_or_stream.read()
+    return Path(pdb_path_or_stream).read_text()
+
+
+def get_contact_residue_ids(coords1, resseq1, coords2, cutoff=8.5):
+    """
+    Residue numbers of the atoms in coords1 that are within `cutoff`
+    (inclusive) of any atom in coords2
+    :return: sorted list of residue numbers
+    """
+    if len(coords1) == 0 or len(coords2) == 0:
+        return []
+
+    tree = cKDTree(np.asarray(coords2, dtype=np.float64))
+    n_contacts = tree.query_ball_point(
+        np.asarray(coords1, dtype=np.float64), r=cutoff, return_length=True
+    )
+    return sorted({int(r) for r, n in zip(resseq1, n_contacts) if n > 0})
+
+
+def get_interface_residue_ids(pdb_model, chain1="M", chain2="P", cutoff=8.5):
+    """
+    Get the residue numbers of chain1 in contact with chain2, i.e. with any
+    atom within `cutoff` (inclusive) of any atom of chain2. Same semantics and
+    default cutoff as pdb2sql's interface.get_contact_residues, computed with
+    a KD-tree over the already parsed atoms
+    :param pdb_model: Biopython model or output of read_pdb_atoms
+    :return: sorted list of residue numbers
+    """
+    if isinstance(pdb_model, dict):
+        in_chain1 = pdb_model["chain"] == chain1
+        in_chain2 = pdb_model["chain"] == chain2
+        return get_contact_residue_ids(
+            pdb_model["coords"][in_chain1],
+            pdb_model["resseq"][in_chain1],
+            pdb_model["coords"][in_chain2],
+            cutoff=cutoff,
+        )
+
+    atoms1 = list(pdb_model[chain1].get_atoms())
+    atoms2 = list(pdb_model[chain2].get_atoms())
+    return get_contact_residue_ids(
+        [a.get_coord() for a in atoms1],
+        [a.get_parent().id[1] for a in atoms1],
+        [a.get_coord() for a in atoms2],
+        cutoff=cutoff,
+    )
+
+
+def get_interface_residue_ids_pdb2sql(pdb_path_or_string, chain1="M", chain2="P"):
+    """
+    Reference implementation of get_interface_residue_ids that builds a
+    pdb2sql database of the complex
+    """
+    from pdb2sql import pdb2sql
+    from pdb2sql import interface as extract_interface
+
+    interface = extract_interface(pdb2sql(pdb_path_or_string))
+    interface_residues = interface.get_contact_residues(chain1=chain1, chain2=chain2)
+    return [residue[1] for residue in interface_residues[chain1]]
+
+
 def process_pmhc_pdb_file(
     pdb_path_or_stream,
     # encoder,
@@ -95,42 +273,73 @@ def process_pmhc_pdb_file(
     # n_samples=1,
     device="cpu",
     select_interface=False,
-    pdb_string=None
+    pdb_string=None,
+    interface_backend="kdtree",
+    reader="fixed_columns",
 ):
     """
     Process the pdb file to get the peptide and pocket representations
     :param pdb_path: the path of the pdb file
     :param pocket_atoms: whether to use atoms or residues for the pocket
     :param peptide_atoms: whether to use atoms or residues for the peptide
+    :param interface_backend: 'kdtree' or 'pdb2sql', how interface residues
+        are selected if select_interface is set
+    :param reader: 'fixed_columns' (read_pdb_atoms, falls back to Biopython
+        if the file is not supported) or 'biopython'
 
     :return: peptide, mhc
     """
-    parser = PDBParser(QUIET=True)
-    pdb_models = parser.get_structure("", pdb_path_or_stream)
+    assert reader in {"fixed_columns", "biopython"}
+    pdb_model = None
+    if reader == "fixed_columns":
+        content = read_pdb_content(pdb_path_or_stream)
+        if pdb_string is None:
+            pdb_string = content
+        try:
+            pdb_model = read_pdb_atoms(content)
+        except ValueError:
+            pdb_path_or_stream = io.StringIO(content)
 
-    assert len(pdb_models) == 1
-    pdb_model = pdb_models[0]
+    if pdb_model is None:
+        parser = PDBParser(QUIET=True)
+        pdb_models = parser.get_structure("", pdb_path_or_stream)
+
+        assert len(pdb_models) == 1
+        pdb_model = pdb_models[0]
 
     mhc_interface_residue_ids = None
     if select_interface:
-        if pdb_string is None:
-            pdb_db = pdb2sql(pdb_path_or_stream)
+        assert interface_backend in {"kdtree", "pdb2sql"}
+        if interface_backend == "kdtree":
+            mhc_interface_residue_ids = get_interface_residue_ids(
+                pdb_model, chain1="M", chain2="P"
+            )
         else:
-            pdb_db = pdb2sql(pdb_string)
-
-        interface = extract_interface(pdb_db)
-        interface_residues = interface.get_contact_residues(chain1="M", chain2="P")
-        mhc_interface_residue_ids = [residue[1] for residue in interface_residues["M"]]
-
-    mhc = pdb_model["M"]
-    peptide = pdb_model["P"]
+            mhc_interface_residue_ids = get_interface_residue_ids_pdb2sql(
+                pdb_path_or_stream if pdb_string is None else pdb_string
+            )
+
+    if isinstance(pdb_model, dict):
+        mhc_coords, mhc_types = get_chain_coords_and_types(
+            pdb_model,
+            "M",
+            atom_level=atom_level,
+            device=device,
+            interface_residue_ids=mhc_interface_residue_ids,
+        )
+        peptide_coords, peptide_types = get_chain_coords_and_types(
+            pdb_model, "P", atom_level=atom_level, device=device
+        )
+    else:
+        mhc = pdb_model["M"]
+        peptide = pdb_model["P"]
 
-    mhc_coords, mhc_types = get_coords_and_types(
-        mhc, atom_level=atom_level, device=device, interface_residue_ids=mhc_interface_residue_ids
-    )
-    peptide_coords, peptide_types = get_coords_and_types(
-        peptide, atom_level=atom_level, device=device,
-    )
+        mhc_coords, mhc_types = get_coords_and_types(
+            mhc, atom_level=atom_level, device=device, interface_residue_ids=mhc_interface_residue_ids
+        )
+        peptide_coords, peptide_types = get_coords_and_types(
+            peptide, atom_level=atom_level, device=device,
+        )
 
     mhc_size = len(mhc_coords)
     mhc = {"x": mhc_coords, "types": mhc_types, "size": mhc_size}
@@ -169,6 +378,15 @@ def process_pmhc_hdf5_file(hdf5_path, device="cpu", atom_level=True, select_inte
     return peptides, mhcs, names
 
 
+def read_hdf5_pdb_string(model):
+    """
+    Read the pdb string of an hdf5 record in one go instead of line by line
+    :param model: hdf5 group with a 'complex' dataset of pdb lines
+    :return: the pdb string
+    """
+    return b"\n".join(model["complex"][()]).decode("utf-8")
+
+
 def read_pdb_strings_hdf5_file(hdf5_path):
     """
     Read the pdb string from the hdf5 file
@@ -179,15 +397,262 @@ def read_pdb_strings_hdf5_file(hdf5_path):
     pdb_strings = []
     names = []
     for name, model in content.items():
-        pdb_string = "\n".join([line.decode("utf-8") for line in model["complex"]])
+        pdb_string = read_hdf5_pdb_string(model)
         pdb_strings.append(pdb_string)
         names.append(name)
 
     return pdb_strings, names
 
 
+def iter_pdb_strings_hdf5_file(hdf5_path, names=None):
+    """
+    Lazily iterate over the pdb strings in the hdf5 file, so that files with
+    many structures do not have to be loaded at once
+    :param hdf5_path: the path of the hdf5 file
+    :param names: optional collection of structure names to select
+    :return: generator of (name, pdb string) tuples
+    """
+    with h5py.File(hdf5_path, "r") as content:
+        for name, model in content.items():
+            if names is not None and name not in names:
+                continue
+            pdb_string = read_hdf5_pdb_string(model)
+            yield name, pdb_string
+
+
+def parse_pmhc_pdb_string(pdb_string, atom_level=True, select_interface=False):
+    """
+    Parse a pMHC structure into numpy arrays that can be cached
+    :param pdb_string: content of the pdb file
+    :return: dict with peptide (lig_*) and mhc (pocket_*) coordinates and types
+    """
+    peptide, mhc = process_pmhc_pdb_file(
+        io.StringIO(pdb_string),
+        atom_level=atom_level,
+        select_interface=select_interface,
+        pdb_string=pdb_string,
+    )
+    return {
+        "lig_coords": peptide["x"].numpy().reshape(-1, 3),
+        "lig_types": np.array(peptide["types"], dtype=str),
+        "pocket_c_alpha": mhc["x"].numpy().reshape(-1, 3),
+        "pocket_types": np.array(mhc["types"], dtype=str),
+    }
+
+
+def write_parsed_structure(path, parsed):
+    """
+    Write the output of parse_pmhc_pdb_string atomically, so that concurrent
+    readers never see partial files
+    """
+    tmp_path = Path(path).with_suffix(f".{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, **parsed)
+    os.replace(tmp_path, path)
+
+
+def read_parsed_structure(path):
+    with np.load(path) as f:
+        return {key: val for key, val in f.items()}
+
+
+class HDF5PMHCDataset(Dataset):
+    """
+    Map-style dataset over the raw `complex` records of pMHC HDF5 files.
+    Structures are parsed on demand (i.e. inside the DataLoader workers) and
+    the parsed coordinates and types are cached on disk, keyed by
+    (file, record name, atom_level, select_interface). Items have the same
+    format as those of ProcessedLigandPocketDataset.
+
+    HDF5 files are only opened to list their records in __init__ and are
+    re-opened lazily in every worker process.
+    """
+
+    def __init__(
+        self,
+        hdf5_files,
+        encoder,
+        atom_level=False,
+        select_interface=False,
+        cache_dir=None,
+        names=None,
+        center=True,
+    ):
+        self.hdf5_files = [str(Path(f).resolve()) for f in hdf5_files]
+        self.encoder = encoder
+        self.atom_level = atom_level
+        self.select_interface = select_interface
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.center = center
+
+        self.records = []
+        for file_idx, hdf5_path in enumerate(self.hdf5_files):
+            with h5py.File(hdf5_path, "r") as content:
+                self.records.extend(
+                    (file_idx, name)
+                    for name in content.keys()
+                    if names is None or name in names
+                )
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._handles = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_handles"] = {}
+        state["_pid"] = None
+        return state
+
+    def get_handle(self, file_idx):
+        # h5py handles must not be shared between processes
+        if self._pid != os.getpid():
+            self._handles = {}
+            self._pid = os.getpid()
+        if file_idx not in self._handles:
+            self._handles[file_idx] = h5py.File(self.hdf5_files[file_idx], "r")
+        return self._handles[file_idx]
+
+    def get_cache_path(self, file_idx, name):
+        key = json.dumps(
+            [self.hdf5_files[file_idx], name, self.atom_level, self.select_interface]
+        )
+        return self.cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.npz"
+
+    def parse(self, idx):
+        """
+        Parsed peptide and mhc coordinates and types of record idx, read from
+        the cache if possible.
+        """
+        file_idx, name = self.records[idx]
+
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = self.get_cache_path(file_idx, name)
+            if cache_path.exists():
+                return read_parsed_structure(cache_path)
+
+        model = self.get_handle(file_idx)[name]
+        pdb_string = read_hdf5_pdb_string(model)
+        parsed = parse_pmhc_pdb_string(
+            pdb_string,
+            atom_level=self.atom_level,
+            select_interface=self.select_interface,
+        )
+
+        if cache_path is not None:
+            write_parsed_structure(cache_path, parsed)
+
+        return parsed
+
+    def __getitem__(self, idx):
+        parsed = self.parse(idx)
+        lig_coords = torch.from_numpy(parsed["lig_coords"])
+        pocket_c_alpha = torch.from_numpy(parsed["pocket_c_alpha"])
+
+        if self.center:
+            mean = (lig_coords.sum(0) + pocket_c_alpha.sum(0)) / (
+                len(lig_coords) + len(pocket_c_alpha)
+            )
+            lig_coords = lig_coords - mean
+            pocket_c_alpha = pocket_c_alpha - mean
+
+        return {
+            "names": self.records[idx][1],
+            "lig_coords": lig_coords,
+            "lig_one_hot": encode_types(parsed["lig_types"].tolist(), self.encoder),
+            "lig_mask": torch.zeros(len(lig_coords), dtype=INT_TYPE),
+            "pocket_c_alpha": pocket_c_alpha,
+            "pocket_one_hot": encode_types(
+                parsed["pocket_types"].tolist(), self.encoder
+            ),
+            "pocket_mask": torch.zeros(len(pocket_c_alpha), dtype=INT_TYPE),
+            "num_lig_atoms": len(lig_coords),
+            "num_pocket_nodes": len(pocket_c_alpha),
+        }
+
+    collate_fn = staticmethod(ProcessedLigandPocketDataset.collate_fn)
+
+
+def update_peptide_coords_pdb_string(peptide, pdb_string, atom_level=True):
+    """
+    Replace the coordinates of the peptide (chain P) records in the text of a
+    pdb file, all other lines are kept as they are. With atom_level=False only
+    the CA record of every peptide residue is kept and the peptide chain is
+    moved behind all other chains, as in the Biopython output (which in
+    addition renumbers the atoms and only writes coordinate records). Raises a
+    ValueError if the file is not supported by read_pdb_atoms or the number of
+    coordinates does not fit
+    :param peptide: (n, 3) updated atom/CA coordinates
+    :param pdb_string: content of the reference pdb file
+    :return: the new pdb string
+    """
+    atoms = read_pdb_atoms(pdb_string)
+    peptide = np.asarray(torch.as_tensor(peptide).detach().cpu(), dtype=np.float64)
+
+    in_peptide = atoms["chain"] == "P"
+    if atom_level:
+        targets = np.flatnonzero(in_peptide)
+    else:
+        is_ca = in_peptide & (atoms["name"] == "CA")
+        residue_index = get_residue_index(atoms)
+        _, first = np.unique(residue_index[is_ca], return_index=True)
+        targets = np.flatnonzero(is_ca)[first]
+        if len(targets) != len(np.unique(residue_index[in_peptide])):
+            raise ValueError("Peptide residue without CA atom")
+    if len(targets) > len(peptide):
+        raise ValueError("Not enough coordinates for the peptide")
+    new_coords = dict(zip(targets.tolist(), peptide))
+
+    lines = []
+    # with atom_level=False the peptide chain is rebuilt from its CA records
+    # and, as in the Biopython output, written after all other chains
+    peptide_lines = []
+    peptide_at = None
+    record_idx = -1
+    for line in pdb_string.splitlines():
+        if line.startswith(("ATOM", "HETATM")):
+            record_idx += 1
+            if record_idx in new_coords:
+                x, y, z = new_coords[record_idx]
+                line = f"{line[:30]:<30}{x:8.3f}{y:8.3f}{z:8.3f}{line[54:]}"
+            if not atom_level and in_peptide[record_idx]:
+                if record_idx in new_coords:
+                    peptide_lines.append(line)
+                if peptide_at is None:
+                    peptide_at = len(lines)
+                continue
+            if not atom_level:
+                peptide_at = len(lines) + 1
+        elif not atom_level and line.startswith("TER") and record_idx >= 0:
+            # a TER record belongs to the chain of the preceding record
+            if in_peptide[record_idx]:
+                peptide_lines.append(line)
+                continue
+            if peptide_at == len(lines):
+                peptide_at += 1
+        elif not atom_level and line.startswith("CONECT"):
+            # may refer to removed atoms
+            continue
+        lines.append(line)
+
+    if peptide_at is not None:
+        lines[peptide_at:peptide_at] = peptide_lines
+
+    return "\n".join(lines) + "\n"
+
+
 def write_updated_peptide_coords_pdb(
-    peptide, decoder, pdb_reference_path_or_stream, pdb_output_path, atom_level=True
+    peptide,
+    decoder,
+    pdb_reference_path_or_stream,
+    pdb_output_path,
+    atom_level=True,
+    reader="fixed_columns",
 ):
     """
     Takes an existing pdb file with peptide and mhc and creates a new one
@@ -198,9 +663,24 @@ def write_updated_peptide_coords_pdb(
     :param pdb_reference_path: path to the reference pdb file
     :param pdb_output_path: path to the output pdb file
     :param atom_level: whether to use atoms or residues
+    :param reader: 'fixed_columns' (edit the pdb text with
+        update_peptide_coords_pdb_string, falls back to Biopython if the file
+        is not supported) or 'biopython'
 
     :return: None
     """
+    assert reader in {"fixed_columns", "biopython"}
+    if reader == "fixed_columns":
+        content = read_pdb_content(pdb_reference_path_or_stream)
+        try:
+            pdb_string = update_peptide_coords_pdb_string(
+                peptide, content, atom_level=atom_level
+            )
+            Path(pdb_output_path).write_text(pdb_string)
+            return
+        except ValueError:
+            pdb_reference_path_or_stream = io.StringIO(content)
+
     # Read the reference pdb file
     parser = PDBParser(QUIET=True)
     pdb_models = parser.get_structure("", pdb_reference_path_or_stream)
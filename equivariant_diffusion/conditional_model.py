@@ -6,7 +6,10 @@ import torch.nn.functional as F
 from torch_scatter import scatter_add, scatter_mean
 
 import utils
-from equivariant_diffusion.en_diffusion import EnVariationalDiffusion
+from equivariant_diffusion.en_diffusion import (
+    EnVariationalDiffusion,
+    PredefinedNoiseSchedule,
+)
 
 
 class ConditionalDDPM(EnVariationalDiffusion):
@@ -121,6 +124,7 @@ class ConditionalDDPM(EnVariationalDiffusion):
         fix_noise=False,
         guided=False,
         gradient_scale=1.0,
+        pocket_context=None,
     ):
         """Samples x ~ p(x|z0)."""
         t_zeros = torch.zeros(size=(batch_size, 1), device=z0_lig.device)
@@ -133,7 +137,7 @@ class ConditionalDDPM(EnVariationalDiffusion):
         # # changes made here
         # net_out_lig_x = net_out_lig[:, : self.n_dims]
         net_out_lig_x = self.dynamics(
-            z0_lig, xh0_pocket, t_zeros, lig_mask, pocket_mask
+            z0_lig, xh0_pocket, t_zeros, lig_mask, pocket_mask, pocket_context
         )
 
         z0_lig_x = z0_lig[:, : self.n_dims]
@@ -148,7 +152,8 @@ class ConditionalDDPM(EnVariationalDiffusion):
             mu_lig_x = mu_lig_x - gradient_scale * de_d_lig_x * sigma_x
 
         x_lig, xh0_pocket = self.sample_normal_zero_com(
-            mu_x_lig, xh0_pocket, sigma_x, lig_mask, pocket_mask, fix_noise
+            mu_x_lig, xh0_pocket, sigma_x, lig_mask, pocket_mask, fix_noise,
+            n_samples=batch_size,
         )
 
         x_lig, h_lig = self.unnormalize(x_lig, z0_lig[:, self.n_dims :])
@@ -165,9 +170,17 @@ class ConditionalDDPM(EnVariationalDiffusion):
         raise NotImplementedError("Has been replaced by sample_normal_zero_com()")
 
     def sample_normal_zero_com(
-        self, mu_lig_x, xh0_pocket, sigma, lig_mask, pocket_mask, fix_noise=False
+        self,
+        mu_lig_x,
+        xh0_pocket,
+        sigma,
+        lig_mask,
+        pocket_mask,
+        fix_noise=False,
+        n_samples=None,
     ):
-        """Samples from a Normal distribution."""
+        """Samples from a Normal distribution. Passing the number of samples
+        avoids a device synchronization in the COM projection."""
         if fix_noise:
             # bs = 1 if fix_noise else mu.size(0)
             raise NotImplementedError("fix_noise option isn't implemented yet")
@@ -196,6 +209,7 @@ class ConditionalDDPM(EnVariationalDiffusion):
             xh0_pocket[:, : self.n_dims],
             lig_mask,
             pocket_mask,
+            n_samples=n_samples,
         )
 
         return out_lig_x, xh_pocket
@@ -458,25 +472,27 @@ class ConditionalDDPM(EnVariationalDiffusion):
         guided=False,
         gradient_scale=1.0,
         guidance_starts_at=0,
+        pocket_context=None,
+        check_mean=True,
+        coefficients=None,
     ):
-        """Samples from zs ~ p(zs | zt). Only used during sampling."""
-        gamma_s = self.gamma(s)
-        gamma_t = self.gamma(t)
-
-        (
-            sigma2_t_given_s,
-            sigma_t_given_s,
-            alpha_t_given_s,
-        ) = self.sigma_and_alpha_t_given_s(gamma_t, gamma_s, zt_lig)
-
-        sigma_s = self.sigma(gamma_s, target_tensor=zt_lig)
-        sigma_t = self.sigma(gamma_t, target_tensor=zt_lig)
+        """Samples from zs ~ p(zs | zt). Only used during sampling.
+        check_mean=False skips the COM assertion, which synchronizes with the
+        device. coefficients: optional precomputed output of
+        transition_coefficients()."""
+        if coefficients is None:
+            coefficients = self.transition_coefficients(s, t, zt_lig)
+        sigma2_t_given_s = coefficients["sigma2_t_given_s"]
+        alpha_t_given_s = coefficients["alpha_t_given_s"]
+        sigma_t = coefficients["sigma_t"]
 
         # Neural net prediction.
         # changes made
         # eps_t_lig, _ = self.dynamics(zt_lig, xh0_pocket, t, ligand_mask, pocket_mask)
         # eps_t_lig_x = eps_t_lig[:, : self.n_dims]
-        eps_t_lig_x = self.dynamics(zt_lig, xh0_pocket, t, ligand_mask, pocket_mask)
+        eps_t_lig_x = self.dynamics(
+            zt_lig, xh0_pocket, t, ligand_mask, pocket_mask, pocket_context
+        )
 
         # Compute mu for p(zs | zt).
         # Note: mu_{t->s} = 1 / alpha_{t|s} z_t - sigma_{t|s}^2 / sigma_t / alpha_{t|s} epsilon
@@ -488,7 +504,7 @@ class ConditionalDDPM(EnVariationalDiffusion):
         )
 
         # Compute sigma for p(zs | zt).
-        sigma = sigma_t_given_s * sigma_s / sigma_t
+        sigma = coefficients["posterior_std"]
 
         # If guided, move the sampling mean towards the lower energy region.
         if guided and self.T - t >= guidance_starts_at:
@@ -500,14 +516,219 @@ class ConditionalDDPM(EnVariationalDiffusion):
         # Sample zs given the parameters derived from zt.
         # changes made
         zs_lig_x, xh0_pocket = self.sample_normal_zero_com(
-            mu_lig_x, xh0_pocket, sigma, ligand_mask, pocket_mask, fix_noise
+            mu_lig_x, xh0_pocket, sigma, ligand_mask, pocket_mask, fix_noise,
+            n_samples=len(s),
         )
         zs_lig = torch.cat((zs_lig_x, zt_lig[:, self.n_dims :]), dim=1)
 
-        self.assert_mean_zero_with_mask(zt_lig[:, : self.n_dims], ligand_mask)
+        if check_mean:
+            self.assert_mean_zero_with_mask(zt_lig[:, : self.n_dims], ligand_mask)
 
         return zs_lig, xh0_pocket
 
+    def sample_p_zs_given_zt_ddim(
+        self,
+        s,
+        t,
+        zt_lig,
+        xh0_pocket,
+        ligand_mask,
+        pocket_mask,
+        eta=0.0,
+        pocket_context=None,
+        coefficients=None,
+    ):
+        """
+        Implicit (DDIM) update from zt to zs for arbitrary s < t:
+            zs = alpha_s x_pred + sqrt(sigma_s^2 - c^2) eps + c noise,
+        with c = eta * sigma_{t->s}. eta=1 uses the variance of the ancestral
+        sampler, eta=0 gives a deterministic update.
+        """
+        if coefficients is None:
+            coefficients = self.transition_coefficients(s, t, zt_lig)
+        gamma_t = coefficients["gamma_t"]
+        alpha_s = coefficients["alpha_s"]
+        sigma_s = coefficients["sigma_s"]
+
+        # Neural net prediction.
+        eps_t_lig_x = self.dynamics(
+            zt_lig, xh0_pocket, t, ligand_mask, pocket_mask, pocket_context
+        )
+        x_lig = self.xh_given_zt_and_epsilon(zt_lig, eps_t_lig_x, gamma_t, ligand_mask)
+
+        # Standard deviation of the fresh noise and weight of the predicted one.
+        sigma = eta * coefficients["posterior_std"]
+        eps_weight = torch.sqrt(torch.clamp(sigma_s**2 - sigma**2, min=0.0))
+
+        mu_lig_x = alpha_s[ligand_mask] * x_lig + eps_weight[ligand_mask] * eps_t_lig_x
+
+        zs_lig_x, xh0_pocket = self.sample_normal_zero_com(
+            mu_lig_x, xh0_pocket, sigma, ligand_mask, pocket_mask,
+            n_samples=len(s),
+        )
+        zs_lig = torch.cat((zs_lig_x, zt_lig[:, self.n_dims :]), dim=1)
+
+        return zs_lig, xh0_pocket
+
+    def sample_p_zs_given_zt_dpm_solver(
+        self,
+        s,
+        t,
+        zt_lig,
+        xh0_pocket,
+        ligand_mask,
+        pocket_mask,
+        history,
+        order=2,
+        pocket_context=None,
+        coefficients=None,
+    ):
+        """
+        Multistep DPM-Solver++ update of the probability flow ODE from zt to zs
+        (Lu et al., 2022). The solver works with the data prediction x_pred
+        and the half log-SNR lambda = log(alpha / sigma) = -gamma / 2.
+        Args:
+            history: list of (lambda, x_pred) tuples of the previous steps,
+                most recent last. It is updated in place and must be shared
+                between consecutive calls of one reverse chain.
+            order: 1, 2 or 3. Lower orders are used while the history is
+                still too short.
+            pocket_context: see EGNNDynamics.get_pocket_context
+            coefficients: see transition_coefficients
+        """
+        if coefficients is None:
+            coefficients = self.transition_coefficients(s, t, zt_lig)
+        gamma_s, gamma_t = coefficients["gamma_s"], coefficients["gamma_t"]
+        alpha_s = coefficients["alpha_s"]
+        sigma_s, sigma_t = coefficients["sigma_s"], coefficients["sigma_t"]
+
+        # Neural net prediction.
+        eps_t_lig_x = self.dynamics(
+            zt_lig, xh0_pocket, t, ligand_mask, pocket_mask, pocket_context
+        )
+        x_lig = self.xh_given_zt_and_epsilon(zt_lig, eps_t_lig_x, gamma_t, ligand_mask)
+
+        lambda_s, lambda_t = -0.5 * gamma_s, -0.5 * gamma_t
+        history.append((lambda_t, x_lig))
+        del history[:-3]
+        order = min(order, len(history))
+
+        h = lambda_s - lambda_t
+        phi_1 = torch.expm1(-h)
+
+        # First order update (equivalent to deterministic DDIM)
+        zs_lig_x = (sigma_s / sigma_t)[ligand_mask] * zt_lig[:, : self.n_dims] - (
+            alpha_s * phi_1
+        )[ligand_mask] * x_lig
+
+        if order == 2:
+            lambda_1, x_lig_1 = history[-2]
+            r0 = (lambda_t - lambda_1) / h
+            d1 = (x_lig - x_lig_1) / r0[ligand_mask]
+            zs_lig_x = zs_lig_x - 0.5 * (alpha_s * phi_1)[ligand_mask] * d1
+
+        elif order == 3:
+            (lambda_2, x_lig_2), (lambda_1, x_lig_1) = history[-3], history[-2]
+            r0 = (lambda_t - lambda_1) / h
+            r1 = (lambda_1 - lambda_2) / h
+            d1_0 = (x_lig - x_lig_1) / r0[ligand_mask]
+            d1_1 = (x_lig_1 - x_lig_2) / r1[ligand_mask]
+            d1 = d1_0 + (r0 / (r0 + r1))[ligand_mask] * (d1_0 - d1_1)
+            d2 = (d1_0 - d1_1) / (r0 + r1)[ligand_mask]
+            phi_2 = phi_1 / h + 1.0
+            phi_3 = phi_2 / h - 0.5
+            zs_lig_x = (
+                zs_lig_x
+                + (alpha_s * phi_2)[ligand_mask] * d1
+                - (alpha_s * phi_3)[ligand_mask] * d2
+            )
+
+        # Project to COM-free subspace. The update is linear, so the COM
+        # components of the stored predictions (which live in the frames of
+        # earlier steps) only move zs along the COM and are removed here too.
+        xh_pocket = xh0_pocket.detach().clone()
+        zs_lig_x, xh_pocket[:, : self.n_dims] = self.remove_mean_batch(
+            zs_lig_x, xh0_pocket[:, : self.n_dims], ligand_mask, pocket_mask,
+            n_samples=len(s),
+        )
+
+        zs_lig = torch.cat((zs_lig_x, zt_lig[:, self.n_dims :]), dim=1)
+
+        return zs_lig, xh_pocket
+
+    def transition_coefficients(self, s, t, target_tensor):
+        """
+        Noise schedule quantities of the transition t -> s as [batch_size, 1]
+        tensors, keyed like PredefinedNoiseSchedule.TRANSITION_COEFFICIENTS.
+        """
+        gamma_s = self.gamma(s)
+        gamma_t = self.gamma(t)
+
+        (
+            sigma2_t_given_s,
+            sigma_t_given_s,
+            alpha_t_given_s,
+        ) = self.sigma_and_alpha_t_given_s(gamma_t, gamma_s, target_tensor)
+
+        sigma_s = self.sigma(gamma_s, target_tensor=target_tensor)
+        sigma_t = self.sigma(gamma_t, target_tensor=target_tensor)
+
+        return {
+            "gamma_s": gamma_s,
+            "gamma_t": gamma_t,
+            "alpha_s": self.alpha(gamma_s, target_tensor=target_tensor),
+            "sigma_s": sigma_s,
+            "sigma_t": sigma_t,
+            "alpha_t_given_s": alpha_t_given_s,
+            "sigma2_t_given_s": sigma2_t_given_s,
+            "sigma_t_given_s": sigma_t_given_s,
+            "posterior_std": sigma_t_given_s * sigma_s / sigma_t,
+        }
+
+    def get_sampling_schedule(self, timesteps, spacing="uniform"):
+        """
+        Integer time steps of the training grid {0, ..., T} that are visited
+        during sampling, in increasing order. The schedule starts at 0, ends
+        at T and has exactly timesteps + 1 distinct entries: where the spacing
+        rounds several steps to the same grid step (e.g. if timesteps does
+        not divide T), they are moved to the nearest free grid steps.
+        Args:
+            timesteps: number of denoising steps, at most T
+            spacing: 'uniform' (constant stride), 'quadratic' (smaller
+                strides close to the data, as in the DDIM paper) or 'logsnr'
+                (constant stride in log-SNR, recommended for DPM-Solver)
+        """
+        if not 0 < timesteps <= self.T:
+            raise ValueError(
+                f"Cannot sample with {timesteps} steps on a grid of {self.T} steps"
+            )
+
+        frac = np.linspace(0, 1, timesteps + 1)
+        if spacing == "uniform":
+            pass
+        elif spacing == "quadratic":
+            frac = frac**2
+        elif spacing == "logsnr":
+            grid = torch.arange(self.T + 1, device=self.buffer.device) / self.T
+            gamma = self.gamma(grid.unsqueeze(1)).squeeze(1).detach().cpu().numpy()
+            # gamma is increasing in t, find the grid steps closest to
+            # equidistant gamma values
+            targets = np.linspace(gamma[0], gamma[-1], timesteps + 1)
+            steps = np.abs(gamma[None, :] - targets[:, None]).argmin(1)
+        else:
+            raise ValueError(f"Unknown time step spacing '{spacing}'")
+
+        if spacing != "logsnr":
+            steps = np.round(frac * self.T).astype(int)
+
+        # Step i needs i free grid steps below and timesteps - i above it.
+        # Clipping to these bounds and then pushing every step above its
+        # predecessor gives a strictly increasing schedule from 0 to T.
+        idx = np.arange(timesteps + 1)
+        steps = np.clip(steps, idx, self.T - timesteps + idx)
+        steps = np.maximum.accumulate(steps - idx) + idx
+        return steps.tolist()
+
     def sample_combined_position_feature_noise(
         self, lig_indices, xh0_pocket, pocket_indices
     ):
@@ -533,14 +754,43 @@ class ConditionalDDPM(EnVariationalDiffusion):
         guided=False,
         gradient_scale=1.0,
         guidance_starts_at=0,
+        sampler="ddpm",
+        eta=0.0,
+        spacing="uniform",
+        fast_sampling=False,
+        check_every=None,
+        reverse_step=None,
     ):
         """
         Draw samples from the generative model. Optionally, return intermediate
         states for visualization purposes.
+
+        The reverse chain visits `timesteps` steps of the training grid chosen
+        by `spacing` (see get_sampling_schedule). With sampler='ddpm' every
+        step is an ancestral step p(zs | zt), with sampler='ddim' an implicit
+        step whose stochasticity is controlled by `eta`. 'dpm2' and 'dpm3'
+        integrate the probability flow ODE with the second and third order
+        multistep DPM-Solver++, respectively.
+
+        With fast_sampling=True the reverse chain does not synchronize with
+        the device: NaN outputs of the network are zeroed without a warning
+        and the COM assertions only run every `check_every` steps (if given)
+        and on the final sample.
+
+        reverse_step optionally replaces the ancestral step, e.g. with a
+        compiled version (see equivariant_diffusion.inference). It is called as
+        reverse_step(s, t, z_lig, xh_pocket, lig_mask, pocket_mask,
+        pocket_context).
         """
         timesteps = self.T if timesteps is None else timesteps
+        schedule = self.get_sampling_schedule(timesteps, spacing)
         assert 0 < return_frames <= timesteps
         assert timesteps % return_frames == 0
+        assert sampler in {"ddpm", "ddim", "dpm2", "dpm3"}, \
+            f"Unknown sampler '{sampler}'"
+        assert not guided or sampler == "ddpm", \
+            "Guidance is only implemented for the ancestral sampler"
+        assert reverse_step is None or (sampler == "ddpm" and not guided)
 
         n_samples = len(pocket["size"])
         device = pocket["x"].device
@@ -573,23 +823,72 @@ class ConditionalDDPM(EnVariationalDiffusion):
         out_lig = torch.zeros((return_frames,) + z_lig.size(), device=z_lig.device)
         out_pocket = torch.zeros((return_frames,) + xh_pocket.size(), device=device)
 
-        # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
+        # The pocket is only translated during sampling, so its embeddings,
+        # edges and edge geometry are computed once for the whole chain
+        pocket_context = self.dynamics.get_pocket_context(
+            xh_pocket, pocket["mask"], lig_mask, check_nan=not fast_sampling
+        )
+
+        solver_history = []
+
+        # Coefficients of all transitions are looked up with a single gather
+        # per step if the noise schedule is fixed
+        table = None
+        if isinstance(self.gamma, PredefinedNoiseSchedule):
+            table = self.gamma.transition_table(schedule)
+
+        # Iteratively sample p(z_s | z_t) for t = schedule[s + 1] and
+        # s = schedule[s], going from t = T to s = 0.
         for s in reversed(range(0, timesteps)):
-            s_array = torch.full((n_samples, 1), fill_value=s, device=z_lig.device)
-            t_array = s_array + 1
-            s_array = s_array / timesteps
-            t_array = t_array / timesteps
-
-            z_lig, xh_pocket = self.sample_p_zs_given_zt(
-                s_array,
-                t_array,
-                z_lig,
-                xh_pocket,
-                lig_mask, pocket["mask"],
-                guided=guided,
-                gradient_scale=gradient_scale,
-                guidance_starts_at=guidance_starts_at,
+            s_array = torch.full(
+                (n_samples, 1), fill_value=schedule[s] / self.T, device=device
+            )
+            t_array = torch.full(
+                (n_samples, 1), fill_value=schedule[s + 1] / self.T, device=device
             )
+            coefficients = None
+            if table is not None:
+                coefficients = dict(
+                    zip(
+                        PredefinedNoiseSchedule.TRANSITION_COEFFICIENTS,
+                        table[s].expand(n_samples, -1).unsqueeze(2).unbind(1),
+                    )
+                )
+
+            if sampler == "ddim":
+                z_lig, xh_pocket = self.sample_p_zs_given_zt_ddim(
+                    s_array, t_array, z_lig, xh_pocket, lig_mask, pocket["mask"],
+                    eta=eta, pocket_context=pocket_context,
+                    coefficients=coefficients,
+                )
+            elif sampler in {"dpm2", "dpm3"}:
+                z_lig, xh_pocket = self.sample_p_zs_given_zt_dpm_solver(
+                    s_array, t_array, z_lig, xh_pocket, lig_mask, pocket["mask"],
+                    solver_history, order=min(int(sampler[-1]), s + 1),
+                    pocket_context=pocket_context, coefficients=coefficients,
+                )
+            elif reverse_step is not None:
+                z_lig, xh_pocket = reverse_step(
+                    s_array, t_array, z_lig, xh_pocket, lig_mask, pocket["mask"],
+                    pocket_context,
+                )
+            else:
+                z_lig, xh_pocket = self.sample_p_zs_given_zt(
+                    s_array,
+                    t_array,
+                    z_lig,
+                    xh_pocket,
+                    lig_mask, pocket["mask"],
+                    guided=guided,
+                    gradient_scale=gradient_scale,
+                    guidance_starts_at=guidance_starts_at,
+                    pocket_context=pocket_context,
+                    check_mean=not fast_sampling,
+                    coefficients=coefficients,
+                )
+
+            if fast_sampling and check_every is not None and s % check_every == 0:
+                self.assert_mean_zero_with_mask(z_lig[:, : self.n_dims], lig_mask)
 
             # save frame
             if (s * return_frames) % timesteps == 0:
@@ -599,7 +898,8 @@ class ConditionalDDPM(EnVariationalDiffusion):
         # Finally sample p(x, h | z_0).
         # changes made
         x_lig, _, x_pocket, h_pocket = self.sample_p_xh_given_z0(
-            z_lig, xh_pocket, lig_mask, pocket["mask"], n_samples
+            z_lig, xh_pocket, lig_mask, pocket["mask"], n_samples,
+            pocket_context=pocket_context,
         )
         h_lig = lig["one_hot"]
 
@@ -625,10 +925,12 @@ class ConditionalDDPM(EnVariationalDiffusion):
         return out_lig.squeeze(0), out_pocket.squeeze(0), lig_mask, pocket["mask"]
 
     @classmethod
-    def remove_mean_batch(cls, x_lig, x_pocket, lig_indices, pocket_indices):
+    def remove_mean_batch(
+        cls, x_lig, x_pocket, lig_indices, pocket_indices, n_samples=None
+    ):
 
         # Just subtract the center of mass of the sampled part
-        mean = scatter_mean(x_lig, lig_indices, dim=0)
+        mean = scatter_mean(x_lig, lig_indices, dim=0, dim_size=n_samples)
 
         x_lig = x_lig - mean[lig_indices]
         x_pocket = x_pocket - mean[pocket_indices]
@@ -655,7 +957,9 @@ class SimpleConditionalDDPM(ConditionalDDPM):
         return input_size * self.n_dims
 
     @classmethod
-    def remove_mean_batch(cls, x_lig, x_pocket, lig_indices, pocket_indices):
+    def remove_mean_batch(
+        cls, x_lig, x_pocket, lig_indices, pocket_indices, n_samples=None
+    ):
         """Hacky way of removing the centering steps without changing too much
         code."""
         return x_lig, x_pocket
@@ -675,7 +979,7 @@ class SimpleConditionalDDPM(ConditionalDDPM):
 
     @torch.no_grad()
     def sample_given_pocket(
-        self, pocket, num_nodes_lig, return_frames=1, timesteps=None
+        self, pocket, num_nodes_lig, return_frames=1, timesteps=None, **kwargs
     ):
 
         # Subtract pocket center of mass
@@ -683,5 +987,5 @@ class SimpleConditionalDDPM(ConditionalDDPM):
         pocket["x"] = pocket["x"] - pocket_com[pocket["mask"]]
 
         return super(SimpleConditionalDDPM, self).sample_given_pocket(
-            pocket, num_nodes_lig, return_frames, timesteps
+            pocket, num_nodes_lig, return_frames, timesteps, **kwargs
         )
@@ -1,4 +1,6 @@
 import math
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
@@ -7,9 +9,181 @@ from equivariant_diffusion.en_diffusion import EnVariationalDiffusion
 
 remove_mean_batch = EnVariationalDiffusion.remove_mean_batch
 import numpy as np
+from scipy.spatial import cKDTree
 from torch_geometric.nn.encoding import PositionalEncoding
 
 
+class EdgeCache:
+    """
+    Least-recently-used cache for graph quantities that only depend on the
+    number of nodes per sample, e.g. the edges of complete graphs. Entries are
+    keyed by tuples of per-sample sizes.
+
+    The cache is only active inside `enabled()`, i.e. during one sampling
+    chain of the joint model (EnVariationalDiffusion.sample/inpaint), which
+    calls forward() without a pocket context at every step while the batch
+    layout is fixed. Elsewhere (training) sizes rarely repeat, so entries are
+    neither looked up nor stored and the keys, which require a host
+    synchronization, are not computed. The conditional model does not need
+    it: its graph is built once per chain by get_pocket_context.
+    """
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._depth = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def active(self):
+        return self._depth > 0 and self.max_size > 0
+
+    @contextmanager
+    def enabled(self):
+        """Activate the cache; entries are dropped when the scope is left."""
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self._entries.clear()
+
+    def get(self, key_fn, build_fn):
+        if not self.active:
+            return build_fn()
+
+        key = key_fn()
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        value = build_fn()
+        self._entries[key] = value
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        return {
+            "edge_cache_hits": self.hits,
+            "edge_cache_misses": self.misses,
+            "edge_cache_size": len(self._entries),
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def batch_sizes_key(batch_mask):
+    """Hashable per-sample node counts, which determine a sorted batch mask."""
+    return tuple(torch.bincount(batch_mask).tolist())
+
+
+def node_positions(batch_mask):
+    """
+    Index of every node within its sample, e.g. [0, 1, 2, 0, 1] for the sorted
+    mask [0, 0, 0, 1, 1]. Computed on device without host synchronization.
+    """
+    first = torch.searchsorted(batch_mask, batch_mask)
+    return torch.arange(len(batch_mask), device=batch_mask.device) - first
+
+
+def complete_graph(batch_mask_a, batch_mask_b=None):
+    """
+    Edges (a_i, b_j) between all nodes of the same sample, built block by
+    block without materializing the dense adjacency matrix of the batch.
+    Both masks must be sorted, i.e. the nodes of a sample are contiguous.
+    The edges are returned in row-major order, equivalent to
+    torch.where(batch_mask_a[:, None] == batch_mask_b[None, :]).
+    """
+    if batch_mask_b is None:
+        batch_mask_b = batch_mask_a
+    n_samples = int(max(batch_mask_a.max(), batch_mask_b.max())) + 1
+    sizes_b = torch.bincount(batch_mask_b, minlength=n_samples)
+    starts_b = torch.cumsum(sizes_b, dim=0) - sizes_b
+
+    # number of partners of every node in a
+    counts = sizes_b[batch_mask_a]
+    row = torch.repeat_interleave(
+        torch.arange(len(batch_mask_a), device=batch_mask_a.device), counts
+    )
+    # position of each edge within the neighbour list of its row
+    row_starts = torch.cumsum(counts, dim=0) - counts
+    pos = torch.arange(len(row), device=row.device) - row_starts[row]
+    col = starts_b[batch_mask_a][row] + pos
+    return torch.stack((row, col), dim=0)
+
+
+def radius_graph(x, batch_mask, cutoff, max_neighbors=None):
+    """
+    Edges (i, j) between nodes of the same sample with |x_i - x_j| <= cutoff,
+    including self-loops. The whole batch is handled at once: on CPU with a
+    single KD-tree in which samples are separated along an extra coordinate,
+    on GPU with one masked distance matrix (as for complete graphs). There is
+    no per-sample loop and, on GPU, no host synchronization besides the one
+    for the number of edges.
+    The graph depends on the pocket coordinates. It is built once per reverse
+    chain in EGNNDynamics.get_pocket_context, since the pocket is only
+    translated during sampling, and for every batch during training.
+    Args:
+        x: [N, 3] coordinates
+        batch_mask: [N] sample indices
+        cutoff: radius
+        max_neighbors: optionally keep only the max_neighbors nearest
+            neighbours (besides the node itself) of every node
+    Returns:
+        [2, E] edge index in row-major order
+    """
+    if len(x) == 0:
+        return torch.zeros((2, 0), dtype=torch.long, device=x.device)
+
+    if x.device.type == "cpu":
+        # nodes of different samples are more than the cutoff apart along the
+        # extra coordinate, distances within a sample are unchanged
+        x_np = np.concatenate(
+            (
+                x.detach().numpy().astype(np.float64),
+                batch_mask.numpy()[:, None] * (2.0 * cutoff + 1.0),
+            ),
+            axis=1,
+        )
+        n = len(x_np)
+        tree = cKDTree(x_np)
+        if max_neighbors is None:
+            pairs = tree.query_pairs(cutoff, output_type="ndarray")
+            row = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+            col = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+        else:
+            # the node itself is always its nearest neighbour
+            k = min(max_neighbors + 1, n)
+            # distance_upper_bound is exclusive, unlike query_pairs and the
+            # GPU path
+            dist, col = tree.query(
+                x_np, k=k, distance_upper_bound=np.nextafter(cutoff, np.inf)
+            )
+            dist, col = dist.reshape(n, k), col.reshape(n, k)
+            row = np.repeat(np.arange(n), k)
+            keep = np.isfinite(dist).reshape(-1)
+            row, col = row[keep], col.reshape(-1)[keep]
+        # row-major order
+        edges = np.stack(np.divmod(np.sort(row * n + col), n))
+        return torch.from_numpy(edges).long()
+
+    dist = torch.cdist(x, x)
+    adj = (dist <= cutoff) & (batch_mask[:, None] == batch_mask[None, :])
+    if max_neighbors is not None and max_neighbors + 1 < len(x):
+        dist = dist.masked_fill(~adj, float("inf"))
+        knn = dist.topk(max_neighbors + 1, dim=1, largest=False).indices
+        adj = adj & torch.zeros_like(adj).scatter_(1, knn, True)
+    return torch.stack(torch.where(adj), dim=0)
+
+
 class EGNNDynamics(nn.Module):
     def __init__(
         self,
@@ -34,11 +208,15 @@ class EGNNDynamics(nn.Module):
         aggregation_method="sum",
         update_pocket_coords=True,
         edge_cutoff=None,
+        edge_max_neighbors=None,
+        edge_cache_size=4,
         use_nodes_noise_prediction=True,
     ):
         super().__init__()
         self.mode = mode
         self.edge_cutoff = edge_cutoff
+        self.edge_max_neighbors = edge_max_neighbors
+        self.edge_cache = EdgeCache(edge_cache_size)
         self.use_nodes_noise_prediction = use_nodes_noise_prediction
 
         self.atom_encoder = nn.Sequential(
@@ -114,28 +292,79 @@ class EGNNDynamics(nn.Module):
             self.sin_encoding = PositionalEncoding(
                 joint_nf, base_freq=sin_encoding_freq, granularity=1 / math.pi
             )
+        else:
+            self.sin_encoding = None
 
         self.device = device
         self.n_dims = n_dims
         self.condition_time = condition_time
 
-    def forward(self, xh_atoms, xh_residues, t, mask_atoms, mask_residues):
+    def get_pocket_context(
+        self, xh_residues, mask_residues, mask_atoms=None, check_nan=True
+    ):
+        """
+        Computes everything that only depends on the pocket once, so that it
+        can be reused for all denoising steps of a reverse chain:
+        - residue embeddings
+        - pocket-pocket edges (indices relative to the pocket nodes)
+        - geometry of the pocket-pocket edges, if pocket coordinates are not
+          updated by the network. Pocket translations between steps do not
+          change it.
+        - the ligand layout (see get_ligand_layout), if mask_atoms is given
+        With check_nan=False, forward() zeroes NaN outputs on the device
+        instead of checking for them on the host and printing a warning.
+        """
+        x_residues = xh_residues[:, : self.n_dims]
+        h_residues = self.residue_encoder(xh_residues[:, self.n_dims :])
+
+        if self.edge_cutoff is None:
+            edges = self.get_edges(mask_residues, x_residues)
+        else:
+            edges = radius_graph(
+                x_residues, mask_residues, self.edge_cutoff, self.edge_max_neighbors
+            )
+
+        geometry = None
+        if self.mode == "egnn_dynamics" and not self.update_pocket_coords:
+            geometry = self.egnn.edge_geometry(x_residues, edges)
+
+        ligand_layout = None
+        if mask_atoms is not None:
+            ligand_layout = self.get_ligand_layout(mask_atoms, mask_residues)
+
+        return {
+            "h": h_residues,
+            "edges": edges,
+            "geometry": geometry,
+            "ligand_layout": ligand_layout,
+            "check_nan": check_nan,
+        }
+
+    def forward(
+        self, xh_atoms, xh_residues, t, mask_atoms, mask_residues, pocket_context=None
+    ):
+        """
+        pocket_context: optional output of get_pocket_context() for the same
+            pocket. It is computed on the fly if not provided.
+        """
+        if pocket_context is None:
+            pocket_context = self.get_pocket_context(xh_residues, mask_residues)
+        assert len(pocket_context["h"]) == len(mask_residues)
 
         x_atoms = xh_atoms[:, : self.n_dims].clone()
         h_atoms = xh_atoms[:, self.n_dims :].clone()
 
         x_residues = xh_residues[:, : self.n_dims].clone()
-        h_residues = xh_residues[:, self.n_dims :].clone()
 
         # embed atom features and residue features in a shared space
         h_atoms = self.atom_encoder(h_atoms)
-        h_residues = self.residue_encoder(h_residues)
+        h_residues = pocket_context["h"]
 
+        ligand_layout = pocket_context["ligand_layout"]
+        if ligand_layout is None:
+            ligand_layout = self.get_ligand_layout(mask_atoms, mask_residues)
         if self.sin_encoding is not None:
-            _, sizes = torch.unique(mask_atoms, return_counts=True)
-            h_atoms = h_atoms + self.sin_encoding(
-                torch.concatenate([torch.arange(s) for s in sizes]).to(self.device)
-            )
+            h_atoms = h_atoms + ligand_layout["node_encoding"]
 
         # combine the two node types
         x = torch.cat((x_atoms, x_residues), dim=0)
@@ -145,36 +374,34 @@ class EGNNDynamics(nn.Module):
         if self.condition_time:
             if np.prod(t.size()) == 1:
                 # t is the same for all elements in batch.
-                h_time = torch.empty_like(h[:, 0:1]).fill_(t.item())
+                h_time = t.reshape(1, 1).expand(len(h), 1).to(h.dtype)
             else:
                 # t is different over the batch dimension.
                 h_time = t[mask]
             h = torch.cat([h, h_time], dim=1)
 
-        # get edges of a complete graph
-        if self.edge_cutoff is None:
-            edges=self.get_edges(mask, x)
-        else:
-            edges = self.get_edges_mhc_cutoff(
-                mask_atoms, mask_residues, x_atoms, x_residues
-            )
+        # Edges are ordered as [atom-atom, atom-residue, residue-atom,
+        # residue-residue]. Atoms and residues are fully connected, residues
+        # among each other only within the cutoff radius.
+        edges = torch.cat(
+            (ligand_layout["edges"], pocket_context["edges"] + len(mask_atoms)),
+            dim=1,
+        )
 
+        edge_attr = None
         if self.sin_encoding is not None:
-            edge_attr = torch.zeros(edges.shape[1], h_atoms.shape[1]).to(self.device)
-            # get the subset of edges between atoms and atoms for each batch
-            edges_atoms = self.get_edges(mask_atoms, x_atoms)
-            edge_diff = edges_atoms[0] - edges_atoms[1]
-            atom_edge_attr = self.sin_encoding(edge_diff)
-
-            _, sizes = torch.unique(edges_atoms[0], return_counts=True)
-            atom_nodes = edges_atoms[0].unique()
-            atom_starts = torch.searchsorted(edges[0], atom_nodes)
-            atom_index = torch.repeat_interleave(atom_starts, sizes)
-
-            atom_index = atom_index + torch.concatenate(
-                [torch.arange(s).to(self.device) for s in sizes]
+            # only the leading atom-atom edges carry an encoding, edges
+            # involving residues are padded with zeros
+            edge_attr = ligand_layout["edge_attr"]
+            edge_attr = torch.cat(
+                (
+                    edge_attr,
+                    edge_attr.new_zeros(
+                        edges.size(1) - edge_attr.size(0), edge_attr.size(1)
+                    ),
+                ),
+                dim=0,
             )
-            edge_attr[atom_index] = atom_edge_attr
 
         if self.mode == "egnn_dynamics":
             update_coords_mask = (
@@ -185,7 +412,12 @@ class EGNNDynamics(nn.Module):
                 ).unsqueeze(1)
             )
             h_final, x_final = self.egnn(
-                h, x, edges, update_coords_mask=update_coords_mask, edge_attr=edge_attr
+                h,
+                x,
+                edges,
+                update_coords_mask=update_coords_mask,
+                edge_attr=edge_attr,
+                static_geometry=pocket_context["geometry"],
             )
             vel = x_final - x
 
@@ -206,9 +438,12 @@ class EGNNDynamics(nn.Module):
         h_final_atoms = self.atom_decoder(h_final[: len(mask_atoms)])
         h_final_residues = self.residue_decoder(h_final[len(mask_atoms) :])
 
-        if torch.any(torch.isnan(vel)):
-            print("Warning: detected nan, resetting EGNN output to zero.")
-            vel = torch.zeros_like(vel)
+        if pocket_context["check_nan"]:
+            if torch.any(torch.isnan(vel)):
+                print("Warning: detected nan, resetting EGNN output to zero.")
+                vel = torch.zeros_like(vel)
+        else:
+            vel = torch.where(torch.isnan(vel).any(), torch.zeros_like(vel), vel)
 
         if self.update_pocket_coords:
             # in case of unconditional joint distribution, include this as in
@@ -224,26 +459,39 @@ class EGNNDynamics(nn.Module):
         return noise_prediction
 
     def get_edges(self, batch_mask, x):
-        # TODO: cache batches for each example in self._edges_dict[n_nodes]
-        adj = batch_mask[:, None] == batch_mask[None, :]
-        # if self.edge_cutoff is not None:
-        #     adj = adj & (torch.cdist(x, x) <= self.edge_cutoff)
-        edges = torch.stack(torch.where(adj), dim=0)
-        return edges
-
-    def get_edges_mhc_cutoff(
-        self, batch_mask_peptide, batch_mask_mhc, x_peptide, x_mhc
-    ):
+        return self.edge_cache.get(
+            lambda: ("complete", batch_sizes_key(batch_mask), str(batch_mask.device)),
+            lambda: complete_graph(batch_mask),
+        )
+
+    def get_ligand_layout(self, mask_atoms, mask_residues):
         """
-        Does the same as self.get_edges(), where a fully connected graph is created
-        using batch_mask = [batch_mask_peptide, batch_mask_mhc] and x = [x_peptide, x_mhc],
-        but instead cuts-off the edges within MHC only when they do not fall
-        within the cutoff radius.
+        Atom-atom, atom-residue and residue-atom edges (residues indexed after
+        the atoms) and, if enabled, the sinusoidal encodings of the atom
+        positions within their ligand and of the atom-atom edges (forward()
+        pads the encodings of edges involving residues with zeros). All only
+        depend on the number of nodes per sample
+        and are cached while sampling.
         """
-        mask = torch.cat([batch_mask_peptide, batch_mask_mhc])
-        x = torch.cat([x_peptide, x_mhc], dim=0)
-        adj = mask[:, None] == mask[None, :]
-        adj_mhc = torch.cdist(x_mhc, x_mhc) <= self.edge_cutoff
-        adj[len(batch_mask_peptide) :, len(batch_mask_peptide) :] &= adj_mhc
-        edges = torch.stack(torch.where(adj), dim=0)
-        return edges
+        def key():
+            return (
+                "ligand",
+                batch_sizes_key(mask_atoms),
+                batch_sizes_key(mask_residues),
+                str(mask_atoms.device),
+            )
+
+        def build():
+            edges_atoms = complete_graph(mask_atoms)
+            edges_cross = complete_graph(mask_atoms, mask_residues)
+            edges_cross[1] += len(mask_atoms)
+            edges = torch.cat(
+                (edges_atoms, edges_cross, edges_cross.flip(0)), dim=1
+            )
+            layout = {"edges": edges}
+            if self.sin_encoding is not None:
+                layout["node_encoding"] = self.sin_encoding(node_positions(mask_atoms))
+                layout["edge_attr"] = self.sin_encoding(edges_atoms[0] - edges_atoms[1])
+            return layout
+
+        return self.edge_cache.get(key, build)
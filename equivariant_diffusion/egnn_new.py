@@ -232,6 +232,26 @@ class EquivariantBlock(nn.Module):
         )
         self.to(self.device)
 
+    def edge_geometry(self, x, edge_index, static_geometry=None):
+        """
+        Returns the (embedded) squared distances and normalized coordinate
+        differences of all edges. If static_geometry is given, it holds these
+        values for the last edges of edge_index, whose endpoints do not move,
+        and only the remaining edges are computed.
+        """
+        if static_geometry is not None:
+            n_static = static_geometry[0].size(0)
+            edge_index = edge_index[:, : edge_index.size(1) - n_static]
+
+        distances, coord_diff = coord2diff(x, edge_index, self.norm_constant)
+        if self.sin_embedding is not None:
+            distances = self.sin_embedding(distances)
+
+        if static_geometry is not None:
+            distances = torch.cat([distances, static_geometry[0]], dim=0)
+            coord_diff = torch.cat([coord_diff, static_geometry[1]], dim=0)
+        return distances, coord_diff
+
     def forward(
         self,
         h,
@@ -241,11 +261,10 @@ class EquivariantBlock(nn.Module):
         edge_mask=None,
         edge_attr=None,
         update_coords_mask=None,
+        static_geometry=None,
     ):
         # Edit Emiel: Remove velocity as input
-        distances, coord_diff = coord2diff(x, edge_index, self.norm_constant)
-        if self.sin_embedding is not None:
-            distances = self.sin_embedding(distances)
+        distances, coord_diff = self.edge_geometry(x, edge_index, static_geometry)
         edge_attr = torch.cat([distances, edge_attr], dim=1)
         for i in range(0, self.n_layers):
             h, _ = self._modules["gcl_%d" % i](
@@ -339,6 +358,14 @@ class EGNN(nn.Module):
             )
         self.to(self.device)
 
+    def edge_geometry(self, x, edge_index):
+        """
+        Edge geometry as seen by the equivariant blocks. Can be computed once
+        and passed to forward() as static_geometry for edges whose endpoints
+        are not updated by the network.
+        """
+        return self._modules["e_block_0"].edge_geometry(x, edge_index)
+
     def forward(
         self,
         h,
@@ -348,14 +375,18 @@ class EGNN(nn.Module):
         edge_mask=None,
         update_coords_mask=None,
         edge_attr=None,
+        static_geometry=None,
     ):
+        """
+        static_geometry: optional (distances, coord_diff) tuple for the last
+            edges of edge_index as returned by edge_geometry(). Only valid if
+            the coordinates of their endpoints are fixed by update_coords_mask.
+        """
         # Edit Emiel: Remove velocity as input
         if edge_attr is None:
-            distances, _ = coord2diff(x, edge_index)
-            if self.sin_embedding is not None:
-                edge_attr = self.sin_embedding(distances)
-            else:
-                edge_attr = distances
+            edge_attr, _ = self._modules["e_block_0"].edge_geometry(
+                x, edge_index, static_geometry
+            )
 
         h = self.embedding(h)
         for i in range(0, self.n_layers):
@@ -367,6 +398,7 @@ class EGNN(nn.Module):
                 edge_mask=edge_mask,
                 edge_attr=edge_attr,
                 update_coords_mask=update_coords_mask,
+                static_geometry=static_geometry,
             )
 
         # Important, the bias of the last linear might be non-zero
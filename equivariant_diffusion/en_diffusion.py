@@ -1,4 +1,5 @@
 import math
+import functools
 from typing import Dict
 
 import numpy as np
@@ -10,6 +11,22 @@ from torch_scatter import scatter_add, scatter_mean
 import utils
 
 
+def with_edge_cache(fn):
+    """
+    Enables the edge cache of the dynamics (see dynamics.EdgeCache) for one
+    sampling call. The batch layout is fixed within a reverse chain, so graph
+    quantities are built once; the cache is emptied afterwards.
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        cache = getattr(self.dynamics, "edge_cache", None)
+        if cache is None:
+            return fn(self, *args, **kwargs)
+        with cache.enabled():
+            return fn(self, *args, **kwargs)
+    return wrapper
+
+
 class EnVariationalDiffusion(nn.Module):
     """
     The E(n) Diffusion Module.
@@ -575,6 +592,7 @@ class EnVariationalDiffusion(nn.Module):
         return z_lig, z_pocket
 
     @torch.no_grad()
+    @with_edge_cache
     def sample(self, n_samples, num_nodes_lig, num_nodes_pocket,
                return_frames=1, timesteps=None, device='cpu'):
         """
@@ -671,6 +689,7 @@ class EnVariationalDiffusion(nn.Module):
         return list(reversed(repaint_schedule))
 
     @torch.no_grad()
+    @with_edge_cache
     def inpaint(self, ligand, pocket, lig_fixed, pocket_fixed, resamplings=1,
                 jump_length=1, return_frames=1, timesteps=None):
         """
@@ -1155,9 +1174,18 @@ class PredefinedNoiseSchedule(torch.nn.Module):
     Predefined noise schedule. Essentially creates a lookup array for predefined
     (non-learned) noise schedules.
     """
-    def __init__(self, noise_schedule, timesteps, precision):
+    # columns of the tables returned by transition_table()
+    TRANSITION_COEFFICIENTS = (
+        'gamma_s', 'gamma_t', 'alpha_s', 'sigma_s', 'sigma_t',
+        'alpha_t_given_s', 'sigma2_t_given_s', 'sigma_t_given_s',
+        'posterior_std',
+    )
+
+    def __init__(self, noise_schedule, timesteps, precision, max_tables=16):
         super(PredefinedNoiseSchedule, self).__init__()
         self.timesteps = timesteps
+        self.max_tables = max_tables
+        self._tables = {}
 
         if noise_schedule == 'cosine':
             alphas2 = cosine_beta_schedule(timesteps)
@@ -1187,3 +1215,52 @@ class PredefinedNoiseSchedule(torch.nn.Module):
     def forward(self, t):
         t_int = torch.round(t * self.timesteps).long()
         return self.gamma[t_int]
+
+    def _apply(self, fn, *args, **kwargs):
+        # tables live on the device and dtype of gamma
+        self._tables.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # tables are derived from gamma, which is replaced here
+        self._tables.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    @torch.no_grad()
+    def transition_table(self, steps):
+        """
+        Coefficients of all transitions t = steps[i + 1] -> s = steps[i] of a
+        sampling schedule, computed from gamma once per schedule. The tables
+        are dropped when gamma is loaded or moved to another device/dtype.
+        Args:
+            steps: increasing integer steps of the grid {0, ..., T}
+        Returns:
+            [len(steps) - 1, len(TRANSITION_COEFFICIENTS)] tensor, row i holds
+            the coefficients of the transition into steps[i]
+        """
+        key = tuple(steps)
+        if key in self._tables:
+            return self._tables[key]
+
+        steps = torch.tensor(steps, device=self.gamma.device)
+        gamma_s, gamma_t = self.gamma[steps[:-1]], self.gamma[steps[1:]]
+        alpha_s = torch.sqrt(torch.sigmoid(-gamma_s))
+        sigma_s = torch.sqrt(torch.sigmoid(gamma_s))
+        sigma_t = torch.sqrt(torch.sigmoid(gamma_t))
+
+        # same expressions as EnVariationalDiffusion.sigma_and_alpha_t_given_s
+        sigma2_t_given_s = -torch.expm1(F.softplus(gamma_s) - F.softplus(gamma_t))
+        alpha_t_given_s = torch.exp(
+            0.5 * (F.logsigmoid(-gamma_t) - F.logsigmoid(-gamma_s)))
+        sigma_t_given_s = torch.sqrt(sigma2_t_given_s)
+
+        table = torch.stack([
+            gamma_s, gamma_t, alpha_s, sigma_s, sigma_t, alpha_t_given_s,
+            sigma2_t_given_s, sigma_t_given_s,
+            sigma_t_given_s * sigma_s / sigma_t,
+        ], dim=1)
+
+        if len(self._tables) >= self.max_tables:
+            self._tables.pop(next(iter(self._tables)))
+        self._tables[key] = table
+        return table
@@ -0,0 +1,208 @@
+from collections import OrderedDict
+
+import torch
+
+
+def _round_up(n, multiple):
+    """Smallest multiple of `multiple` that is strictly larger than n, so that
+    there is always room for at least one padding element."""
+    return (n // multiple + 1) * multiple
+
+
+def _pad(x, size, value=0):
+    """Pads the first dimension of x to `size` with `value`."""
+    padding = x.new_full((size - x.size(0),) + tuple(x.shape[1:]), value)
+    return torch.cat((x, padding), dim=0)
+
+
+class CompiledReverseStep:
+    """
+    torch.compile-d version of one ancestral reverse step of a ConditionalDDPM
+    (dynamics + ConditionalDDPM.sample_p_zs_given_zt) with a fixed signature
+    of tensor arguments.
+
+    Inputs are padded to shape buckets so that the number of compiled graphs
+    stays small: node and edge counts are rounded up to multiples of
+    `node_bucket` and `edge_bucket`. Padding nodes belong to an extra dummy
+    sample and padding edges are self-loops on dummy nodes, so the real
+    samples are not affected. One compiled artefact is kept per bucket in an
+    LRU cache. Dynamo's recompilation limit is raised to `max_buckets` only
+    while the compiled step runs, other compiled code is not affected.
+
+    The wrapper only holds a reference to the model and is not an nn.Module,
+    hence checkpoints and state_dict names are unchanged.
+
+    Usage:
+        step = CompiledReverseStep(ddpm)
+        ddpm.sample_given_pocket(pocket, lig_one_hot, lig_mask,
+                                 fast_sampling=True, reverse_step=step)
+    """
+
+    def __init__(
+        self,
+        ddpm,
+        backend="inductor",
+        node_bucket=64,
+        edge_bucket=1024,
+        sample_bucket=8,
+        max_buckets=8,
+    ):
+        assert ddpm.dynamics.mode == "egnn_dynamics"
+        assert not ddpm.dynamics.update_pocket_coords
+        self.ddpm = ddpm
+        self.backend = backend
+        self.node_bucket = node_bucket
+        self.edge_bucket = edge_bucket
+        self.sample_bucket = sample_bucket
+        self.max_buckets = max_buckets
+        self.compiled = OrderedDict()
+
+    def _step(
+        self,
+        s,
+        t,
+        zt_lig,
+        xh_pocket,
+        lig_mask,
+        pocket_mask,
+        h_residues,
+        pocket_edges,
+        pocket_distances,
+        pocket_coord_diff,
+        ligand_edges,
+        ligand_edge_attr,
+        node_encoding,
+    ):
+        sin_encoding = self.ddpm.dynamics.sin_encoding is not None
+        ligand_layout = {"edges": ligand_edges}
+        if sin_encoding:
+            ligand_layout["edge_attr"] = ligand_edge_attr
+            ligand_layout["node_encoding"] = node_encoding
+        pocket_context = {
+            "h": h_residues,
+            "edges": pocket_edges,
+            "geometry": (pocket_distances, pocket_coord_diff),
+            "ligand_layout": ligand_layout,
+            "check_nan": False,
+        }
+        return self.ddpm.sample_p_zs_given_zt(
+            s,
+            t,
+            zt_lig,
+            xh_pocket,
+            lig_mask,
+            pocket_mask,
+            pocket_context=pocket_context,
+            check_mean=False,
+        )
+
+    def pad_context(self, pocket_context, lig_mask, pocket_mask, n_samples):
+        """
+        Pads all chain-constant inputs to their bucket sizes. The result is
+        stored in the pocket context and reused for all steps.
+        """
+        ligand_layout = pocket_context["ligand_layout"]
+        assert ligand_layout is not None, "Context must contain the ligand layout"
+
+        n_lig, n_pocket = len(lig_mask), len(pocket_mask)
+        n_lig_pad = _round_up(n_lig, self.node_bucket)
+        n_pocket_pad = _round_up(n_pocket, self.node_bucket)
+        n_samples_pad = _round_up(n_samples, self.sample_bucket)
+        dummy = n_samples_pad - 1
+
+        # padding edges connect the last (dummy) ligand or pocket node to
+        # itself, pocket edges are indexed relative to the pocket nodes
+        ligand_edges = ligand_layout["edges"].clone()
+        ligand_edges[ligand_edges >= n_lig] += n_lig_pad - n_lig
+        ligand_edges = _pad(
+            ligand_edges.T,
+            _round_up(ligand_edges.size(1), self.edge_bucket),
+            n_lig_pad - 1,
+        ).T
+        pocket_edges = pocket_context["edges"]
+        n_pocket_edges_pad = _round_up(pocket_edges.size(1), self.edge_bucket)
+        pocket_edges = _pad(pocket_edges.T, n_pocket_edges_pad, n_pocket_pad - 1).T
+
+        distances, coord_diff = pocket_context["geometry"]
+        padded = {
+            "n_lig_pad": n_lig_pad,
+            "n_pocket_pad": n_pocket_pad,
+            "n_samples_pad": n_samples_pad,
+            "lig_mask": _pad(lig_mask, n_lig_pad, dummy),
+            "pocket_mask": _pad(pocket_mask, n_pocket_pad, dummy),
+            "h_residues": _pad(pocket_context["h"], n_pocket_pad),
+            "pocket_edges": pocket_edges,
+            "pocket_distances": _pad(distances, n_pocket_edges_pad),
+            "pocket_coord_diff": _pad(coord_diff, n_pocket_edges_pad),
+            "ligand_edges": ligand_edges,
+        }
+
+        joint_nf = pocket_context["h"].size(1)
+        if self.ddpm.dynamics.sin_encoding is not None:
+            # atom-atom encodings, padded to the (bucketed) number of ligand
+            # edges so that their shape does not depend on the ligand sizes
+            padded["ligand_edge_attr"] = _pad(
+                ligand_layout["edge_attr"], ligand_edges.size(1)
+            )
+            padded["node_encoding"] = _pad(ligand_layout["node_encoding"], n_lig_pad)
+        else:
+            empty = distances.new_zeros(0, joint_nf)
+            padded["ligand_edge_attr"] = empty
+            padded["node_encoding"] = empty
+
+        pocket_context["padded"] = padded
+        return padded
+
+    def get_compiled(self, key):
+        if key in self.compiled:
+            self.compiled.move_to_end(key)
+            return self.compiled[key]
+
+        fn = torch.compile(self._step, backend=self.backend, dynamic=False)
+        self.compiled[key] = fn
+        if len(self.compiled) > self.max_buckets:
+            self.compiled.popitem(last=False)
+        return fn
+
+    def __call__(self, s, t, zt_lig, xh_pocket, lig_mask, pocket_mask, pocket_context):
+        n_samples, n_lig, n_pocket = len(s), len(lig_mask), len(pocket_mask)
+        padded = pocket_context.get("padded")
+        if padded is None:
+            padded = self.pad_context(pocket_context, lig_mask, pocket_mask, n_samples)
+
+        key = (
+            padded["n_samples_pad"],
+            padded["n_lig_pad"],
+            padded["n_pocket_pad"],
+            padded["ligand_edges"].size(1),
+            padded["pocket_edges"].size(1),
+            str(zt_lig.device),
+        )
+        fn = self.get_compiled(key)
+
+        # padding samples use the time of the first sample
+        s_pad = _pad(s, padded["n_samples_pad"], 0.0)
+        s_pad[n_samples:] = s[:1]
+        t_pad = _pad(t, padded["n_samples_pad"], 0.0)
+        t_pad[n_samples:] = t[:1]
+
+        # every bucket is a recompilation of the same code object, the limit
+        # is only raised for these calls instead of process-wide
+        limit = max(torch._dynamo.config.cache_size_limit, self.max_buckets)
+        with torch._dynamo.config.patch(cache_size_limit=limit):
+            zs_lig, xh_pocket = fn(
+                s_pad,
+                t_pad,
+                _pad(zt_lig, padded["n_lig_pad"]),
+                _pad(xh_pocket, padded["n_pocket_pad"]),
+                padded["lig_mask"],
+                padded["pocket_mask"],
+                padded["h_residues"],
+                padded["pocket_edges"],
+                padded["pocket_distances"],
+                padded["pocket_coord_diff"],
+                padded["ligand_edges"],
+                padded["ligand_edge_attr"],
+                padded["node_encoding"],
+            )
+        return zs_lig[:n_lig], xh_pocket[:n_pocket]
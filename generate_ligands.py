@@ -5,6 +5,7 @@ import torch
 
 import utils
 from lightning_modules import LigandPocketDDPM
+from analysis.postprocessing import get_postprocessor
 
 
 if __name__ == "__main__":
@@ -22,6 +23,13 @@ if __name__ == "__main__":
     parser.add_argument('--resamplings', type=int, default=1)
     parser.add_argument('--jump_length', type=int, default=1)
     parser.add_argument('--timesteps', type=int, default=None)
+    parser.add_argument('--sampler', type=str, default='ddpm',
+                        choices=['ddpm', 'ddim', 'dpm2', 'dpm3'])
+    parser.add_argument('--eta', type=float, default=0.0)
+    parser.add_argument('--spacing', type=str, default='uniform',
+                        choices=['uniform', 'quadratic', 'logsnr'])
+    parser.add_argument('--n_workers', type=int, default=0,
+                        help='processes for building and filtering molecules')
     args = parser.parse_args()
 
     pdb_id = Path(args.pdbfile).stem
@@ -39,12 +47,15 @@ if __name__ == "__main__":
     else:
         num_nodes_lig = None
 
+    postprocessor = get_postprocessor(args.n_workers)
     molecules = model.generate_ligands(
         args.pdbfile, args.n_samples, args.resi_list, args.ref_ligand,
         num_nodes_lig, args.sanitize, largest_frag=not args.all_frags,
         relax_iter=(200 if args.relax else 0),
         resamplings=args.resamplings, jump_length=args.jump_length,
-        timesteps=args.timesteps)
+        timesteps=args.timesteps, sampler=args.sampler, eta=args.eta,
+        spacing=args.spacing, postprocessor=postprocessor)
+    postprocessor.close()
 
     # Make SDF files
     utils.write_sdf_file(Path(args.outdir, f'{pdb_id}_mol.sdf'), molecules)
@@ -6,6 +6,7 @@ import time
 
 from Bio.PDB import PDBParser, PDBIO
 import torch
+from tqdm import tqdm
 
 import utils
 from lightning_modules import LigandPocketDDPM
@@ -13,6 +14,7 @@ from dataset_pmhc import (
     write_updated_peptide_coords_pdb,
     process_pmhc_pdb_file,
     read_pdb_strings_hdf5_file,
+    iter_pdb_strings_hdf5_file,
     encode_types,
 )
 
@@ -39,35 +41,155 @@ def combine_samples(peptide, mhc, n_samples):
     return peptide, mhc
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("checkpoint", type=Path)
-    parser.add_argument("--pdbfile", type=Path)
-    parser.add_argument("--outdir", type=Path)
-    parser.add_argument("--n_samples", type=int, default=5)
-    parser.add_argument("--timesteps", type=int, default=None)
-    parser.add_argument("--atom_level", type=bool, default=False)
-    parser.add_argument("--data_dir", type=Path, default=None)
-    parser.add_argument("--return_frames", type=int, default=1)
-    parser.add_argument("--select_interface", action="store_true", default=False)
-    parser.add_argument("--structure_idx", type=int, default=0)
-    args = parser.parse_args()
+def iter_complexes(hdf5_files, names, encoder, atom_level, select_interface, device,
+                   skip=None):
+    """
+    Streams encoded (name, pdb string, peptide, mhc) tuples from hdf5 files.
+    Structures for which skip(name) is true are dropped before parsing.
+    """
+    for hdf5_file in hdf5_files:
+        for name, pdb_string in iter_pdb_strings_hdf5_file(hdf5_file, names):
+            if skip is not None and skip(name):
+                continue
+            peptide, mhc = process_pmhc_pdb_file(
+                io.StringIO(pdb_string),
+                atom_level=atom_level,
+                device=device,
+                select_interface=select_interface,
+                pdb_string=pdb_string,
+            )
+            peptide["one_hot"] = encode_types(peptide["types"], encoder, device=device)
+            mhc["one_hot"] = encode_types(mhc["types"], encoder, device=device)
+            yield name, pdb_string, peptide, mhc
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    atom_level = args.atom_level
 
-    # load model
-    if args.data_dir is not None:
-        model = LigandPocketDDPM.load_from_checkpoint(
-            args.checkpoint, map_location=device, datadir=args.data_dir
+def iter_batches(complexes, n_samples, max_batch_nodes, max_batch_complexes=None):
+    """
+    Packs complexes into mixed batches. Each complex contributes n_samples
+    samples and a batch is closed before its total number of peptide and
+    MHC nodes would exceed max_batch_nodes (a single complex that is larger
+    than the budget forms its own batch).
+    """
+    batch, batch_nodes = [], 0
+    for item in complexes:
+        _, _, peptide, mhc = item
+        n_nodes = n_samples * (peptide["size"] + mhc["size"])
+        if len(batch) > 0 and (
+            batch_nodes + n_nodes > max_batch_nodes
+            or (max_batch_complexes is not None and len(batch) >= max_batch_complexes)
+        ):
+            yield batch
+            batch, batch_nodes = [], 0
+        batch.append(item)
+        batch_nodes += n_nodes
+    if len(batch) > 0:
+        yield batch
+
+
+def collate_complexes(batch, n_samples):
+    """Concatenates n_samples copies of every complex in the batch, samples
+    of the same complex are consecutive."""
+
+    def collate(parts):
+        sizes = torch.tensor(
+            [p["size"] for p in parts for _ in range(n_samples)],
+            device=parts[0]["x"].device,
         )
-    else:
-        model = LigandPocketDDPM.load_from_checkpoint(
-            args.checkpoint, map_location=device
+        return {
+            "x": torch.cat([p["x"] for p in parts for _ in range(n_samples)], dim=0),
+            "one_hot": torch.cat(
+                [p["one_hot"] for p in parts for _ in range(n_samples)], dim=0
+            ),
+            "size": sizes,
+            "mask": torch.repeat_interleave(
+                torch.arange(len(sizes), device=sizes.device), sizes
+            ),
+        }
+
+    return collate([item[2] for item in batch]), collate([item[3] for item in batch])
+
+
+def generate_batched(model, args, device):
+    """
+    Samples peptides for all (or the selected) structures of one or more hdf5
+    files. Different complexes are packed into size-bounded batches and the
+    results of every batch are written as soon as it is done.
+    """
+    assert args.return_frames == 1, "Batch mode only writes final samples"
+    decoder = model.pocket_type_decoder
+
+    names = None
+    if args.names_file is not None:
+        with open(args.names_file, "r") as f:
+            names = {line.strip() for line in f if line.strip()}
+
+    skip = None
+    if args.skip_existing:
+        def skip(name):
+            return (args.outdir / name / "original.pdb").exists()
+
+    complexes = iter_complexes(
+        args.hdf5_files,
+        names,
+        model.pocket_type_encoder,
+        args.atom_level,
+        args.select_interface,
+        device,
+        skip=skip,
+    )
+
+    pbar = tqdm(unit="complex")
+    start_time = time.time()
+    for batch in iter_batches(
+        complexes, args.n_samples, args.max_batch_nodes, args.max_batch_complexes
+    ):
+        peptide, mhc = collate_complexes(batch, args.n_samples)
+        xh_peptide = model.generate_peptides(
+            peptide,
+            mhc,
+            timesteps=args.timesteps,
+            sampler=args.sampler,
+            eta=args.eta,
+            spacing=args.spacing,
+            fast_sampling=args.fast_sampling,
         )
-    model = model.to(device)
+        x_peptide = xh_peptide[:, : model.x_dims].cpu()
+        x_split = torch.split(x_peptide, peptide["size"].tolist())
+
+        for i, (name, pdb_string, _, _) in enumerate(batch):
+            samples_dir = args.outdir / name
+            for j in range(args.n_samples):
+                sample_dir = samples_dir / f"{name}_sample_{j}"
+                sample_dir.mkdir(parents=True, exist_ok=True)
+                write_updated_peptide_coords_pdb(
+                    x_split[i * args.n_samples + j],
+                    decoder,
+                    io.StringIO(pdb_string),
+                    sample_dir / f"{name}_sample_{j}.pdb",
+                    atom_level=args.atom_level,
+                )
+
+            # written last, marks the complex as done
+            structure = PDBParser(QUIET=True).get_structure(
+                name, io.StringIO(pdb_string)
+            )
+            pdb_io = PDBIO()
+            pdb_io.set_structure(structure)
+            pdb_io.save(str(samples_dir / "original.pdb"))
+
+        pbar.update(len(batch))
+        samples_per_s = pbar.n * args.n_samples / (time.time() - start_time)
+        pbar.set_postfix(
+            samples_per_s=f"{samples_per_s:.2f}",
+            batch_nodes=len(peptide["mask"]) + len(mhc["mask"]),
+        )
+    pbar.close()
+
 
-    # load encoder and decoder
+def generate_single(model, args, device):
+    """Sample peptides for a single structure (pdb file or one entry of an
+    hdf5 file)."""
+    atom_level = args.atom_level
     encoder = model.pocket_type_encoder
     decoder = model.pocket_type_decoder
 
@@ -88,7 +210,9 @@ if __name__ == "__main__":
     mhc["one_hot"] = encode_types(mhc["types"], encoder, device=device)
     
     peptide, mhc = combine_samples(peptide, mhc, args.n_samples)
-    print("average mhc size:", mhc["size"])
+    tqdm.write(
+        f"peptide size: {int(peptide['size'][0])}, MHC size: {int(mhc['size'][0])}"
+    )
 
     start_time = time.time()
     xh_peptide = model.generate_peptides(
@@ -96,8 +220,12 @@ if __name__ == "__main__":
         mhc,
         timesteps=args.timesteps,
         return_frames=args.return_frames,
+        sampler=args.sampler,
+        eta=args.eta,
+        spacing=args.spacing,
+        fast_sampling=args.fast_sampling,
     )
-    print("time taken:", time.time() - start_time)
+    tqdm.write(f"time taken: {time.time() - start_time:.2f} s")
     
     size = int(len(xh_peptide) / args.n_samples) if args.return_frames == 1 else int(len(xh_peptide[0]) / args.n_samples)
 
@@ -135,6 +263,51 @@ if __name__ == "__main__":
         structure = parser.get_structure(name, args.pdbfile)
     else:
         structure = parser.get_structure(name, io.StringIO(pdb_string[args.structure_idx]))
-    io = PDBIO()
-    io.set_structure(structure)
-    io.save(str(samples_dir / "original.pdb"))
+    pdb_io = PDBIO()
+    pdb_io.set_structure(structure)
+    pdb_io.save(str(samples_dir / "original.pdb"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", type=Path)
+    parser.add_argument("--pdbfile", type=Path)
+    parser.add_argument("--outdir", type=Path)
+    parser.add_argument("--n_samples", type=int, default=5)
+    parser.add_argument("--timesteps", type=int, default=None)
+    parser.add_argument("--sampler", type=str, default="ddpm", choices=["ddpm", "ddim", "dpm2", "dpm3"])
+    parser.add_argument("--eta", type=float, default=0.0)
+    parser.add_argument("--spacing", type=str, default="uniform", choices=["uniform", "quadratic", "logsnr"])
+    parser.add_argument("--fast_sampling", action="store_true", default=False)
+    parser.add_argument("--atom_level", type=bool, default=False)
+    parser.add_argument("--data_dir", type=Path, default=None)
+    parser.add_argument("--return_frames", type=int, default=1)
+    parser.add_argument("--select_interface", action="store_true", default=False)
+    parser.add_argument("--structure_idx", type=int, default=0)
+    parser.add_argument("--hdf5_files", type=Path, nargs="+", default=None,
+                        help="batch mode: sample for all structures in these files")
+    parser.add_argument("--names_file", type=Path, default=None,
+                        help="batch mode: only use the structure names listed in this file")
+    parser.add_argument("--max_batch_nodes", type=int, default=20000)
+    parser.add_argument("--max_batch_complexes", type=int, default=None)
+    parser.add_argument("--skip_existing", action="store_true", default=False)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # load model
+    if args.data_dir is not None:
+        model = LigandPocketDDPM.load_from_checkpoint(
+            args.checkpoint, map_location=device, datadir=args.data_dir
+        )
+    else:
+        model = LigandPocketDDPM.load_from_checkpoint(
+            args.checkpoint, map_location=device
+        )
+    model = model.to(device)
+
+
+    if args.hdf5_files is not None:
+        generate_batched(model, args, device)
+    else:
+        generate_single(model, args, device)
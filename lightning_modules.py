@@ -8,7 +8,7 @@ from pathlib import Path
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 import pytorch_lightning as pl
 import wandb
 from torch_scatter import scatter_add, scatter_mean
@@ -22,7 +22,13 @@ from equivariant_diffusion.conditional_model import (
     ConditionalDDPM,
     SimpleConditionalDDPM,
 )
-from dataset import ProcessedLigandPocketDataset
+from dataset import (
+    load_processed_dataset,
+    ShardedLigandPocketDataset,
+    ShardShuffleSampler,
+    SizeBucketBatchSampler,
+)
+from dataset_pmhc import HDF5PMHCDataset
 import utils
 from analysis.visualization import (
     save_xyz_file,
@@ -32,10 +38,11 @@ from analysis.visualization import (
 )
 from analysis.metrics import (
     check_stability,
+    check_stability_batch,
     BasicMolecularMetrics,
     CategoricalDistribution,
 )
-from analysis.molecule_builder import build_molecule, process_molecule
+from analysis.postprocessing import PostProcessor
 
 
 class LigandPocketDDPM(pl.LightningModule):
@@ -61,6 +68,8 @@ class LigandPocketDDPM(pl.LightningModule):
         mode,
         node_histogram,
         pocket_representation="CA",
+        edge_budget=None,
+        hdf5_params=None,
     ):
         super(LigandPocketDDPM, self).__init__()
         self.save_hyperparameters()
@@ -79,6 +88,8 @@ class LigandPocketDDPM(pl.LightningModule):
         self.datadir = datadir
         self.outdir = outdir
         self.batch_size = batch_size
+        self.edge_budget = edge_budget
+        self.hdf5_params = hdf5_params
         self.eval_batch_size = (
             eval_params.eval_batch_size
             if "eval_batch_size" in eval_params
@@ -126,6 +137,9 @@ class LigandPocketDDPM(pl.LightningModule):
         self.test_batch_size = None
         self.test_n_samples = None
         self.test_n_time_batches = None
+        self.test_sampler = "ddpm"
+        self.test_eta = 0.0
+        self.test_spacing = "uniform"
 
         with open(Path(datadir) / "encoder.json") as f:
             encoder = json.load(f)
@@ -176,6 +190,8 @@ class LigandPocketDDPM(pl.LightningModule):
             normalization_factor=egnn_params.normalization_factor,
             aggregation_method=egnn_params.aggregation_method,
             edge_cutoff=egnn_params.__dict__.get("edge_cutoff"),
+            edge_max_neighbors=egnn_params.__dict__.get("edge_max_neighbors"),
+            edge_cache_size=egnn_params.__dict__.get("edge_cache_size", 4),
             update_pocket_coords=(self.mode == "joint"),
             use_nodes_noise_prediction=use_nodes,
         )
@@ -207,47 +223,106 @@ class LigandPocketDDPM(pl.LightningModule):
             self.ddpm.parameters(), lr=self.lr, amsgrad=True, weight_decay=1e-12
         )
 
+    def load_split(self, split):
+        """
+        Raw HDF5 files listed for the split in hdf5_params are parsed on the
+        fly, otherwise the processed split in datadir is used.
+        """
+        hdf5_params = {} if self.hdf5_params is None else self.hdf5_params.__dict__
+        if split not in hdf5_params:
+            dataset = load_processed_dataset(Path(self.datadir, f"{split}.npz"))
+            if self.edge_budget is not None and isinstance(
+                dataset, ShardedLigandPocketDataset
+            ):
+                # size buckets span all shards, which defeats shard-wise reading
+                raise ValueError(
+                    f"edge_budget batching cannot be combined with the sharded "
+                    f"{split} split, which is read shard by shard. Remove "
+                    f"edge_budget from the config or preprocess the split "
+                    f"without --shard_size."
+                )
+            return dataset
+
+        if self.edge_budget is not None:
+            # sample sizes of raw HDF5 files are only known after parsing
+            raise ValueError(
+                f"edge_budget batching needs per-sample sizes, which are not "
+                f"available for the HDF5 {split} split. Preprocess the split "
+                f"with process_pmhc.py or remove edge_budget from the config."
+            )
+
+        return HDF5PMHCDataset(
+            hdf5_params[split],
+            self.pocket_type_encoder,
+            atom_level=self.pocket_representation == "full-atom",
+            select_interface=hdf5_params.get("select_interface", False),
+            cache_dir=hdf5_params.get("cache_dir"),
+        )
+
     def setup(self, stage: Optional[str] = None):
         if stage == "fit":
-            self.train_dataset = ProcessedLigandPocketDataset(
-                Path(self.datadir, "train.npz")
-            )
-            self.val_dataset = ProcessedLigandPocketDataset(
-                Path(self.datadir, "val.npz")
-            )
+            self.train_dataset = self.load_split("train")
+            self.val_dataset = self.load_split("val")
         elif stage == "test":
             if self.test_dataset is None:
-                self.test_dataset = ProcessedLigandPocketDataset(
-                    Path(self.datadir, "test.npz")
-                )
+                self.test_dataset = self.load_split("test")
         else:
             raise NotImplementedError
 
-    def train_dataloader(self):
+    def get_dataloader(self, dataset, shuffle, batch_size=None):
+        # samplers are sharded across ranks here instead of by Lightning
+        trainer = self._trainer
+        num_replicas = 1 if trainer is None else trainer.world_size
+        rank = 0 if trainer is None else trainer.global_rank
+
+        if self.edge_budget is not None and batch_size is None:
+            # batches with a fixed number of edges instead of samples
+            batch_sampler = SizeBucketBatchSampler(
+                dataset.num_lig_atoms,
+                dataset.num_pocket_nodes,
+                self.edge_budget,
+                shuffle=shuffle,
+                num_replicas=num_replicas,
+                rank=rank,
+            )
+            return DataLoader(
+                dataset,
+                batch_sampler=batch_sampler,
+                num_workers=self.num_workers,
+                collate_fn=dataset.collate_fn,
+            )
+
+        sampler = None
+        if isinstance(dataset, ShardedLigandPocketDataset):
+            sampler = ShardShuffleSampler(
+                dataset.shard_sizes,
+                shuffle=shuffle,
+                num_replicas=num_replicas,
+                rank=rank,
+            )
+        elif num_replicas > 1:
+            sampler = DistributedSampler(
+                dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle
+            )
+
         return DataLoader(
-            self.train_dataset,
-            self.batch_size,
-            shuffle=True,
+            dataset,
+            self.batch_size if batch_size is None else batch_size,
+            shuffle=shuffle if sampler is None else False,
+            sampler=sampler,
             num_workers=self.num_workers,
-            collate_fn=self.train_dataset.collate_fn,
+            collate_fn=dataset.collate_fn,
         )
 
+    def train_dataloader(self):
+        return self.get_dataloader(self.train_dataset, shuffle=True)
+
     def val_dataloader(self):
-        return DataLoader(
-            self.val_dataset,
-            self.batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            collate_fn=self.val_dataset.collate_fn,
-        )
+        return self.get_dataloader(self.val_dataset, shuffle=False)
 
     def test_dataloader(self, batch_size=None):
-        return DataLoader(
-            self.test_dataset,
-            self.batch_size if batch_size is None else batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            collate_fn=self.test_dataset.collate_fn,
+        return self.get_dataloader(
+            self.test_dataset, shuffle=False, batch_size=batch_size
         )
 
     def get_ligand_and_pocket(self, data):
@@ -476,6 +551,9 @@ class LigandPocketDDPM(pl.LightningModule):
             timesteps=self.test_timesteps,
             n_samples=self.test_n_samples,
             n_time_batches=self.test_n_time_batches,
+            sampler=self.test_sampler,
+            eta=self.test_eta,
+            spacing=self.test_spacing,
         )
         self.log_metrics(rmsd, "test")
         self.log_metrics(mean_time, "test")
@@ -496,11 +574,14 @@ class LigandPocketDDPM(pl.LightningModule):
         print(f"Analyzing molecule stability at epoch {self.current_epoch}...")
 
         batch_size = self.batch_size if batch_size is None else batch_size
-        batch_size = min(batch_size, n_samples)
+        batch_size = max(min(batch_size, n_samples), 1)
 
         # each item in molecules is a tuple (position, atom_type_encoded)
         molecules = []
-        atom_types = []
+        # all molecules concatenated, starting with an empty batch
+        x_all = [torch.zeros(0, self.x_dims)]
+        atom_type_all = [torch.zeros(0, dtype=torch.long)]
+        lig_mask_all = [torch.zeros(0, dtype=torch.long)]
         aa_types = []
         for i in range(math.ceil(n_samples / batch_size)):
 
@@ -516,7 +597,11 @@ class LigandPocketDDPM(pl.LightningModule):
 
             x = xh_lig[:, : self.x_dims].detach().cpu()
             atom_type = xh_lig[:, self.x_dims :].argmax(1).detach().cpu()
+            lig_mask = lig_mask.cpu()
 
+            x_all.append(x)
+            atom_type_all.append(atom_type)
+            lig_mask_all.append(lig_mask + len(molecules))
             molecules.extend(
                 list(
                     zip(
@@ -526,17 +611,29 @@ class LigandPocketDDPM(pl.LightningModule):
                 )
             )
 
-            atom_types.extend(atom_type.tolist())
             aa_types.extend(
                 xh_pocket[:, self.x_dims :].argmax(1).detach().cpu().tolist()
             )
 
-        return self.analyze_sample(molecules, atom_types, aa_types)
+        return self.analyze_sample(
+            molecules,
+            torch.cat(x_all),
+            torch.cat(atom_type_all),
+            torch.cat(lig_mask_all),
+            aa_types,
+        )
 
-    def analyze_sample(self, molecules, atom_types, aa_types):
+    def analyze_sample(self, molecules, x, atom_type, batch_mask, aa_types):
+        """
+        :param molecules: list of (positions, atom types) tuples
+        :param x: (n_atoms, 3) positions of all molecules
+        :param atom_type: (n_atoms,) atom types of all molecules
+        :param batch_mask: (n_atoms,) sorted molecule index of every atom
+        :param aa_types: list of pocket residue types
+        """
         # Distribution of node types
         kl_div_atom = (
-            self.ligand_type_distribution.kl_divergence(atom_types)
+            self.ligand_type_distribution.kl_divergence(atom_type.tolist())
             if self.ligand_type_distribution is not None
             else -1
         )
@@ -546,18 +643,14 @@ class LigandPocketDDPM(pl.LightningModule):
             else -1
         )
 
-        # Stability
-        molecule_stable = 0
-        nr_stable_bonds = 0
-        n_atoms = 0
-        for pos, atom_type in molecules:
-            validity_results = check_stability(pos, atom_type, self.dataset_info)
-            molecule_stable += int(validity_results[0])
-            nr_stable_bonds += int(validity_results[1])
-            n_atoms += int(validity_results[2])
+        # Stability (all molecules at once)
+        mol_stable, atm_stable = check_stability_batch(
+            x, atom_type, batch_mask, self.dataset_info
+        )
 
-        fraction_mol_stable = molecule_stable / float(len(molecules))
-        fraction_atm_stable = nr_stable_bonds / float(n_atoms)
+        # no molecules count as 0, as in the other metrics
+        fraction_mol_stable = mol_stable.sum() / max(len(mol_stable), 1)
+        fraction_atm_stable = atm_stable.sum() / max(len(atm_stable), 1)
 
         # Other basic metrics
         validity, connectivity, uniqueness, novelty = self.ligand_metrics.evaluate(
@@ -583,11 +676,14 @@ class LigandPocketDDPM(pl.LightningModule):
         )
 
         batch_size = self.batch_size if batch_size is None else batch_size
-        batch_size = min(batch_size, n_samples)
+        batch_size = max(min(batch_size, n_samples), 1)
 
         # each item in molecules is a tuple (position, atom_type_encoded)
         molecules = []
-        atom_types = []
+        # all molecules concatenated, starting with an empty batch
+        x_all = [torch.zeros(0, self.x_dims)]
+        atom_type_all = [torch.zeros(0, dtype=torch.long)]
+        lig_mask_all = [torch.zeros(0, dtype=torch.long)]
         aa_types = []
 
         for i in range(math.ceil(n_samples / batch_size)):
@@ -614,7 +710,11 @@ class LigandPocketDDPM(pl.LightningModule):
 
             x = xh_lig[:, : self.x_dims].detach().cpu()
             atom_type = xh_lig[:, self.x_dims :].argmax(1).detach().cpu()
+            lig_mask = lig_mask.cpu()
 
+            x_all.append(x)
+            atom_type_all.append(atom_type)
+            lig_mask_all.append(lig_mask + len(molecules))
             molecules.extend(
                 list(
                     zip(
@@ -624,12 +724,17 @@ class LigandPocketDDPM(pl.LightningModule):
                 )
             )
 
-            atom_types.extend(atom_type.tolist())
             aa_types.extend(
                 xh_pocket[:, self.x_dims :].argmax(1).detach().cpu().tolist()
             )
 
-        return self.analyze_sample(molecules, atom_types, aa_types)
+        return self.analyze_sample(
+            molecules,
+            torch.cat(x_all),
+            torch.cat(atom_type_all),
+            torch.cat(lig_mask_all),
+            aa_types,
+        )
 
     def sample_and_save(self, n_samples):
         num_nodes_lig, num_nodes_pocket = self.ddpm.size_distribution.sample(n_samples)
@@ -713,10 +818,13 @@ class LigandPocketDDPM(pl.LightningModule):
             timesteps=None,
             average_over_batch=True,
             n_samples=None,
-            n_time_batches=None
+            n_time_batches=None,
+            sampler="ddpm",
+            eta=0.0,
+            spacing="uniform",
         ):
-        x_data = []
-        x_generated = []
+        rmsd_per_peptide = []
+        aligned_rmsd_per_peptide = []
         times = []
         names = []
 
@@ -742,6 +850,9 @@ class LigandPocketDDPM(pl.LightningModule):
                 ligand["one_hot"],
                 ligand["mask"],
                 timesteps=timesteps,
+                sampler=sampler,
+                eta=eta,
+                spacing=spacing,
             )
             time_end = time.time()
             times.append(time_end - time_start)
@@ -751,16 +862,21 @@ class LigandPocketDDPM(pl.LightningModule):
             )
             xh_lig[:, : self.x_dims] += (pocket_com_before - pocket_com_after)[lig_mask]
 
-            x = xh_lig[:, : self.x_dims].detach().cpu()
-            x_data.extend(
-                utils.batch_to_list(ligand["x"].detach().cpu(), lig_mask.detach().cpu())
+            # RMSD of all samples of the batch at once, on the device
+            x = xh_lig[:, : self.x_dims].detach()
+            n_batch = len(ligand["size"])
+            rmsd_per_peptide.append(
+                utils.batch_rmsd(ligand["x"], x, lig_mask, n_batch).cpu()
+            )
+            aligned_rmsd_per_peptide.append(
+                utils.batch_rmsd(ligand["x"], x, lig_mask, n_batch, align=True).cpu()
             )
-            x_generated.extend(utils.batch_to_list(x, lig_mask.detach().cpu()))
 
         save_plot = plot_distribution and n_time_batches is not None
         rmsd = self.rmsd_peptide_sample(
-            x_data,
-            x_generated,
+            torch.cat(rmsd_per_peptide),
+            torch.cat(aligned_rmsd_per_peptide),
+            n_samples=n_samples,
             plot_distribution=save_plot,
         )
 
@@ -775,30 +891,45 @@ class LigandPocketDDPM(pl.LightningModule):
 
 
     def rmsd_peptide_sample(
-        self, list_x_data, list_x_generated, plot_distribution=False
+        self,
+        rmsd_per_peptide,
+        aligned_rmsd_per_peptide,
+        n_samples=None,
+        plot_distribution=False,
     ):
-        # get the rmsd for each sample
-        rmsd_per_peptide = np.array(
-            [
-                self.rmsd_single_peptide(x_data, x_generated)
-                for x_data, x_generated in zip(list_x_data, list_x_generated)
-            ]
-        )
-        rmsd_per_peptide = rmsd_per_peptide
+        """
+        Aggregate the RMSDs of all generated peptides.
+        :param rmsd_per_peptide: (n_complexes * n_samples,) RMSD of each sample
+        :param aligned_rmsd_per_peptide: same after Kabsch superposition
+        :param n_samples: number of consecutive samples per complex, if given
+            the best and average sample per complex are reported as well
+        :return: dict of metrics
+        """
+        rmsd_per_peptide = rmsd_per_peptide.numpy()
+        aligned_rmsd_per_peptide = aligned_rmsd_per_peptide.numpy()
         # save rmsd per peptide
         np.save(self.outdir / "rmsd_per_peptide.npy", rmsd_per_peptide)
+        np.save(self.outdir / "aligned_rmsd_per_peptide.npy", aligned_rmsd_per_peptide)
         if plot_distribution:
             plot_rmsd_distribution(self.outdir / "rmsd_dist.png", rmsd_per_peptide)
 
-        rmsd = rmsd_per_peptide.mean()
-
-        return {"sample_rmsd": rmsd}
-
-    def rmsd_single_peptide(self, x_data, x_generated):
-        x_diff = x_data.numpy() - x_generated.numpy()
-        x_dist = (x_diff**2).sum(axis=1)
-        rmsd = np.sqrt(x_dist.mean())
-        return rmsd
+        metrics = {
+            "sample_rmsd": rmsd_per_peptide.mean(),
+            "sample_aligned_rmsd": aligned_rmsd_per_peptide.mean(),
+        }
+        if n_samples is not None:
+            # samples of a complex are consecutive (utils.extend_batch_n_samples)
+            assert len(rmsd_per_peptide) % n_samples == 0, \
+                f"{len(rmsd_per_peptide)} RMSDs are not {n_samples} samples " \
+                f"per complex"
+            per_complex = rmsd_per_peptide.reshape(-1, n_samples)
+            aligned_per_complex = aligned_rmsd_per_peptide.reshape(-1, n_samples)
+            metrics["complex_min_rmsd"] = per_complex.min(1).mean()
+            metrics["complex_mean_rmsd"] = per_complex.mean(1).mean()
+            metrics["complex_min_aligned_rmsd"] = aligned_per_complex.min(1).mean()
+            metrics["complex_mean_aligned_rmsd"] = aligned_per_complex.mean(1).mean()
+
+        return metrics
 
     def sample_chain_and_save(self, keep_frames):
         n_samples = 1
@@ -966,6 +1097,11 @@ class LigandPocketDDPM(pl.LightningModule):
         largest_frag=False,
         relax_iter=0,
         timesteps=None,
+        sampler="ddpm",
+        eta=0.0,
+        spacing="uniform",
+        postprocessor=None,
+        wait=True,
         **kwargs,
     ):
         """
@@ -982,9 +1118,18 @@ class LigandPocketDDPM(pl.LightningModule):
             largest_frag: only return the largest fragment
             relax_iter: number of force field optimization steps
             timesteps: number of denoising steps, use training value if None
+            sampler: 'ddpm' (ancestral), 'ddim' (implicit) or 'dpm2'/'dpm3'
+                (DPM-Solver++), only used by the conditional model
+            eta: stochasticity of the implicit sampler
+            spacing: spacing of the visited time steps, see
+                ConditionalDDPM.get_sampling_schedule
+            postprocessor: executor for building and filtering the molecules
+                (see analysis.postprocessing), serial if None
+            wait: if False, return the PendingMolecules handle immediately so
+                that the next batch can be sampled while this one is processed
             kwargs: additional inpainting parameters
         Returns:
-            list of molecules
+            list of molecules (PendingMolecules if wait=False)
         """
 
         assert (pocket_ids is None) ^ (ref_ligand is None)
@@ -1099,7 +1244,8 @@ class LigandPocketDDPM(pl.LightningModule):
         # Use conditional generation
         elif type(self.ddpm) == ConditionalDDPM:
             xh_lig, xh_pocket, lig_mask, pocket_mask = self.ddpm.sample_given_pocket(
-                pocket, num_nodes_lig, timesteps=timesteps
+                pocket, num_nodes_lig, timesteps=timesteps, sampler=sampler,
+                eta=eta, spacing=spacing
             )
 
         else:
@@ -1117,23 +1263,23 @@ class LigandPocketDDPM(pl.LightningModule):
         x = xh_lig[:, : self.x_dims].detach().cpu()
         atom_type = xh_lig[:, self.x_dims :].argmax(1).detach().cpu()
 
-        molecules = []
-        for mol_pc in zip(
-            utils.batch_to_list(x, lig_mask), utils.batch_to_list(atom_type, lig_mask)
-        ):
-
-            mol = build_molecule(*mol_pc, self.dataset_info, add_coords=True)
-            mol = process_molecule(
-                mol,
-                add_hydrogens=False,
-                sanitize=sanitize,
-                relax_iter=relax_iter,
-                largest_frag=largest_frag,
-            )
-            if mol is not None:
-                molecules.append(mol)
+        if postprocessor is None:
+            postprocessor = PostProcessor()
+        pending = postprocessor.submit(
+            x,
+            atom_type,
+            lig_mask,
+            self.dataset_info,
+            add_hydrogens=False,
+            sanitize=sanitize,
+            relax_iter=relax_iter,
+            largest_frag=largest_frag,
+        )
+        if not wait:
+            return pending
 
-        return molecules
+        _, molecules = pending.get()
+        return [mol for mol in molecules if mol is not None]
 
     def generate_peptides(
         self,
@@ -1141,6 +1287,8 @@ class LigandPocketDDPM(pl.LightningModule):
         pocket,
         timesteps=None,
         return_frames=1,
+        sampler="ddpm",
+        eta=0.0,
         **kwargs,
     ):
         """
@@ -1149,7 +1297,10 @@ class LigandPocketDDPM(pl.LightningModule):
             pdb_path: path to pdb file
             n_samples: number of samples to generate
             timesteps: number of denoising steps, use training value if None
-            kwargs: additional inpainting parameters
+            sampler: 'ddpm' (ancestral), 'ddim' (implicit) or 'dpm2'/'dpm3'
+                (DPM-Solver++)
+            eta: stochasticity of the implicit sampler
+            kwargs: additional sampling parameters
         Returns:
             list of molecules
         """
@@ -1158,7 +1309,8 @@ class LigandPocketDDPM(pl.LightningModule):
         pocket_com_before = scatter_mean(pocket["x"], pocket["mask"], dim=0)
 
         xh_pep, xh_pocket, pep_mask, pocket_mask = self.ddpm.sample_given_pocket(
-            pocket, peptide["one_hot"], peptide["mask"], timesteps=timesteps, return_frames=return_frames
+            pocket, peptide["one_hot"], peptide["mask"], timesteps=timesteps, return_frames=return_frames,
+            sampler=sampler, eta=eta, **kwargs
         )
 
         # Move generated molecule back to the original pocket position
@@ -16,6 +16,7 @@ from rdkit import Chem
 from rdkit.Chem import QED
 from scipy.ndimage import gaussian_filter
 
+from dataset import compute_sample_stats
 from geometry_utils import get_bb_transform
 from analysis.molecule_builder import build_molecule
 import constants
@@ -582,7 +583,9 @@ if __name__ == '__main__':
         np.savez(processed_dir / f'{split}.npz', names=pdb_and_mol_ids,
                  lig_coords=lig_coords, lig_one_hot=lig_one_hot,
                  lig_mask=lig_mask, pocket_c_alpha=pocket_c_alpha,
-                 pocket_one_hot=pocket_one_hot, pocket_mask=pocket_mask)
+                 pocket_one_hot=pocket_one_hot, pocket_mask=pocket_mask,
+                 **compute_sample_stats(lig_coords, lig_mask,
+                                        pocket_c_alpha, pocket_mask))
 
         n_samples_after[split] = len(pdb_and_mol_ids)
         print(f"Processing {split} set took {(time() - tic)/60.0:.2f} minutes")
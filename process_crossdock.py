@@ -18,6 +18,7 @@ from scipy.ndimage import gaussian_filter
 import torch
 
 from analysis.molecule_builder import build_molecule
+from dataset import compute_sample_stats
 import constants
 from constants import covalent_radii, dataset_params
 
@@ -237,7 +238,9 @@ def saveall(filename, pdb_and_mol_ids, lig_coords, lig_one_hot, lig_mask,
         lig_mask=lig_mask,
         pocket_c_alpha=pocket_c_alpha,
         pocket_one_hot=pocket_one_hot,
-        pocket_mask=pocket_mask
+        pocket_mask=pocket_mask,
+        **compute_sample_stats(lig_coords, lig_mask, pocket_c_alpha,
+                               pocket_mask)
     )
     return True
 
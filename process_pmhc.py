@@ -1,83 +1,350 @@
 import argparse
 from collections import defaultdict
+from functools import partial
+import hashlib
+from itertools import islice
 import json
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
 import os
 from pathlib import Path
 import random
 import warnings
 from Bio import BiopythonDeprecationWarning
 
+import h5py
 import numpy as np
 from scipy.ndimage import gaussian_filter
 import torch
+from tqdm import tqdm
 
+from dataset import compute_sample_stats, write_memmap_dataset, ShardWriter
 from dataset_pmhc import (
     get_encoder_decoder,
-    process_pmhc_pdb_file,
-    process_pmhc_hdf5_file,
     encode_types,
+    get_chain_coords_and_types,
+    parse_pmhc_pdb_string,
+    read_hdf5_pdb_string,
+    read_pdb_atoms,
+    read_parsed_structure,
+    write_parsed_structure,
 )
 warnings.simplefilter(action='ignore', category=BiopythonDeprecationWarning)
 
-def process_pmhc_directory(dir_path: Path, atom_level=True, encoder=None, decoder=None, ids_to_keep=None, select_interface=False):
+def list_structures(dir_path: Path, ids_to_keep=None):
+    """
+    List the structures in a directory in a fixed order
+    :param dir_path: directory with pdb and hdf5 files
+    :param ids_to_keep: optional pdb file stems to select
+    :return: list of (file path, hdf5 record name or None) tuples
+    """
+    structures = []
+    for pdb_file in sorted(os.listdir(dir_path)):
+        pdb_path = Path(dir_path, pdb_file)
+        if pdb_path.suffix == ".pdb":
+            if ids_to_keep is not None and pdb_path.stem not in ids_to_keep:
+                continue
+            structures.append((str(pdb_path), None))
+        elif pdb_path.suffix == ".hdf5":
+            with h5py.File(pdb_path, "r") as content:
+                structures.extend((str(pdb_path), name) for name in content.keys())
+    return structures
+
+
+# hdf5 files opened by the current (worker) process
+_hdf5_handles = {}
+
+
+def read_structure(path, record=None):
+    if record is None:
+        return Path(path).read_text()
+    if path not in _hdf5_handles:
+        _hdf5_handles[path] = h5py.File(path, "r")
+    model = _hdf5_handles[path][record]
+    return read_hdf5_pdb_string(model)
+
+
+def close_hdf5_handles():
+    """Close the hdf5 files opened by read_structure in this process"""
+    for handle in _hdf5_handles.values():
+        handle.close()
+    _hdf5_handles.clear()
+
+
+def init_worker():
+    """Pool initializer, the worker closes its hdf5 files when it exits"""
+    Finalize(None, close_hdf5_handles, exitpriority=0)
+
+
+def process_structure(
+    structure, atom_level=True, select_interface=False, cache_dir=None
+):
+    """
+    Parse one structure. Results are cached under the hash of the pdb content
+    and the processing options, so unchanged structures are never parsed
+    twice, even if files are renamed or regrouped.
+    """
+    pdb_string = read_structure(*structure)
+
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha1(pdb_string.encode())
+        key.update(json.dumps([atom_level, select_interface]).encode())
+        cache_path = Path(cache_dir, f"{key.hexdigest()}.npz")
+        if cache_path.exists():
+            return read_parsed_structure(cache_path)
+
+    parsed = parse_pmhc_pdb_string(
+        pdb_string, atom_level=atom_level, select_interface=select_interface
+    )
+    if cache_path is not None:
+        write_parsed_structure(cache_path, parsed)
+    return parsed
+
+
+def read_peptide_sequence(structure, atom_level=True):
+    """
+    Concatenated peptide types of one structure (the key used by
+    group_peptide_sequences), read without processing the MHC chain so that
+    splits can be decided before any structure is processed
+    """
+    pdb_string = read_structure(*structure)
+    try:
+        atoms = read_pdb_atoms(pdb_string)
+    except ValueError:
+        return "".join(parse_pmhc_pdb_string(pdb_string, atom_level)["lig_types"])
+    return "".join(get_chain_coords_and_types(atoms, "P", atom_level=atom_level)[1])
+
+
+def iter_pmhc_structures(
+    structures,
+    atom_level=True,
+    select_interface=False,
+    n_workers=1,
+    cache_dir=None,
+):
+    """
+    Process structures in the given order
+    :param structures: list of (file path, hdf5 record name or None) tuples
+    :param n_workers: number of processes parsing structures
+    :param cache_dir: directory for parsed structures, every finished
+        structure is stored immediately so interrupted runs can be resumed
+    :return: generator of (name, peptide, mhc) tuples, the hdf5 files opened
+        by read_structure (in this process and in the workers) are closed
+        when it is exhausted. If it is closed early, the workers are
+        terminated.
+    """
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    process_fn = partial(
+        process_structure,
+        atom_level=atom_level,
+        select_interface=select_interface,
+        cache_dir=cache_dir,
+    )
+
+    def to_samples(results):
+        for (path, record), parsed in zip(structures, results):
+            peptide = {
+                "x": torch.from_numpy(parsed["lig_coords"]),
+                "types": parsed["lig_types"].tolist(),
+                "size": len(parsed["lig_coords"]),
+            }
+            mhc = {
+                "x": torch.from_numpy(parsed["pocket_c_alpha"]),
+                "types": parsed["pocket_types"].tolist(),
+                "size": len(parsed["pocket_c_alpha"]),
+            }
+            yield Path(path).stem if record is None else record, peptide, mhc
+
+    try:
+        if n_workers > 1:
+            with Pool(n_workers, initializer=init_worker) as pool:
+                # imap keeps the order of the structures
+                yield from to_samples(
+                    pool.imap(process_fn, structures, chunksize=8)
+                )
+                # let the workers exit normally, so that they run
+                # close_hdf5_handles (leaving the block terminates them)
+                pool.close()
+                pool.join()
+        else:
+            yield from to_samples(map(process_fn, structures))
+    finally:
+        close_hdf5_handles()
+
+
+def process_pmhc_directory(
+    dir_path: Path,
+    atom_level=True,
+    encoder=None,
+    decoder=None,
+    ids_to_keep=None,
+    select_interface=False,
+    n_workers=1,
+    cache_dir=None,
+):
     """
     Process the directory to get the peptide and pocket representations
     :param dir_path: the path of the directory
-    :param kwargs: the arguments to pass to process_pmhc_pdb_file
+    :param n_workers: number of processes parsing structures
+    :param cache_dir: directory for parsed structures, every finished
+        structure is stored immediately so interrupted runs can be resumed
     :return: peptide, mhc
     """
-    # encoder, decoder = get_encoder_decoder(dir_path, atom_level=atom_level)
+    structures = list_structures(Path(dir_path), ids_to_keep=ids_to_keep)
+
     peptide_list = []
     mhc_list = []
     types = set()
     complex_names = []
-    for pdb_file in os.listdir(dir_path):
-        pdb_path = dir_path / pdb_file
-        if pdb_path.suffix == ".pdb":
-            if ids_to_keep is not None:
-                if pdb_path.stem not in ids_to_keep:
-                    continue
-            peptide, mhc = process_pmhc_pdb_file(pdb_path, atom_level=atom_level, select_interface=select_interface)
-            peptides = [peptide]
-            mhcs = [mhc]
-            names = [pdb_path.stem]
-            # peptide.append(peptide_)
-            # mhc.append(mhc_)
-            # types.update(peptide_["type"])
-            # types.update(mhc_["type"])
-            # complex_names.append(pdb_path.stem)
-
-        elif pdb_path.suffix == ".hdf5":
-            peptides, mhcs, names = process_pmhc_hdf5_file(
-                pdb_path, atom_level=atom_level, select_interface=select_interface
-            )
-        else:
-            continue
-
-        for peptide, mhc, name in zip(peptides, mhcs, names):
-            complex_names.append(name)
-            peptide_list.append(peptide)
-            mhc_list.append(mhc)
-            types.update(peptide["types"])
-            types.update(mhc["types"])
+    for name, peptide, mhc in tqdm(
+        iter_pmhc_structures(
+            structures,
+            atom_level=atom_level,
+            select_interface=select_interface,
+            n_workers=n_workers,
+            cache_dir=cache_dir,
+        ),
+        total=len(structures),
+    ):
+        complex_names.append(name)
+        peptide_list.append(peptide)
+        mhc_list.append(mhc)
+        types.update(peptide["types"])
+        types.update(mhc["types"])
 
     if encoder is None or decoder is None:
         encoder, decoder = get_encoder_decoder(types)
-    # peptide["one_hot"] = encode_types(pep_types, encoder)
-    # mhc["one_hot"] = encode_types(mhc_types, encoder)
-
-    # peptide["mask"] = torch.repeat_interleave(
-    #     torch.arange(peptide["x"].shape[0]),
-    #     peptide["size"],
-    #  )
-    # mhc["mask"] = torch.repeat_interleave(
-    #     torch.arange(mhc["x"].shape[0]),
-    #     mhc["size"],
-    # )
 
     return peptide_list, mhc_list, encoder, decoder, complex_names
 
 
+def get_split_indices(n, train_frac, val_frac, peptide_sequences=None, seed=42):
+    """
+    Split n complexes into train, val and test
+    :param peptide_sequences: if given, complexes with the same peptide
+        sequence are always added to the same split
+    :return: train, val and test index arrays
+    """
+    if peptide_sequences is not None:
+        # obtain a sequence id per peptide
+        peptide_sequence_idx = get_sequence_idx(peptide_sequences)
+
+        # split train, val and test integers in such a way that it is
+        # random but the same sequence id is not in train and val or test
+        # at the same time
+        return attribute_data_to_splits_selective(
+            peptide_sequence_idx, train_frac, val_frac, seed=seed
+        )
+
+    # randomly split the data into train, val, and test
+    train_size = int(n * train_frac)
+    val_size = int(n * val_frac)
+
+    train_idx = np.random.choice(n, train_size, replace=False)
+    val_idx = np.random.choice(
+        np.setdiff1d(np.arange(n), train_idx), val_size, replace=False
+    )
+    test_idx = np.setdiff1d(np.arange(n), np.concatenate((train_idx, val_idx)))
+    return train_idx, val_idx, test_idx
+
+
+def process_save_pdb_dir_shards(
+    pdb_dir,
+    outdir,
+    atom_level,
+    encoder,
+    shard_size,
+    train_frac=0.6,
+    val_frac=0.2,
+    ids_to_keep=None,
+    select_interface=False,
+    group_sequences=False,
+    seed=42,
+    load_path=None,
+    n_workers=1,
+    cache_dir=None,
+):
+    """
+    Write every split as a directory of shards. Splits are decided from the
+    structure names (and peptide sequences if group_sequences is set) before
+    any structure is processed, then the processed structures are streamed
+    split by split into a ShardWriter, so at most one shard is held in
+    memory.
+    """
+    if load_path is None:
+        structures = list_structures(Path(pdb_dir), ids_to_keep=ids_to_keep)
+        n = len(structures)
+        peptide_sequences = None
+        if group_sequences:
+            sequence_fn = partial(read_peptide_sequence, atom_level=atom_level)
+            if n_workers > 1:
+                with Pool(n_workers, initializer=init_worker) as pool:
+                    peptide_sequences = pool.map(sequence_fn, structures, chunksize=8)
+                    pool.close()
+                    pool.join()
+            else:
+                peptide_sequences = list(map(sequence_fn, structures))
+                close_hdf5_handles()
+    else:
+        with open(load_path, "rb") as f:
+            datadict = torch.load(f)
+        n = len(datadict["peptides"])
+        peptide_sequences = None
+        if group_sequences:
+            peptide_sequences = [
+                "".join(peptide["types"]) for peptide in datadict["peptides"]
+            ]
+
+    split_idx = get_split_indices(
+        n, train_frac, val_frac, peptide_sequences=peptide_sequences, seed=seed
+    )
+    order = np.concatenate(split_idx)
+
+    # complexes are processed in split order, so every split is a contiguous
+    # part of the stream
+    if load_path is None:
+        samples = iter_pmhc_structures(
+            [structures[i] for i in order],
+            atom_level=atom_level,
+            select_interface=select_interface,
+            n_workers=n_workers,
+            cache_dir=cache_dir,
+        )
+    else:
+        samples = (
+            (datadict["names"][i], datadict["peptides"][i], datadict["mhcs"][i])
+            for i in order
+        )
+    samples = iter(tqdm(samples, total=n))
+
+    lig_sizes = []
+    pocket_sizes = []
+    for idx, split in zip(split_idx, ["train", "val", "test"]):
+        with ShardWriter(Path(outdir) / split, shard_size=shard_size) as writer:
+            for name, peptide, mhc in islice(samples, len(idx)):
+                writer.add(
+                    name,
+                    lig_coords=peptide["x"].numpy(),
+                    lig_one_hot=encode_types(peptide["types"], encoder).numpy(),
+                    pocket_c_alpha=mhc["x"].numpy(),
+                    pocket_one_hot=encode_types(mhc["types"], encoder).numpy(),
+                )
+                lig_sizes.append(peptide["size"])
+                pocket_sizes.append(mhc["size"])
+        print(f"{split} set: {len(idx)} complexes in {len(writer.shards)} shards")
+
+    sample_idx = np.arange(n)
+    n_nodes = get_n_nodes(
+        np.repeat(sample_idx, lig_sizes),
+        np.repeat(sample_idx, pocket_sizes),
+        smooth_sigma=1.0,
+    )
+    np.save(Path(outdir, "size_distribution.npy"), n_nodes)
+
+
 def process_save_pdb_dir(
     pdb_dir,
     outdir,
@@ -91,6 +358,10 @@ def process_save_pdb_dir(
     seed=42,
     save_path=None,
     load_path=None,
+    memmap=False,
+    shard_size=None,
+    n_workers=1,
+    cache_dir=None,
 ):
     input_encoder = None
     input_decoder = None
@@ -100,6 +371,35 @@ def process_save_pdb_dir(
         with open(Path(encoder_decoder_dir) / "decoder.json", "r") as f:
             input_decoder = json.load(f)
 
+    if shard_size is not None:
+        if input_encoder is None or input_decoder is None:
+            raise ValueError("shard_size requires encoder_decoder_dir")
+        if save_path is not None:
+            raise ValueError(
+                "save_path keeps all complexes in memory and cannot be "
+                "combined with shard_size"
+            )
+        for name, coder in [("encoder", input_encoder), ("decoder", input_decoder)]:
+            with open(Path(outdir) / f"{name}.json", "w") as f:
+                json.dump(coder, f)
+        process_save_pdb_dir_shards(
+            pdb_dir,
+            outdir,
+            atom_level,
+            input_encoder,
+            shard_size,
+            train_frac=train_frac,
+            val_frac=val_frac,
+            ids_to_keep=ids_to_keep,
+            select_interface=select_interface,
+            group_sequences=group_sequences,
+            seed=seed,
+            load_path=load_path,
+            n_workers=n_workers,
+            cache_dir=cache_dir,
+        )
+        return
+
     if load_path is None:    
         peptides, mhcs, encoder, decoder, names = process_pmhc_directory(
             Path(pdb_dir),
@@ -108,6 +408,8 @@ def process_save_pdb_dir(
             decoder=input_decoder,
             ids_to_keep=ids_to_keep,
             select_interface=select_interface,
+            n_workers=n_workers,
+            cache_dir=cache_dir,
         )
     else:
         with open(load_path, "rb") as f:
@@ -135,27 +437,17 @@ def process_save_pdb_dir(
             torch.save(savedict, f)
 
     n = len(peptides)
-    if group_sequences:
-        # obtain a sequence id per peptide
-        peptide_sequence_idx = group_peptide_sequences(peptides)
-
-        # split train, val and test integers in such a way that it is
-        # random but the same sequence id is not in train and val or test
-        # at the same time
-        train_idx, val_idx, test_idx = attribute_data_to_splits_selective(
-            peptide_sequence_idx, train_frac, val_frac, seed=seed
-        )
-    else:
-        # randomly split the data into train, val, and test
-        n = len(peptides)
-        train_size = int(n * train_frac)
-        val_size = int(n * val_frac)
-
-        train_idx = np.random.choice(n, train_size, replace=False)
-        val_idx = np.random.choice(
-            np.setdiff1d(np.arange(n), train_idx), val_size, replace=False
-        )
-        test_idx = np.setdiff1d(np.arange(n), np.concatenate((train_idx, val_idx)))
+    train_idx, val_idx, test_idx = get_split_indices(
+        n,
+        train_frac,
+        val_frac,
+        peptide_sequences=(
+            ["".join(peptide["types"]) for peptide in peptides]
+            if group_sequences
+            else None
+        ),
+        seed=seed,
+    )
 
     for idx, split in zip(
         [train_idx, val_idx, test_idx, np.arange(n)], ["train", "val", "test", "all"]
@@ -173,9 +465,7 @@ def process_save_pdb_dir(
         )
         split_names = [names[i] for i in idx]
 
-        np.savez(
-            path,
-            names=split_names,
+        arrays = dict(
             lig_coords=peptide["x"],
             lig_one_hot=pep_one_hot.numpy(),
             lig_mask=pep_mask,
@@ -183,6 +473,12 @@ def process_save_pdb_dir(
             pocket_one_hot=mhc_one_hot.numpy(),
             pocket_mask=mhc_mask,
         )
+        stats = compute_sample_stats(
+            arrays["lig_coords"], pep_mask, arrays["pocket_c_alpha"], mhc_mask
+        )
+        np.savez(path, names=split_names, **arrays, **stats)
+        if memmap:
+            write_memmap_dataset(path.with_suffix(""), split_names, **arrays)
         if split == "all":
             n_nodes = get_n_nodes(pep_mask, mhc_mask, smooth_sigma=1.0)
             np.save(Path(outdir, "size_distribution.npy"), n_nodes)
@@ -205,13 +501,20 @@ def process_save_pdb_dir(
 
 
 def combine_samples(peptides, mhcs, idx):
+    def concat_coords(samples):
+        # an empty split (e.g. val_frac=0) has no coordinates
+        coords = [samples[i]["x"].numpy() for i in idx]
+        if len(coords) == 0:
+            return np.zeros((0, 3), dtype=samples[0]["x"].numpy().dtype)
+        return np.concatenate(coords, axis=0)
+
     peptide = {
-        "x": np.concatenate([peptides[i]["x"].numpy() for i in idx], axis=0),
+        "x": concat_coords(peptides),
         "types": [node for i in idx for node in peptides[i]["types"]],
         "size": [peptides[i]["size"] for i in idx],
     }
     mhc = {
-        "x": np.concatenate([mhcs[i]["x"].numpy() for i in idx], axis=0),
+        "x": concat_coords(mhcs),
         "types": [node for i in idx for node in mhcs[i]["types"]],
         "size": [mhcs[i]["size"] for i in idx],
     }
@@ -260,7 +563,12 @@ def group_peptide_sequences(peptides):
     so that they can be added to the same split to prevent
     data leakage.
     """
-    peptide_sequences = ["".join(pep["types"]) for pep in peptides]
+    return get_sequence_idx(["".join(pep["types"]) for pep in peptides])
+
+def get_sequence_idx(peptide_sequences):
+    """
+    Same as group_peptide_sequences for the concatenated peptide types
+    """
     unique_sequences = np.unique(peptide_sequences)
     sequence_to_idx = {seq: i for i, seq in enumerate(unique_sequences)}
     peptide_idx = [sequence_to_idx[seq] for seq in peptide_sequences]
@@ -291,7 +599,11 @@ def attribute_data_to_splits(group_indices, train_fraction, val_fraction, seed=4
         else:
             test_indices += group_data[group_id]
 
-    return np.array(train_indices), np.array(val_indices), np.array(test_indices)
+    return (
+        np.array(train_indices, dtype=int),
+        np.array(val_indices, dtype=int),
+        np.array(test_indices, dtype=int),
+    )
 
 def attribute_data_to_splits_selective(group_indices, train_fraction, val_fraction, allowed_spillover=100, seed=42):
     """
@@ -343,7 +655,11 @@ def attribute_data_to_splits_selective(group_indices, train_fraction, val_fracti
             else:
                 test_indices += group_data[group_id]
 
-    return np.array(train_indices), np.array(val_indices), np.array(test_indices)
+    return (
+        np.array(train_indices, dtype=int),
+        np.array(val_indices, dtype=int),
+        np.array(test_indices, dtype=int),
+    )
 
 
 if __name__ == "__main__":
@@ -362,6 +678,29 @@ if __name__ == "__main__":
     parser.add_argument("--val_fraction", type=float, default=0.2)
     parser.add_argument("--save_path", type=Path, default=None)
     parser.add_argument("--load_path", type=Path, default=None)
+    parser.add_argument(
+        "--memmap",
+        action="store_true",
+        default=False,
+        help="also write every split as memory-mappable directory",
+    )
+    parser.add_argument(
+        "--n_workers", type=int, default=1, help="number of parsing processes"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=Path,
+        default=None,
+        help="cache for parsed structures, re-runs only parse new or changed "
+        "structures",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=None,
+        help="write every split as directory of shards with this many "
+        "complexes instead of .npz files",
+    )
     args = parser.parse_args()
 
     random.seed(args.seed)
@@ -385,4 +724,8 @@ if __name__ == "__main__":
         val_frac=args.val_fraction,
         save_path=args.save_path,
         load_path=args.load_path,
+        memmap=args.memmap,
+        shard_size=args.shard_size,
+        n_workers=args.n_workers,
+        cache_dir=args.cache_dir,
     )
\ No newline at end of file
@@ -1,5 +1,8 @@
 import argparse
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
 from pathlib import Path
 from time import time
 
@@ -8,13 +11,229 @@ from rdkit import Chem
 from tqdm import tqdm
 
 from lightning_modules import LigandPocketDDPM
-from analysis.molecule_builder import process_molecule
+from analysis.postprocessing import get_postprocessor
 import utils
 
-MAXITER = 10
+MAXITER = 10  # budget of full batches (args.batch_size molecules) per pocket
 MAXNTRIES = 3
 
 
+class PocketSampling:
+    """
+    Sampling state of one test pocket. Several pockets can be in flight at
+    the same time: the next pocket is sampled while the last batches of the
+    previous one are still being post-processed.
+    """
+    def __init__(self, sdf_file, n_try, fix_n_nodes):
+        self.sdf_file = sdf_file
+        self.n_try = n_try
+        self.t_start = time()
+
+        txt_file = Path(sdf_file.parent, f"{sdf_file.stem}.txt")
+        with open(txt_file, 'r') as f:
+            self.resi_list = f.read().split()
+
+        pdb_name, pocket_id, *suffix = sdf_file.stem.split('_')
+        self.pdb_file = Path(sdf_file.parent, f"{pdb_name}.pdb")
+
+        if fix_n_nodes:
+            # some ligands (e.g. 6JWS_bio1_PT1:A:801) could not be read with sanitize=True
+            suppl = Chem.SDMolSupplier(str(sdf_file), sanitize=False)
+            self.num_nodes_lig = suppl[0].GetNumAtoms()
+        else:
+            self.num_nodes_lig = None
+
+        self.all_molecules = []
+        self.valid_molecules = []
+        self.processed_molecules = []  # only used as temporary variable
+        self.n_sampled = 0  # including batches that are still processed
+        self.n_pending = 0
+        self.n_generated = 0
+        self.n_valid = 0
+
+    def n_requested(self, n_samples, default_validity, validity_margin):
+        """
+        Number of molecules to sample such that the expected number of valid
+        ones reaches n_samples, given the batches that are still pending.
+        The estimate is multiplied by validity_margin.
+        """
+        validity = self.n_valid / self.n_generated if self.n_generated > 0 \
+            else default_validity
+        n_missing = n_samples - len(self.valid_molecules)
+        n_expected = validity * self.n_pending
+        if n_missing <= n_expected:
+            return 0
+        return ceil((n_missing - n_expected) / max(validity, 1e-3)
+                    * validity_margin)
+
+    def add_batch(self, batch_size, mols_batch, mols_batch_processed,
+                  n_samples):
+        """Returns the number of valid molecules in the batch."""
+        self.all_molecules.extend(mols_batch)
+        self.processed_molecules.extend(mols_batch_processed)
+        valid_mols_batch = [m for m in mols_batch_processed if m is not None]
+
+        self.n_pending -= batch_size
+        self.n_generated += batch_size
+        self.n_valid += len(valid_mols_batch)
+        # batches sampled ahead may not be needed anymore
+        n_keep = max(0, n_samples - len(self.valid_molecules))
+        self.valid_molecules.extend(valid_mols_batch[:n_keep])
+        return len(valid_mols_batch)
+
+    def done(self, n_samples):
+        return len(self.valid_molecules) >= n_samples and self.n_pending == 0
+
+    def write(self, sdf_out_file_raw, sdf_out_file_processed, time_file):
+        """Writes the SDF files and returns the time spent on this pocket."""
+        # Reorder raw files
+        all_molecules = \
+            [self.all_molecules[i] for i, m in
+             enumerate(self.processed_molecules) if m is not None] + \
+            [self.all_molecules[i] for i, m in
+             enumerate(self.processed_molecules) if m is None]
+
+        # Write SDF files
+        utils.write_sdf_file(sdf_out_file_raw, all_molecules)
+        utils.write_sdf_file(sdf_out_file_processed, self.valid_molecules)
+
+        # Time the sampling process
+        time_pocket = time() - self.t_start
+        with open(time_file, 'w') as f:
+            f.write(f"{str(self.sdf_file)} {time_pocket}")
+        return time_pocket
+
+
+def get_out_files(outdir, sdf_file):
+    return (Path(outdir, 'raw', f'{sdf_file.stem}_gen.sdf'),
+            Path(outdir, 'processed', f'{sdf_file.stem}_gen.sdf'),
+            Path(outdir, 'pocket_times', f'{sdf_file.stem}.txt'))
+
+
+def sample_test_set(model, test_files, args):
+    """
+    Samples args.n_samples valid molecules for every test pocket and writes
+    them to the raw/, processed/ and pocket_times/ directories of
+    args.outdir. The batch sizes only depend on the molecules that have been
+    post-processed, not on how fast, so the output does not depend on
+    args.n_workers.
+    Returns:
+        dict with the time spent on every pocket
+    """
+    # With n_workers <= 1 the molecules are post-processed in a background
+    # thread, otherwise in a process pool
+    postprocessor = get_postprocessor(args.n_workers, background=True)
+
+    # SDF files are written in the background while sampling continues
+    writer = ThreadPoolExecutor(max_workers=1)
+
+    pbar = tqdm(total=len(test_files))
+    time_per_pocket = {}
+    todo = deque()  # (sdf_file, n_try)
+    for sdf_file in test_files:
+        sdf_out_file_raw, sdf_out_file_processed, time_file = \
+            get_out_files(args.outdir, sdf_file)
+
+        if args.skip_existing and time_file.exists() \
+                and sdf_out_file_processed.exists() \
+                and sdf_out_file_raw.exists():
+
+            with open(time_file, 'r') as f:
+                time_per_pocket[str(sdf_file)] = float(f.read().split()[1])
+
+            pbar.update()
+            continue
+
+        todo.append((sdf_file, 0))
+
+    active = []  # pockets that are sampled or post-processed, in order
+    pending = deque()  # (pocket, batch size, PendingMolecules), in order
+    writes = deque()  # (pocket, future) of the SDF files being written
+    n_generated_total = 0
+    n_valid_total = 0
+    while todo or active or writes:
+        # Finished writes, wait for them only if there is nothing else to do
+        if writes and (writes[0][1].done() or not (todo or active)):
+            pocket, future = writes.popleft()
+            try:
+                time_per_pocket[str(pocket.sdf_file)] = future.result()
+            except RuntimeError as e:
+                if pocket.n_try >= MAXNTRIES - 1:
+                    raise e
+                warnings.warn(f"Attempt {pocket.n_try + 1}/{MAXNTRIES} failed "
+                              f"with error: '{e}'. Trying again...")
+                todo.appendleft((pocket.sdf_file, pocket.n_try + 1))
+                continue
+
+            time_pocket = time_per_pocket[str(pocket.sdf_file)]
+            pbar.update()
+            pbar.set_description(
+                f'Last processed: {pocket.sdf_file.stem}. '
+                f'Validity: {pocket.n_valid / pocket.n_generated * 100:.2f}%. '
+                f'{time_pocket / len(pocket.valid_molecules):.2f} sec/mol.')
+            continue
+
+        # First pocket (in order) that still needs molecules
+        default_validity = n_valid_total / n_generated_total \
+            if n_generated_total > 0 else 1.0
+        pocket, n_requested = None, 0
+        for p in active:
+            n_requested = p.n_requested(args.n_samples, default_validity,
+                                        args.validity_margin)
+            if n_requested > 0:
+                pocket = p
+                break
+
+        if pocket is not None and len(pending) < args.max_pending:
+            # Sample just enough molecules for the observed validity, but
+            # not less than a quarter batch. The budget of MAXITER full
+            # batches is shared by all batches of the pocket.
+            n_remaining = MAXITER * args.batch_size - pocket.n_sampled
+            if n_remaining <= 0:
+                raise RuntimeError('Maximum number of iterations has been exceeded.')
+            batch_size = min(args.batch_size, n_remaining,
+                             max(args.batch_size // 4, n_requested))
+
+            num_nodes_lig_inflated = None if pocket.num_nodes_lig is None \
+                else torch.ones(batch_size, dtype=int) * pocket.num_nodes_lig
+
+            # Raw and filtered molecules are built by the postprocessor
+            pending.append((pocket, batch_size, model.generate_ligands(
+                pocket.pdb_file, batch_size, pocket.resi_list,
+                num_nodes_lig=num_nodes_lig_inflated,
+                sanitize=args.sanitize, largest_frag=not args.all_frags,
+                relax_iter=(200 if args.relax else 0),
+                resamplings=args.resamplings, jump_length=args.jump_length,
+                postprocessor=postprocessor, wait=False)))
+            pocket.n_sampled += batch_size
+            pocket.n_pending += batch_size
+            continue
+
+        if pocket is None and todo:
+            # All active pockets have enough molecules in flight, start
+            # sampling the next one
+            active.append(PocketSampling(*todo.popleft(), args.fix_n_nodes))
+            continue
+
+        # Collect the oldest batch, waiting for it if necessary
+        pocket, batch_size, pending_batch = pending.popleft()
+        mols_batch, mols_batch_processed = pending_batch.get()
+        n_valid_batch = pocket.add_batch(
+            batch_size, mols_batch, mols_batch_processed, args.n_samples)
+        n_generated_total += batch_size
+        n_valid_total += n_valid_batch
+
+        if pocket.done(args.n_samples):
+            active.remove(pocket)
+            writes.append((pocket, writer.submit(
+                pocket.write, *get_out_files(args.outdir, pocket.sdf_file))))
+
+    writer.shutdown()
+    postprocessor.close()
+    pbar.close()
+    return time_per_pocket
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('checkpoint', type=Path)
@@ -30,17 +249,22 @@ if __name__ == "__main__":
     parser.add_argument('--resamplings', type=int, default=1)
     parser.add_argument('--jump_length', type=int, default=1)
     parser.add_argument('--skip_existing', action='store_true')
+    parser.add_argument('--n_workers', type=int, default=0,
+                        help='processes for building and filtering molecules, '
+                             'with 0 or 1 they run in a background thread')
+    parser.add_argument('--max_pending', type=int, default=2,
+                        help='batches that are post-processed while the next '
+                             'one is sampled')
+    parser.add_argument('--validity_margin', type=float, default=1.2,
+                        help='factor by which the adaptive batch size exceeds '
+                             'the number of molecules expected to be needed')
     args = parser.parse_args()
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     args.outdir.mkdir(exist_ok=args.skip_existing)
-    raw_sdf_dir = Path(args.outdir, 'raw')
-    raw_sdf_dir.mkdir(exist_ok=args.skip_existing)
-    processed_sdf_dir = Path(args.outdir, 'processed')
-    processed_sdf_dir.mkdir(exist_ok=args.skip_existing)
-    times_dir = Path(args.outdir, 'pocket_times')
-    times_dir.mkdir(exist_ok=args.skip_existing)
+    for subdir in ['raw', 'processed', 'pocket_times']:
+        Path(args.outdir, subdir).mkdir(exist_ok=args.skip_existing)
 
     # Load model
     model = LigandPocketDDPM.load_from_checkpoint(
@@ -53,117 +277,12 @@ if __name__ == "__main__":
             test_list = set(f.read().split(','))
         test_files = [x for x in test_files if x.stem in test_list]
 
-    pbar = tqdm(test_files)
-    time_per_pocket = {}
-    for sdf_file in pbar:
-        ligand_name = sdf_file.stem
-
-        pdb_name, pocket_id, *suffix = ligand_name.split('_')
-        pdb_file = Path(sdf_file.parent, f"{pdb_name}.pdb")
-        txt_file = Path(sdf_file.parent, f"{ligand_name}.txt")
-        sdf_out_file_raw = Path(raw_sdf_dir, f'{ligand_name}_gen.sdf')
-        sdf_out_file_processed = Path(processed_sdf_dir,
-                                      f'{ligand_name}_gen.sdf')
-        time_file = Path(times_dir, f'{ligand_name}.txt')
-
-        if args.skip_existing and time_file.exists() \
-                and sdf_out_file_processed.exists() \
-                and sdf_out_file_raw.exists():
-
-            with open(time_file, 'r') as f:
-                time_per_pocket[str(sdf_file)] = float(f.read().split()[1])
-
-            continue
-
-        for n_try in range(MAXNTRIES):
-
-            t_pocket_start = time()
-
-            with open(txt_file, 'r') as f:
-                resi_list = f.read().split()
-
-            if args.fix_n_nodes:
-                # some ligands (e.g. 6JWS_bio1_PT1:A:801) could not be read with sanitize=True
-                suppl = Chem.SDMolSupplier(str(sdf_file), sanitize=False)
-                num_nodes_lig = suppl[0].GetNumAtoms()
-            else:
-                num_nodes_lig = None
-
-            all_molecules = []
-            valid_molecules = []
-            processed_molecules = []  # only used as temporary variable
-            iter = 0
-            n_generated = 0
-            n_valid = 0
-            while len(valid_molecules) < args.n_samples:
-                iter += 1
-                if iter > MAXITER:
-                    raise RuntimeError('Maximum number of iterations has been exceeded.')
-
-                num_nodes_lig_inflated = None if num_nodes_lig is None else \
-                    torch.ones(args.batch_size, dtype=int) * num_nodes_lig
-
-                # Turn all filters off first
-                mols_batch = model.generate_ligands(
-                    pdb_file, args.batch_size, resi_list,
-                    num_nodes_lig=num_nodes_lig_inflated, sanitize=False,
-                    largest_frag=False, relax_iter=0,
-                    resamplings=args.resamplings, jump_length=args.jump_length)
-
-                all_molecules.extend(mols_batch)
-
-                # Filter to find valid molecules
-                mols_batch_processed = [
-                    process_molecule(m, sanitize=args.sanitize,
-                                     relax_iter=(200 if args.relax else 0),
-                                     largest_frag=not args.all_frags)
-                    for m in mols_batch
-                ]
-                processed_molecules.extend(mols_batch_processed)
-                valid_mols_batch = [m for m in mols_batch_processed if m is not None]
-
-                n_generated += args.batch_size
-                n_valid += len(valid_mols_batch)
-                valid_molecules.extend(
-                    valid_mols_batch[:min(len(valid_mols_batch),
-                                          args.n_samples - len(valid_molecules))]
-                )
-
-            # Reorder raw files
-            all_molecules = \
-                [all_molecules[i] for i, m in enumerate(processed_molecules)
-                 if m is not None] + \
-                [all_molecules[i] for i, m in enumerate(processed_molecules)
-                 if m is None]
-
-            try:
-                # Write SDF files
-                utils.write_sdf_file(sdf_out_file_raw, all_molecules)
-                utils.write_sdf_file(sdf_out_file_processed, valid_molecules)
-
-                # Time the sampling process
-                time_per_pocket[str(sdf_file)] = time() - t_pocket_start
-                with open(time_file, 'w') as f:
-                    f.write(f"{str(sdf_file)} {time_per_pocket[str(sdf_file)]}")
-
-                pbar.set_description(
-                    f'Last processed: {ligand_name}. '
-                    f'Validity: {n_valid / n_generated * 100:.2f}%. '
-                    f'{(time() - t_pocket_start) / len(valid_molecules):.2f} '
-                    f'sec/mol.')
-
-                break  # no more tries needed
-
-            except RuntimeError as e:
-                if n_try >= MAXNTRIES - 1:
-                    raise e
-                warnings.warn(f"Attempt {n_try + 1}/{MAXNTRIES} failed with "
-                              f"error: '{e}'. Trying again...")
+    time_per_pocket = sample_test_set(model, test_files, args)
 
     with open(Path(args.outdir, 'pocket_times.txt'), 'w') as f:
         for k, v in time_per_pocket.items():
             f.write(f"{k} {v}\n")
 
     times_arr = torch.tensor([x for x in time_per_pocket.values()])
-    print(f"Time per pocket: {times_arr.mean():.3f} \pm "
+    print(f"Time per pocket: {times_arr.mean():.3f} \\pm "
           f"{times_arr.std(unbiased=False):.2f}")
@@ -11,7 +11,7 @@ from rdkit import Chem
 from tqdm import tqdm
 
 from lightning_modules import LigandPocketDDPM
-from dataset import ProcessedLigandPocketDataset
+from dataset import load_processed_dataset
 from equivariant_diffusion.en_diffusion import DistributionNodes
 
 MAXITER = 10
@@ -26,6 +26,9 @@ if __name__ == "__main__":
     parser.add_argument("--outdir", type=Path, required=True)
     parser.add_argument("--testfile", type=str, default="test.npz")
     parser.add_argument("--timesteps", type=int, default=None)
+    parser.add_argument("--sampler", type=str, default="ddpm", choices=["ddpm", "ddim", "dpm2", "dpm3"])
+    parser.add_argument("--eta", type=float, default=0.0)
+    parser.add_argument("--spacing", type=str, default="uniform", choices=["uniform", "quadratic", "logsnr"])
     parser.add_argument("--n_samples", type=int, default=None)
     parser.add_argument("--batch_size", type=int, default=None)
     parser.add_argument("--n_time_batches", type=int, default=None)
@@ -50,7 +53,7 @@ if __name__ == "__main__":
     )
     model = model.to(device)
 
-    test_dataset = ProcessedLigandPocketDataset(Path(args.datadir, args.testfile))
+    test_dataset = load_processed_dataset(Path(args.datadir, args.testfile))
     model.test_dataset = test_dataset
 
     histogram_file = Path(args.datadir, "size_distribution.npy")
@@ -67,4 +70,7 @@ if __name__ == "__main__":
     model.test_batch_size = args.batch_size
     model.test_n_samples = args.n_samples
     model.test_n_time_batches = args.n_time_batches
+    model.test_sampler = args.sampler
+    model.test_eta = args.eta
+    model.test_spacing = args.spacing
     trainer.test(model)
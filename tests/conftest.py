@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# the repository is not installed as a package, scripts import modules from
+# its root directory
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,405 @@
+import json
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from convert_dataset import convert_npz_dataset
+from dataset import (
+    SAMPLE_STATS,
+    MemmapLigandPocketDataset,
+    ProcessedLigandPocketDataset,
+    ShardedLigandPocketDataset,
+    ShardShuffleSampler,
+    ShardWriter,
+    SizeBucketBatchSampler,
+    compute_sample_stats,
+    get_offsets,
+    load_processed_dataset,
+    write_memmap_dataset,
+)
+
+FIELDS = ("lig_coords", "lig_one_hot", "lig_mask",
+          "pocket_c_alpha", "pocket_one_hot", "pocket_mask")
+
+
+def random_split(n_samples=12, n_types=4, seed=0):
+    """Fields of a processed split with varying ligand and pocket sizes."""
+    rng = np.random.default_rng(seed)
+    num_lig_atoms = rng.integers(1, 10, n_samples)
+    num_pocket_nodes = rng.integers(1, 30, n_samples)
+    lig_mask = np.repeat(np.arange(n_samples), num_lig_atoms)
+    pocket_mask = np.repeat(np.arange(n_samples), num_pocket_nodes)
+    # samples far from the origin, so that missing centering is visible
+    offset = rng.normal(scale=50.0, size=(n_samples, 3))
+    return {
+        "names": np.array([f"complex_{i}" for i in range(n_samples)]),
+        "lig_coords": (rng.normal(size=(len(lig_mask), 3))
+                       + offset[lig_mask]).astype(np.float32),
+        "lig_one_hot": np.eye(n_types, dtype=np.float32)[
+            rng.integers(n_types, size=len(lig_mask))],
+        "lig_mask": lig_mask,
+        "pocket_c_alpha": (rng.normal(size=(len(pocket_mask), 3))
+                           + offset[pocket_mask]).astype(np.float32),
+        "pocket_one_hot": np.eye(n_types, dtype=np.float32)[
+            rng.integers(n_types, size=len(pocket_mask))],
+        "pocket_mask": pocket_mask,
+    }
+
+
+def reference_items(data, center):
+    """Per-sample split and centering as done by the original loader."""
+    n_samples = len(data["names"])
+    items = []
+    for i in range(n_samples):
+        item = {"names": str(data["names"][i])}
+        for key in FIELDS:
+            mask = data["lig_mask"] if "lig" in key else data["pocket_mask"]
+            item[key] = torch.from_numpy(data[key][mask == i])
+        if center:
+            mean = (item["lig_coords"].sum(0) + item["pocket_c_alpha"].sum(0)) / (
+                len(item["lig_coords"]) + len(item["pocket_c_alpha"]))
+            item["lig_coords"] = item["lig_coords"] - mean
+            item["pocket_c_alpha"] = item["pocket_c_alpha"] - mean
+        item["num_lig_atoms"] = len(item["lig_mask"])
+        item["num_pocket_nodes"] = len(item["pocket_mask"])
+        items.append(item)
+    return items
+
+
+def assert_items_equal(dataset, expected, exact_masks=True):
+    assert len(dataset) == len(expected)
+    for i, ref in enumerate(expected):
+        item = dataset[i]
+        assert item.keys() == ref.keys()
+        for key, value in ref.items():
+            if "mask" in key and not exact_masks:
+                # only the sizes are used, collate_fn rebuilds the masks
+                assert len(item[key]) == len(value), key
+            elif isinstance(value, torch.Tensor):
+                assert item[key].dtype == value.dtype, key
+                assert torch.allclose(item[key], value, atol=1e-5), key
+            else:
+                assert item[key] == value, key
+
+
+@pytest.fixture
+def split():
+    return random_split()
+
+
+@pytest.fixture
+def npz_path(split, tmp_path):
+    np.savez(tmp_path / "train.npz", **split)
+    return tmp_path / "train.npz"
+
+
+@pytest.fixture
+def memmap_dir(split, tmp_path):
+    data = dict(split)
+    names = data.pop("names")
+    write_memmap_dataset(tmp_path / "train", names, **data)
+    return tmp_path / "train"
+
+
+@pytest.mark.parametrize("center", [True, False])
+def test_memmap_items_match_reference(split, memmap_dir, center):
+    dataset = MemmapLigandPocketDataset(memmap_dir, center=center)
+    assert_items_equal(dataset, reference_items(split, center))
+    # repeated access is not centered twice
+    assert_items_equal(dataset, reference_items(split, center))
+
+
+def test_npz_path_resolves_to_memmap_dir(memmap_dir):
+    dataset = load_processed_dataset(memmap_dir.with_suffix(".npz"))
+    assert isinstance(dataset, MemmapLigandPocketDataset)
+
+
+def test_memmap_files_are_never_written(split, memmap_dir):
+    dataset = MemmapLigandPocketDataset(memmap_dir, center=False)
+    item = dataset[3]
+    # copy-on-write mapping: in-place changes stay private to the process
+    item["lig_coords"] += 100.0
+    item["pocket_c_alpha"].zero_()
+
+    assert np.array_equal(np.load(memmap_dir / "lig_coords.npy"),
+                          split["lig_coords"])
+    assert np.array_equal(np.load(memmap_dir / "pocket_c_alpha.npy"),
+                          split["pocket_c_alpha"])
+    fresh = MemmapLigandPocketDataset(memmap_dir, center=True)
+    assert_items_equal(fresh, reference_items(split, center=True))
+
+
+def test_offsets():
+    assert get_offsets(np.array([0, 0, 0, 1, 2, 2])).tolist() == [0, 3, 4, 6]
+    assert get_offsets(np.zeros(0, dtype=int)).tolist() == [0]
+
+
+@pytest.mark.parametrize("center", [True, False])
+def test_npz_items_match_reference(split, npz_path, center):
+    dataset = ProcessedLigandPocketDataset(npz_path, center=center)
+    assert_items_equal(dataset, reference_items(split, center))
+    assert_items_equal(dataset, reference_items(split, center))
+
+
+def test_npz_items_are_views(npz_path):
+    dataset = ProcessedLigandPocketDataset(npz_path)
+    # one contiguous tensor per field instead of per-sample tensors
+    assert all(isinstance(v, torch.Tensor) for v in dataset.data.values())
+    item = dataset[5]
+    for key in FIELDS:
+        assert (item[key].untyped_storage().data_ptr()
+                == dataset.data[key].untyped_storage().data_ptr()), key
+
+
+def test_converted_split_matches_npz(split, npz_path):
+    out_dir = convert_npz_dataset(npz_path)
+    assert out_dir == npz_path.with_suffix("")
+    # the converted directory takes precedence over the .npz file
+    dataset = load_processed_dataset(npz_path)
+    assert isinstance(dataset, MemmapLigandPocketDataset)
+    for center in (True, False):
+        assert_items_equal(load_processed_dataset(out_dir, center=center),
+                           reference_items(split, center))
+
+
+def reference_stats(data):
+    stats = {key: [] for key in SAMPLE_STATS}
+    for i in range(len(data["names"])):
+        x = np.concatenate((data["lig_coords"][data["lig_mask"] == i],
+                            data["pocket_c_alpha"][data["pocket_mask"] == i]))
+        center_of_mass = x.mean(0)
+        stats["center_of_mass"].append(center_of_mass)
+        stats["num_lig_atoms"].append((data["lig_mask"] == i).sum())
+        stats["num_pocket_nodes"].append((data["pocket_mask"] == i).sum())
+        stats["radius_of_gyration"].append(
+            np.sqrt(((x - center_of_mass) ** 2).sum(1).mean()))
+    return {key: np.array(value) for key, value in stats.items()}
+
+
+def assert_stats_equal(stats, expected):
+    assert stats.keys() == expected.keys()
+    for key, value in expected.items():
+        assert np.allclose(stats[key], value, atol=1e-4), key
+
+
+def test_sample_stats_match_per_sample_loop(split):
+    stats = compute_sample_stats(split["lig_coords"], split["lig_mask"],
+                                 split["pocket_c_alpha"], split["pocket_mask"])
+    assert_stats_equal(stats, reference_stats(split))
+    assert stats["center_of_mass"].dtype == np.float32
+
+
+def test_stats_are_stored_and_loaded(split, npz_path, memmap_dir):
+    expected = reference_stats(split)
+    assert_stats_equal(ProcessedLigandPocketDataset(npz_path).stats, expected)
+    assert_stats_equal(MemmapLigandPocketDataset(memmap_dir).stats, expected)
+    with np.load(memmap_dir / "stats.npz") as f:
+        assert_stats_equal(dict(f), expected)
+
+
+@pytest.mark.parametrize("backend", ["npz", "memmap"])
+def test_centering_uses_stored_stats(split, tmp_path, backend):
+    # shifted centers of mass must be used as stored, not recomputed
+    shift = np.arange(len(split["names"]) * 3, dtype=np.float32).reshape(-1, 3)
+    stats = reference_stats(split)
+    stats["center_of_mass"] = (stats["center_of_mass"] + shift).astype(np.float32)
+
+    if backend == "npz":
+        np.savez(tmp_path / "stats.npz", **split, **stats)
+        dataset = ProcessedLigandPocketDataset(tmp_path / "stats.npz")
+    else:
+        data = dict(split)
+        names = data.pop("names")
+        write_memmap_dataset(tmp_path / "stats", names, **data)
+        np.savez(tmp_path / "stats" / "stats.npz", **stats)
+        dataset = MemmapLigandPocketDataset(tmp_path / "stats")
+
+    for i, ref in enumerate(reference_items(split, center=True)):
+        item = dataset[i]
+        for key in ("lig_coords", "pocket_c_alpha"):
+            assert torch.allclose(item[key] + torch.from_numpy(shift[i]),
+                                  ref[key], atol=1e-4), key
+
+
+@pytest.fixture
+def sizes():
+    rng = np.random.default_rng(1)
+    num_lig_atoms = rng.choice([5, 9, 20], size=200)
+    num_pocket_nodes = rng.choice([10, 40, 90], size=200)
+    return num_lig_atoms, num_pocket_nodes
+
+
+@pytest.mark.parametrize("max_batch_size", [None, 3])
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_bucket_batches_respect_edge_budget(sizes, max_batch_size, shuffle):
+    num_lig_atoms, num_pocket_nodes = sizes
+    cost = (num_lig_atoms + num_pocket_nodes) ** 2
+    budget = 20000
+    sampler = SizeBucketBatchSampler(num_lig_atoms, num_pocket_nodes, budget,
+                                     max_batch_size=max_batch_size,
+                                     shuffle=shuffle)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        # the length is exact in every epoch
+        assert len(batches) == len(sampler)
+        assert sorted(i for b in batches for i in b) == list(range(len(cost)))
+        for batch in batches:
+            assert cost[batch].sum() <= budget or len(batch) == 1
+            if max_batch_size is not None:
+                assert len(batch) <= max_batch_size
+        # a single sample exceeding the budget forms its own batch
+        assert [i for b in batches for i in b if len(b) == 1 and
+                cost[b].sum() > budget] == list(np.where(cost > budget)[0])
+
+
+def test_bucket_batches_are_packed_greedily(sizes):
+    num_lig_atoms, num_pocket_nodes = sizes
+    cost = (num_lig_atoms + num_pocket_nodes) ** 2
+    sampler = SizeBucketBatchSampler(num_lig_atoms, num_pocket_nodes, 20000,
+                                     shuffle=False)
+    batches = list(sampler)
+    # visited in order of increasing size, closed only if the next one is full
+    order = [i for b in batches for i in b]
+    keys = list(zip(num_lig_atoms[order], num_pocket_nodes[order]))
+    assert keys == sorted(keys)
+    for batch, next_batch in zip(batches, batches[1:]):
+        assert cost[batch].sum() + cost[next_batch[0]] > 20000
+
+
+def test_bucket_batches_are_split_across_ranks(sizes):
+    num_lig_atoms, num_pocket_nodes = sizes
+    samplers = [
+        SizeBucketBatchSampler(num_lig_atoms, num_pocket_nodes, 20000,
+                               num_replicas=3, rank=rank)
+        for rank in range(3)
+    ]
+    batches = [list(sampler) for sampler in samplers]
+    assert all(len(b) == len(samplers[0]) for b in batches)
+    # the ranks share the same packing and together cover all samples
+    covered = {i for rank_batches in batches for b in rank_batches for i in b}
+    assert covered == set(range(len(num_lig_atoms)))
+
+
+@pytest.mark.parametrize("indices", [[0], [0, 5, 3, 3, 11], list(range(12))])
+def test_collate_matches_loop_collate(npz_path, indices):
+    from benchmark import collate_loop
+
+    dataset = ProcessedLigandPocketDataset(npz_path)
+    batch = [dataset[i] for i in indices]
+    out = ProcessedLigandPocketDataset.collate_fn(batch)
+    expected = collate_loop(batch)
+
+    assert out.keys() == expected.keys()
+    assert out["names"] == expected["names"]
+    for key in expected.keys() - {"names"}:
+        if "mask" in key:
+            # integer masks instead of float masks that had to be cast
+            assert out[key].dtype == torch.int64
+            assert torch.equal(out[key], expected[key].long()), key
+        else:
+            assert torch.equal(out[key], expected[key]), key
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+def test_collate_pins_memory(npz_path):
+    dataset = ProcessedLigandPocketDataset(npz_path)
+    out = ProcessedLigandPocketDataset.collate_fn(
+        [dataset[0], dataset[1]], pin_memory=True)
+    assert all(v.is_pinned() for v in out.values() if isinstance(v, torch.Tensor))
+
+
+@pytest.fixture
+def shard_dir(tmp_path):
+    split = random_split(n_samples=25, seed=3)
+    with ShardWriter(tmp_path / "train", shard_size=10) as writer:
+        for item in reference_items(split, center=False):
+            writer.add(item["names"], **{
+                key: item[key].numpy() for key in FIELDS if "mask" not in key
+            })
+    return split, tmp_path / "train"
+
+
+def test_shard_writer_manifest(shard_dir):
+    split, out_dir = shard_dir
+    with open(out_dir / "manifest.json") as f:
+        manifest = json.load(f)
+    assert manifest["n_samples"] == 25
+    assert [s["n_samples"] for s in manifest["shards"]] == [10, 10, 5]
+    num_lig_atoms = np.bincount(split["lig_mask"])
+    for i, shard in enumerate(manifest["shards"]):
+        sizes = num_lig_atoms[10 * i : 10 * i + shard["n_samples"]]
+        assert shard["num_lig_atoms"] == {
+            "min": sizes.min(), "max": sizes.max(), "mean": sizes.mean(),
+            "sum": sizes.sum(),
+        }
+        assert (out_dir / shard["path"] / "fields.json").exists()
+
+
+@pytest.mark.parametrize("center", [True, False])
+def test_sharded_items_match_reference(shard_dir, center):
+    split, out_dir = shard_dir
+    dataset = load_processed_dataset(out_dir.with_suffix(".npz"), center=center)
+    assert isinstance(dataset, ShardedLigandPocketDataset)
+    # masks are written per shard
+    assert_items_equal(dataset, reference_items(split, center), exact_masks=False)
+    assert torch.equal(dataset.num_lig_atoms,
+                       torch.from_numpy(np.bincount(split["lig_mask"])))
+    assert_stats_equal(dataset.stats, reference_stats(split))
+
+
+def test_sharded_dataset_maps_shards_lazily(shard_dir):
+    _, out_dir = shard_dir
+    dataset = ShardedLigandPocketDataset(out_dir)
+    assert dataset.shards == {}
+    dataset[12]
+    assert list(dataset.shards) == [1]
+    # mapped shards are not sent to DataLoader workers
+    assert pickle.loads(pickle.dumps(dataset)).shards == {}
+
+
+def test_shard_sampler_order(shard_dir):
+    _, out_dir = shard_dir
+    dataset = ShardedLigandPocketDataset(out_dir)
+    shard_of = np.repeat(np.arange(3), dataset.shard_sizes)
+    sampler = ShardShuffleSampler(dataset.shard_sizes, seed=1)
+
+    orders = []
+    for epoch in (0, 0, 1):
+        sampler.set_epoch(epoch)
+        order = list(sampler)
+        # every shard is read in one go
+        assert sorted(order) == list(range(25))
+        shards = shard_of[order]
+        assert (np.diff(shards) != 0).sum() == 2
+        orders.append(order)
+    # the order only depends on the epoch, not on how often it was iterated
+    assert orders[0] == orders[1]
+    assert orders[0] != orders[2] == list(sampler)
+
+    unshuffled = ShardShuffleSampler(dataset.shard_sizes, shuffle=False)
+    assert list(unshuffled) == list(range(25))
+
+
+def test_shard_sampler_splits_ranks(shard_dir):
+    _, out_dir = shard_dir
+    shard_sizes = ShardedLigandPocketDataset(out_dir).shard_sizes
+    samplers = [ShardShuffleSampler(shard_sizes, seed=1, num_replicas=2, rank=r)
+                for r in range(2)]
+    orders = [list(sampler) for sampler in samplers]
+    # padded by wrapping around to the same length
+    assert [len(o) for o in orders] == [13, 13] == [len(s) for s in samplers]
+    full = list(ShardShuffleSampler(shard_sizes, seed=1))
+    assert orders[0] + orders[1] == full + full[:1]
+
+
+def test_bucket_sampler_order_only_depends_on_epoch(sizes):
+    sampler = SizeBucketBatchSampler(*sizes, 20000, seed=1)
+    first, second = list(sampler), list(sampler)
+    assert first == second
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+    sampler.set_epoch(0)
+    assert list(sampler) == first
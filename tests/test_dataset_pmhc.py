@@ -0,0 +1,280 @@
+import importlib.util
+import io
+import pickle
+
+import h5py
+import numpy as np
+import pytest
+import torch
+from Bio.PDB import PDBParser
+from torch.utils.data import DataLoader
+
+import dataset_pmhc
+from benchmark import random_pmhc_pdb
+from dataset_pmhc import (
+    HDF5PMHCDataset,
+    encode_types,
+    get_interface_residue_ids,
+    get_interface_residue_ids_pdb2sql,
+    process_pmhc_pdb_file,
+    read_pdb_atoms,
+    update_peptide_coords_pdb_string,
+    write_updated_peptide_coords_pdb,
+)
+
+ENCODER = {aa: i for i, aa in enumerate("ACDEFGHIKLMNPQRSTVWY")}
+
+
+def write_hdf5(path, pdb_strings):
+    """Records in the format of the pMHC HDF5 files: one 'complex' dataset of
+    pdb lines per structure."""
+    with h5py.File(path, "w") as f:
+        for name, pdb_string in pdb_strings.items():
+            lines = [line.encode() for line in pdb_string.split("\n")]
+            f.create_group(name).create_dataset("complex", data=lines)
+
+
+@pytest.fixture
+def pdb_strings():
+    rng = np.random.default_rng(0)
+    return {f"complex_{i}": random_pmhc_pdb(20 + 5 * i, 9, rng) for i in range(4)}
+
+
+@pytest.fixture
+def hdf5_file(pdb_strings, tmp_path):
+    write_hdf5(tmp_path / "structures.hdf5", pdb_strings)
+    return tmp_path / "structures.hdf5"
+
+
+def reference_item(pdb_string, atom_level):
+    """Eager parsing of a single structure, centered as in the .npz data."""
+    peptide, mhc = process_pmhc_pdb_file(io.StringIO(pdb_string),
+                                         atom_level=atom_level)
+    x_peptide, x_mhc = peptide["x"].reshape(-1, 3), mhc["x"].reshape(-1, 3)
+    mean = torch.cat((x_peptide, x_mhc)).mean(0)
+    return {
+        "lig_coords": x_peptide - mean,
+        "lig_one_hot": encode_types(peptide["types"], ENCODER),
+        "pocket_c_alpha": x_mhc - mean,
+        "pocket_one_hot": encode_types(mhc["types"], ENCODER),
+    }
+
+
+def assert_item_matches(item, pdb_string, atom_level=False):
+    expected = reference_item(pdb_string, atom_level)
+    for key, value in expected.items():
+        assert torch.allclose(item[key], value, atol=1e-5), key
+    assert item["num_lig_atoms"] == len(expected["lig_coords"])
+    assert item["num_pocket_nodes"] == len(expected["pocket_c_alpha"])
+
+
+def test_items_match_eager_parsing(hdf5_file, pdb_strings, tmp_path):
+    dataset = HDF5PMHCDataset([hdf5_file], ENCODER, cache_dir=tmp_path / "cache")
+    assert len(dataset) == len(pdb_strings)
+    for i in range(len(dataset)):
+        item = dataset[i]
+        assert_item_matches(item, pdb_strings[item["names"]])
+
+
+def test_names_select_records(hdf5_file):
+    dataset = HDF5PMHCDataset([hdf5_file], ENCODER,
+                              names={"complex_1", "complex_3"})
+    assert [dataset[i]["names"] for i in range(len(dataset))] == [
+        "complex_1", "complex_3"]
+
+
+def test_cache_is_reused(hdf5_file, pdb_strings, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    items = list(HDF5PMHCDataset([hdf5_file], ENCODER, cache_dir=cache_dir))
+    assert len(list(cache_dir.glob("*.npz"))) == len(pdb_strings)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("structure parsed again")
+
+    # a new dataset on the same cache never parses or opens the structures
+    monkeypatch.setattr(dataset_pmhc, "parse_pmhc_pdb_string", fail)
+    dataset = HDF5PMHCDataset([hdf5_file], ENCODER, cache_dir=cache_dir)
+    monkeypatch.setattr(dataset, "get_handle", fail)
+    for item, cached in zip(items, dataset):
+        for key, value in item.items():
+            if isinstance(value, torch.Tensor):
+                assert torch.equal(cached[key], value), key
+            else:
+                assert cached[key] == value, key
+
+    # other parsing options are cached separately
+    atom_level = HDF5PMHCDataset([hdf5_file], ENCODER, atom_level=True,
+                                 cache_dir=cache_dir)
+    with pytest.raises(AssertionError, match="parsed again"):
+        atom_level[0]
+
+
+def test_structures_are_parsed_in_workers(hdf5_file, pdb_strings, tmp_path):
+    dataset = HDF5PMHCDataset([hdf5_file], ENCODER, cache_dir=tmp_path / "cache")
+    # nothing is parsed or cached up front
+    assert list((tmp_path / "cache").iterdir()) == []
+
+    # handles opened in the main process are not passed on to the workers
+    dataset[0]
+    assert len(dataset._handles) == 1
+    assert pickle.loads(pickle.dumps(dataset))._handles == {}
+
+    loader = DataLoader(dataset, batch_size=2, num_workers=2,
+                        collate_fn=dataset.collate_fn)
+    batches = list(loader)
+    names = [name for batch in batches for name in batch["names"]]
+    assert names == list(pdb_strings)
+    assert len(list((tmp_path / "cache").glob("*.npz"))) == len(pdb_strings)
+
+    sizes = batches[0]["num_lig_atoms"].tolist()
+    for j, x in enumerate(torch.split(batches[0]["lig_coords"], sizes)):
+        expected = reference_item(pdb_strings[names[j]], atom_level=False)
+        assert torch.allclose(x, expected["lig_coords"], atol=1e-5)
+
+
+def atom_line(serial, chain, resseq, coords, name="CA", resname="ALA"):
+    x, y, z = coords
+    return (f"ATOM  {serial:5d}  {name:<3s} {resname} {chain}{resseq:4d}    "
+            f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00           {name[0]}  ")
+
+
+def biopython_model(pdb_string):
+    return PDBParser(QUIET=True).get_structure("", io.StringIO(pdb_string))[0]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_interface_matches_pdb2sql(seed):
+    pytest.importorskip("pdb2sql")
+    pdb_string = random_pmhc_pdb(60, 9, np.random.default_rng(seed))
+    expected = get_interface_residue_ids_pdb2sql(pdb_string)
+    # the random structures have residues on both sides of the cutoff
+    assert 0 < len(expected) < 60
+
+    assert get_interface_residue_ids(read_pdb_atoms(pdb_string)) == expected
+    assert get_interface_residue_ids(biopython_model(pdb_string)) == expected
+
+    kdtree = process_pmhc_pdb_file(io.StringIO(pdb_string),
+                                   select_interface=True)[1]
+    reference = process_pmhc_pdb_file(io.StringIO(pdb_string),
+                                      select_interface=True,
+                                      interface_backend="pdb2sql")[1]
+    assert torch.equal(kdtree["x"], reference["x"])
+    assert kdtree["types"] == reference["types"]
+
+
+def test_interface_cutoff_is_inclusive():
+    # one peptide atom at the origin, MHC residues around the 8.5 A cutoff
+    mhc_coords = {
+        1: (8.5, 0.0, 0.0),  # exactly at the cutoff
+        2: (0.0, 8.501, 0.0),
+        3: (0.0, 0.0, -8.499),
+        4: (6.0, 6.0, 0.0),  # 8.485
+        5: (6.011, 6.011, 0.0),  # 8.501
+    }
+    lines = [atom_line(1, "P", 1, (0.0, 0.0, 0.0))]
+    for resseq, coords in mhc_coords.items():
+        lines.append(atom_line(len(lines) + 1, "M", resseq, coords))
+    pdb_string = "\n".join(lines + ["END"])
+
+    for pdb_model in [read_pdb_atoms(pdb_string), biopython_model(pdb_string)]:
+        assert get_interface_residue_ids(pdb_model) == [1, 3, 4]
+        assert get_interface_residue_ids(pdb_model, cutoff=8.499) == [3, 4]
+
+    if importlib.util.find_spec("pdb2sql") is not None:
+        assert get_interface_residue_ids_pdb2sql(pdb_string) == [1, 3, 4]
+
+
+def small_pmhc_pdb(chain_order):
+    """PDB string with TER records, glycines without CB and the peptide
+    chain P before or after the MHC chain M."""
+    rng = np.random.default_rng(3)
+    residues = {"M": ["GLY", "SER", "LEU", "TYR", "LYS", "ALA", "GLU", "ARG"],
+                "P": ["SER", "ILE", "GLY", "PHE", "LEU"]}
+    lines = []
+    for chain in chain_order:
+        scale = 4.0 if chain == "P" else 8.0
+        for resseq, resname in enumerate(residues[chain], start=1):
+            centre = rng.normal(size=3) * scale
+            names = ["N", "CA", "C", "O"] + ([] if resname == "GLY" else ["CB"])
+            for name in names:
+                lines.append(atom_line(len(lines) + 1, chain, resseq,
+                                       centre + rng.normal(size=3),
+                                       name=name, resname=resname))
+        lines.append(f"TER   {len(lines) + 1:5d}      {resname} {chain}{resseq:4d}")
+    return "\n".join(lines + ["END"]) + "\n"
+
+
+def read_atoms_biopython(path):
+    """(chain, residue id, residue name, atom name, coords) of every atom in
+    the order of the file"""
+    structure = PDBParser(QUIET=True).get_structure("", str(path))
+    return [
+        (atom.get_parent().get_parent().id, atom.get_parent().id,
+         atom.get_parent().get_resname(), atom.get_id(), atom.get_coord())
+        for atom in structure.get_atoms()
+    ]
+
+
+def assert_same_atoms(atoms, expected):
+    assert [a[:4] for a in atoms] == [a[:4] for a in expected]
+    assert np.array_equal(np.array([a[4] for a in atoms]),
+                          np.array([a[4] for a in expected]))
+
+
+@pytest.mark.parametrize("chain_order", ["MP", "PM"])
+@pytest.mark.parametrize("atom_level", [True, False])
+@pytest.mark.parametrize("select_interface", [True, False])
+def test_readers_parse_the_same_structure(chain_order, atom_level,
+                                          select_interface):
+    pdb_string = small_pmhc_pdb(chain_order)
+    parsed = {
+        reader: process_pmhc_pdb_file(io.StringIO(pdb_string),
+                                      atom_level=atom_level,
+                                      select_interface=select_interface,
+                                      reader=reader)
+        for reader in ["fixed_columns", "biopython"]
+    }
+    for part, expected in zip(parsed["fixed_columns"], parsed["biopython"]):
+        assert torch.equal(part["x"], expected["x"])
+        assert part["types"] == expected["types"]
+        assert part["size"] == expected["size"]
+    if select_interface:
+        # some, but not all MHC residues are in the interface
+        assert 0 < parsed["biopython"][1]["size"] < 8 * (5 if atom_level else 1)
+
+
+@pytest.mark.parametrize("chain_order", ["MP", "PM"])
+@pytest.mark.parametrize("atom_level", [True, False])
+def test_updated_coords_match_biopython_writer(chain_order, atom_level,
+                                               tmp_path):
+    pdb_string = small_pmhc_pdb(chain_order)
+    peptide, mhc = process_pmhc_pdb_file(io.StringIO(pdb_string),
+                                         atom_level=atom_level)
+    new_coords = torch.randn(peptide["size"], 3) * 5
+
+    paths = {}
+    for reader in ["fixed_columns", "biopython"]:
+        paths[reader] = tmp_path / f"{reader}.pdb"
+        write_updated_peptide_coords_pdb(new_coords, None,
+                                         io.StringIO(pdb_string),
+                                         paths[reader], atom_level=atom_level,
+                                         reader=reader)
+    assert paths["fixed_columns"].read_text() == update_peptide_coords_pdb_string(
+        new_coords, pdb_string, atom_level=atom_level)
+
+    # same atoms, coordinates and chain order (the rebuilt residue level
+    # peptide comes last)
+    atoms = read_atoms_biopython(paths["fixed_columns"])
+    assert_same_atoms(atoms, read_atoms_biopython(paths["biopython"]))
+    chains = list(dict.fromkeys(atom[0] for atom in atoms))
+    assert chains == (list(chain_order) if atom_level else ["M", "P"])
+
+    # round trip: the new peptide coordinates and the unchanged MHC
+    for path in paths.values():
+        for reader in ["fixed_columns", "biopython"]:
+            new_peptide, new_mhc = process_pmhc_pdb_file(
+                path, atom_level=atom_level, reader=reader)
+            assert torch.allclose(new_peptide["x"], new_coords, atol=5e-4)
+            assert new_peptide["types"] == peptide["types"]
+            assert torch.equal(new_mhc["x"], mhc["x"])
+            assert new_mhc["types"] == mhc["types"]
@@ -0,0 +1,235 @@
+import shlex
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+from analysis.docking import DockingScheduler, ReceptorCache, dock_sdf_files
+
+FAKE_QVINA = Path(__file__).resolve().parents[1] / "analysis" / "fake_qvina.py"
+
+# OpenBabel stand-in: the fake "PDBQT" files are SDF files, poses written by
+# fake_qvina.py are turned back into SDF by removing the model records
+FAKE_OBABEL = """
+import sys
+source, _, target = sys.argv[1:4]
+with open(source) as f:
+    lines = [l for l in f if not l.startswith(("MODEL", "REMARK", "ENDMDL"))]
+with open(target, "w") as f:
+    f.writelines(lines)
+"""
+
+# prepare_receptor4.py stand-in that logs every conversion
+FAKE_PREPARE = """
+import shutil, sys
+log, _, receptor, _, out = sys.argv[1:6]
+with open(log, "a") as f:
+    f.write(receptor + "\\n")
+shutil.copy(receptor, out)
+"""
+
+# QuickVina stand-in that logs its arguments and fails for ligands with
+# nitrogen atoms
+LOGGING_QVINA = """
+import runpy, sys
+log, fake_qvina, *args = sys.argv[1:]
+with open(log, "a") as f:
+    f.write(" ".join(args) + "\\n")
+with open(args[args.index("--ligand") + 1]) as f:
+    if any(line[31:34].strip() == "N" for line in f):
+        sys.exit("nitrogen")
+sys.argv = [fake_qvina, *args]
+runpy.run_path(fake_qvina, run_name="__main__")
+"""
+
+
+def command(*args):
+    return shlex.join([sys.executable, *map(str, args)])
+
+
+def write_ligands(path, smiles_list):
+    with Chem.SDWriter(str(path)) as writer:
+        for smiles in smiles_list:
+            mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+            AllChem.EmbedMolecule(mol, randomSeed=0)
+            writer.write(mol)
+
+
+def write_receptor(path, offset):
+    lines = [
+        f"ATOM  {i + 1:5d}  CA  ALA A{i + 1:4d}    "
+        f"{offset + i:8.3f}{0.0:8.3f}{0.0:8.3f}  1.00  0.00           C"
+        for i in range(5)
+    ]
+    path.write_text("\n".join(lines + ["END"]) + "\n")
+
+
+@pytest.fixture
+def docking_setup(tmp_path):
+    obabel = tmp_path / "obabel.py"
+    obabel.write_text(FAKE_OBABEL)
+    prepare = tmp_path / "prepare.py"
+    prepare.write_text(FAKE_PREPARE)
+    log = tmp_path / "prepare.log"
+    log.touch()
+
+    receptors = [tmp_path / "rec_a.pdb", tmp_path / "rec_b.pdb"]
+    for i, receptor in enumerate(receptors):
+        write_receptor(receptor, offset=10.0 * i)
+
+    sdf_files = [tmp_path / f"ligands_{i}.sdf" for i in range(3)]
+    write_ligands(sdf_files[0], ["CCO", "c1ccccc1"])
+    write_ligands(sdf_files[1], ["CC(=O)O", "CCN", "OCCO"])
+    write_ligands(sdf_files[2], ["CCCC"])
+
+    def make_scheduler(qvina_cmd=command(FAKE_QVINA), n_workers=4):
+        return DockingScheduler(
+            tmp_path / "out",
+            n_workers=n_workers,
+            qvina_cmd=qvina_cmd,
+            obabel_cmd=command(obabel),
+            prepare_cmd=command(prepare, log),
+        )
+
+    # the first two SDF files share a receptor
+    jobs = [(receptors[0], sdf_files[0]), (receptors[0], sdf_files[1]),
+            (receptors[1], sdf_files[2])]
+    return make_scheduler, jobs, log
+
+
+def run_jobs(scheduler, jobs, return_rdmol=False):
+    try:
+        futures = [scheduler.submit(receptor, sdf) for receptor, sdf in jobs]
+        return [scheduler.collect(f, return_rdmol=return_rdmol) for f in futures]
+    finally:
+        scheduler.close()
+
+
+def test_shared_receptor_is_prepared_once(docking_setup):
+    make_scheduler, jobs, log = docking_setup
+
+    results = run_jobs(make_scheduler(), jobs, return_rdmol=True)
+
+    prepared = log.read_text().split()
+    assert sorted(prepared) == sorted({str(receptor) for receptor, _ in jobs})
+    assert [len(scores) for scores, _ in results] == [2, 3, 1]
+    for (receptor, sdf_file), (scores, rdmols) in zip(jobs, results):
+        assert all(isinstance(score, float) for score in scores)
+        # poses are read with the default settings (hydrogens removed)
+        ligands = Chem.SDMolSupplier(str(sdf_file))
+        for ligand, pose in zip(ligands, rdmols):
+            assert pose.GetNumAtoms() == ligand.GetNumAtoms()
+
+
+def test_results_are_resumed_from_store(docking_setup, tmp_path):
+    make_scheduler, jobs, log = docking_setup
+
+    scores = run_jobs(make_scheduler(), jobs)
+    store = tmp_path / "out" / "docking_results.jsonl"
+    n_entries = len(store.read_text().splitlines())
+    assert n_entries == sum(len(s) for s in scores)
+
+    # every job is served from the store (and the receptor files from the
+    # receptor cache), the docking command is never run again
+    failing_cmd = command("-c", "import sys; sys.exit(1)")
+    resumed = run_jobs(make_scheduler(qvina_cmd=failing_cmd, n_workers=2), jobs)
+    assert resumed == scores
+    assert len(store.read_text().splitlines()) == n_entries
+    assert len(log.read_text().split()) == 2
+
+    # new ligands are docked with the given command
+    write_ligands(jobs[0][1], ["CCOC"])
+    scheduler = make_scheduler(qvina_cmd=failing_cmd)
+    with pytest.raises(subprocess.CalledProcessError):
+        run_jobs(scheduler, jobs[:1])
+
+
+@pytest.mark.parametrize("cpus_per_job", [None, 3])
+def test_cpus_per_job_is_passed_to_qvina(docking_setup, tmp_path, cpus_per_job):
+    make_scheduler, jobs, _ = docking_setup
+    qvina = tmp_path / "qvina.py"
+    qvina.write_text(LOGGING_QVINA)
+    qvina_log = tmp_path / "qvina.log"
+
+    scheduler = make_scheduler(qvina_cmd=command(qvina, qvina_log, FAKE_QVINA))
+    scheduler.cpus_per_job = cpus_per_job
+    run_jobs(scheduler, jobs[:1])
+
+    calls = [shlex.split(line) for line in qvina_log.read_text().splitlines()]
+    assert len(calls) == 2
+    for args in calls:
+        if cpus_per_job is None:
+            assert "--cpu" not in args
+        else:
+            assert args[args.index("--cpu") + 1] == "3"
+
+
+def test_concurrent_receptor_cache_access(docking_setup, tmp_path):
+    _, jobs, _ = docking_setup
+    receptor = jobs[0][0]
+    # a slow conversion, so that all threads request the receptor while it
+    # is being prepared
+    prepare = tmp_path / "slow_prepare.py"
+    prepare.write_text("import time; time.sleep(0.5)\n" + FAKE_PREPARE)
+    log = tmp_path / "slow_prepare.log"
+    cache = ReceptorCache(tmp_path / "receptors", command(prepare, log))
+
+    n_threads = 8
+    barrier = threading.Barrier(n_threads)
+
+    def get(_):
+        barrier.wait()
+        return cache.get(receptor)
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        results = list(executor.map(get, range(n_threads)))
+
+    assert log.read_text().split() == [str(receptor)]
+    assert len(set(results)) == 1
+    pdbqt_file, _ = results[0]
+    assert pdbqt_file.read_text() == receptor.read_text()
+    assert [p.name for p in (tmp_path / "receptors").iterdir()] == [pdbqt_file.name]
+
+
+def test_failures_are_recorded(docking_setup, tmp_path):
+    make_scheduler, jobs, _ = docking_setup
+    qvina = tmp_path / "qvina.py"
+    qvina.write_text(LOGGING_QVINA)
+    pdbqt_dir = tmp_path / "pdbqt"
+    pdbqt_dir.mkdir()
+
+    # receptor 1abc exists, the receptor of the last file does not
+    (pdbqt_dir / "1abc.pdbqt").write_text(jobs[0][0].read_text())
+    sdf_files = [tmp_path / "1abc_pocket0_gen.sdf",
+                 tmp_path / "2xyz_pocket0_gen.sdf"]
+    write_ligands(sdf_files[0], ["CCO", "CCN", "c1ccccc1"])
+    write_ligands(sdf_files[1], ["CCCC"])
+
+    scheduler = make_scheduler(
+        qvina_cmd=command(qvina, tmp_path / "qvina.log", FAKE_QVINA))
+    try:
+        results, results_dict = dock_sdf_files(scheduler, sdf_files, pdbqt_dir)
+    finally:
+        scheduler.close()
+
+    assert results["ligand"] == [str(f) for f in sdf_files]
+    assert results["receptor"] == [str(pdbqt_dir / "1abc.pdbqt"),
+                                   str(pdbqt_dir / "2xyz.pdbqt")]
+
+    # only the ligand with nitrogen failed
+    scores, rdmols = results_dict["1abc"]
+    assert results["scores"][0] == scores
+    assert scores[0] < 0 and np.isnan(scores[1]) and scores[2] < 0
+    assert rdmols[0] is not None and rdmols[1] is None
+    assert "non-zero exit status" in results["error"][0]
+
+    # the missing receptor fails the whole file
+    assert np.isnan(results["scores"][1]).all()
+    assert results_dict["2xyz"][1] == [None]
+    assert "2xyz.pdbqt" in results["error"][1]
@@ -0,0 +1,98 @@
+import pytest
+import torch
+
+pytest.importorskip("pytorch_lightning")
+import generate_peptides
+from generate_peptides import collate_complexes, iter_batches, iter_complexes
+
+N_TYPES = 3
+
+
+def make_complex(name, n_peptide, n_mhc):
+    def part(n):
+        return {
+            "x": torch.randn(n, 3),
+            "one_hot": torch.eye(N_TYPES)[torch.arange(n) % N_TYPES],
+            "size": n,
+        }
+    return name, f"pdb of {name}", part(n_peptide), part(n_mhc)
+
+
+def n_nodes(item, n_samples):
+    return n_samples * (item[2]["size"] + item[3]["size"])
+
+
+@pytest.fixture
+def complexes():
+    sizes = [(9, 30), (8, 25), (10, 60), (9, 12), (11, 90), (8, 20), (9, 31)]
+    return [make_complex(f"c{i}", *size) for i, size in enumerate(sizes)]
+
+
+@pytest.mark.parametrize("max_batch_complexes", [None, 2])
+def test_batches_respect_node_budget(complexes, max_batch_complexes):
+    n_samples, budget = 2, 150
+    batches = list(iter_batches(iter(complexes), n_samples, budget,
+                                max_batch_complexes))
+
+    # complexes keep their order and none is lost
+    assert [c[0] for b in batches for c in b] == [c[0] for c in complexes]
+    for batch, next_batch in zip(batches, batches[1:] + [None]):
+        nodes = sum(n_nodes(c, n_samples) for c in batch)
+        # only a single complex may exceed the budget
+        assert nodes <= budget or len(batch) == 1
+        if max_batch_complexes is not None:
+            assert len(batch) <= max_batch_complexes
+        # batches are only closed when the next complex does not fit
+        if next_batch is not None and (
+            max_batch_complexes is None or len(batch) < max_batch_complexes
+        ):
+            assert nodes + n_nodes(next_batch[0], n_samples) > budget
+    # the complex with 2 * (11 + 90) nodes forms its own batch
+    assert ["c4"] in [[c[0] for c in b] for b in batches]
+
+
+def test_collate_repeats_complexes_consecutively(complexes):
+    n_samples = 3
+    batch = complexes[:2]
+    peptide, mhc = collate_complexes(batch, n_samples)
+
+    for key, out in ((2, peptide), (3, mhc)):
+        parts = [c[key] for c in batch]
+        sizes = [p["size"] for p in parts for _ in range(n_samples)]
+        assert out["size"].tolist() == sizes
+        assert torch.equal(
+            out["mask"], torch.arange(len(sizes)).repeat_interleave(
+                torch.tensor(sizes))
+        )
+        # sample i * n_samples + j is copy j of complex i
+        x_split = torch.split(out["x"], sizes)
+        for i, p in enumerate(parts):
+            for j in range(n_samples):
+                assert torch.equal(x_split[i * n_samples + j], p["x"])
+        assert torch.equal(
+            out["one_hot"], torch.cat([p["one_hot"] for p in parts
+                                       for _ in range(n_samples)])
+        )
+
+
+def test_skipped_complexes_are_not_parsed(monkeypatch):
+    names = ["a", "b", "c"]
+    monkeypatch.setattr(
+        generate_peptides, "iter_pdb_strings_hdf5_file",
+        lambda path, names_filter: ((n, f"pdb of {n}") for n in names),
+    )
+    parsed = []
+
+    def parse(pdb_stream, **kwargs):
+        parsed.append(kwargs["pdb_string"])
+        peptide = {"x": torch.zeros(2, 3), "types": ["A", "B"], "size": 2}
+        mhc = {"x": torch.zeros(1, 3), "types": ["A"], "size": 1}
+        return peptide, mhc
+
+    monkeypatch.setattr(generate_peptides, "process_pmhc_pdb_file", parse)
+
+    out = list(iter_complexes(["file.hdf5"], None, {"A": 0, "B": 1},
+                              False, False, "cpu", skip=lambda n: n == "b"))
+    assert [c[0] for c in out] == ["a", "c"]
+    assert parsed == ["pdb of a", "pdb of c"]
+    assert out[0][2]["one_hot"].tolist() == [[1, 0], [0, 1]]
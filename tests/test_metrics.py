@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("openbabel")
+from analysis.metrics import check_stability, check_stability_batch
+from constants import dataset_params
+
+DATASET_INFO = dataset_params["crossdock"]
+
+
+def random_molecules(n_molecules, rng):
+    """Random chains of atoms at bond-like distances and a few molecules
+    that are stable (CO2, N2, O2)."""
+    molecules = [
+        (np.array([[0, 0, 0], [1.16, 0, 0], [-1.16, 0, 0]]), np.array([0, 2, 2])),
+        (np.array([[0, 0, 0], [1.1, 0, 0]]), np.array([1, 1])),
+        (np.array([[0, 0, 0], [1.21, 0, 0]]), np.array([2, 2])),
+    ]
+    for _ in range(n_molecules):
+        n = rng.integers(1, 9)
+        steps = rng.normal(size=(n, 3))
+        steps *= rng.uniform(1.1, 1.6, size=(n, 1)) / np.linalg.norm(
+            steps, axis=1, keepdims=True)
+        atom_type = rng.choice(len(DATASET_INFO["atom_decoder"]), size=n)
+        molecules.append((np.cumsum(steps, axis=0), atom_type))
+    order = rng.permutation(len(molecules))
+    return [molecules[i] for i in order]
+
+
+def concat_molecules(molecules):
+    sizes = [len(pos) for pos, _ in molecules]
+    return (
+        torch.from_numpy(np.concatenate([pos for pos, _ in molecules])),
+        torch.from_numpy(np.concatenate([atom_type for _, atom_type in molecules])),
+        torch.repeat_interleave(torch.arange(len(molecules)), torch.tensor(sizes)),
+    )
+
+
+def test_batch_stability_matches_check_stability():
+    molecules = random_molecules(200, np.random.default_rng(0))
+    mol_stable, atm_stable = check_stability_batch(
+        *concat_molecules(molecules), DATASET_INFO)
+
+    expected = [check_stability(pos, atom_type, DATASET_INFO)
+                for pos, atom_type in molecules]
+    assert mol_stable.tolist() == [e[0] for e in expected]
+    n_stable = np.add.reduceat(atm_stable, np.cumsum(
+        [0] + [len(pos) for pos, _ in molecules[:-1]]))
+    assert n_stable.tolist() == [e[1] for e in expected]
+    # both outcomes are tested
+    assert 0 < mol_stable.sum() < len(molecules)
+
+
+def test_empty_batch():
+    mol_stable, atm_stable = check_stability_batch(
+        torch.zeros(0, 3), torch.zeros(0, dtype=torch.long),
+        torch.zeros(0, dtype=torch.long), DATASET_INFO)
+    assert len(mol_stable) == 0 and len(atm_stable) == 0
+
+
+def test_unknown_atom_type_raises():
+    info = dataset_params["crossdock_full"]
+    others = info["atom_decoder"].index("others")
+    pos = torch.tensor([[0.0, 0.0, 0.0], [1.5, 0.0, 0.0]])
+
+    # types without valences are only an error if they occur, as in
+    # check_stability
+    check_stability_batch(pos, torch.tensor([0, 0]), torch.tensor([0, 0]), info)
+    with pytest.raises(KeyError, match="others"):
+        check_stability(pos.numpy(), np.array([0, others]), info)
+    with pytest.raises(KeyError, match="others"):
+        check_stability_batch(pos, torch.tensor([0, others]),
+                              torch.tensor([0, 0]), info)
+
+
+class FakeDDPM:
+    """Samples random molecules of 1-5 atoms with 3 atom types."""
+
+    def __init__(self):
+        self.size_distribution = self
+
+    def sample(self, n_samples, num_nodes_lig=None, num_nodes_pocket=None,
+               device=None):
+        if num_nodes_lig is None:
+            return torch.randint(1, 6, (n_samples,)), torch.ones(n_samples)
+        lig_mask = torch.repeat_interleave(torch.arange(n_samples), num_nodes_lig)
+        xh_lig = torch.randn(len(lig_mask), 3 + 3) * 2
+        xh_pocket = torch.randn(n_samples, 3 + 3)
+        return xh_lig, xh_pocket, lig_mask, None
+
+
+def fake_module(**kwargs):
+    from types import SimpleNamespace
+
+    class LigandMetrics:
+        def evaluate(self, molecules):
+            return [len(molecules), 0, 0, 0],
+
+    return SimpleNamespace(
+        ligand_type_distribution=None,
+        pocket_type_distribution=None,
+        ligand_metrics=LigandMetrics(),
+        dataset_info=DATASET_INFO,
+        x_dims=3,
+        **kwargs,
+    )
+
+
+def test_analyze_sample_matches_check_stability():
+    pytest.importorskip("pytorch_lightning")
+    from lightning_modules import LigandPocketDDPM
+
+    molecules = random_molecules(50, np.random.default_rng(1))
+    metrics = LigandPocketDDPM.analyze_sample(
+        fake_module(), molecules, *concat_molecules(molecules), [])
+
+    expected = [check_stability(pos, atom_type, DATASET_INFO)
+                for pos, atom_type in molecules]
+    assert metrics["mol_stable"] == pytest.approx(
+        np.mean([e[0] for e in expected]))
+    assert metrics["atm_stable"] == pytest.approx(
+        sum(e[1] for e in expected) / sum(e[2] for e in expected))
+    assert metrics["Validity"] == len(molecules)
+
+
+@pytest.mark.parametrize("n_samples", [0, 5])
+def test_sample_and_analyze_concatenates_batches(n_samples):
+    pytest.importorskip("pytorch_lightning")
+    from lightning_modules import LigandPocketDDPM
+
+    received = []
+    module = fake_module(ddpm=FakeDDPM(), batch_size=2, current_epoch=0,
+                         device="cpu")
+    module.analyze_sample = lambda *args: received.append(args) or \
+        LigandPocketDDPM.analyze_sample(module, *args)
+    metrics = LigandPocketDDPM.sample_and_analyze(module, n_samples)
+
+    molecules, x, atom_type, batch_mask, aa_types = received[0]
+    assert len(molecules) == n_samples and len(aa_types) == n_samples
+    assert torch.equal(batch_mask, torch.repeat_interleave(
+        torch.arange(n_samples), torch.tensor([len(p) for p, _ in molecules],
+                                              dtype=torch.long)))
+    if n_samples > 0:
+        assert torch.equal(x, torch.cat([pos for pos, _ in molecules]))
+        assert torch.equal(atom_type, torch.cat([t for _, t in molecules]))
+    else:
+        assert metrics["mol_stable"] == 0 and metrics["atm_stable"] == 0
@@ -0,0 +1,142 @@
+import pytest
+import torch
+
+from equivariant_diffusion.dynamics import EGNNDynamics
+
+ATOM_NF = 5
+RESIDUE_NF = 7
+CUTOFF = 2.5
+
+
+def make_dynamics(**kwargs):
+    torch.manual_seed(0)
+    kwargs.setdefault("edge_cutoff", CUTOFF)
+    return EGNNDynamics(
+        atom_nf=ATOM_NF,
+        residue_nf=RESIDUE_NF,
+        n_dims=3,
+        joint_nf=8,
+        hidden_nf=16,
+        n_layers=2,
+        **kwargs,
+    ).eval()
+
+
+@pytest.fixture
+def batch():
+    g = torch.Generator().manual_seed(0)
+    mask_atoms = torch.tensor([0, 0, 0, 1, 1, 2, 2, 2, 2])
+    mask_residues = torch.tensor([0, 0, 0, 0, 1, 1, 1, 2, 2, 2, 2, 2])
+    xh_atoms = torch.cat(
+        [torch.randn(len(mask_atoms), 3, generator=g) * 2,
+         torch.eye(ATOM_NF)[torch.arange(len(mask_atoms)) % ATOM_NF]], dim=1
+    )
+    xh_residues = torch.cat(
+        [torch.randn(len(mask_residues), 3, generator=g) * 2,
+         torch.eye(RESIDUE_NF)[torch.arange(len(mask_residues)) % RESIDUE_NF]],
+        dim=1,
+    )
+    return xh_atoms, xh_residues, mask_atoms, mask_residues
+
+
+def reference_edges(x_atoms, x_residues, mask_atoms, mask_residues):
+    """
+    Dense reference: atoms are connected to all nodes of their sample,
+    residues among each other only within the cutoff. Blocks are ordered as
+    [atom-atom, atom-residue, residue-atom, residue-residue]; the residue-atom
+    edges are the reversed atom-residue edges.
+    """
+    n_atoms = len(mask_atoms)
+    blocks = [
+        (mask_atoms[:, None] == mask_atoms[None, :], 0, 0),
+        (mask_atoms[:, None] == mask_residues[None, :], 0, n_atoms),
+        ((mask_residues[:, None] == mask_residues[None, :])
+         & (torch.cdist(x_residues, x_residues) <= CUTOFF), n_atoms, n_atoms),
+    ]
+    edges = []
+    for adj, row_offset, col_offset in blocks:
+        row, col = torch.where(adj)
+        edges.append(torch.stack((row + row_offset, col + col_offset)))
+    edges.insert(2, edges[1].flip(0))
+    return edges
+
+
+def test_mixed_edges_match_dense_reference(batch):
+    xh_atoms, xh_residues, mask_atoms, mask_residues = batch
+    n_atoms = len(mask_atoms)
+    dynamics = make_dynamics()
+
+    context = dynamics.get_pocket_context(xh_residues, mask_residues, mask_atoms)
+    ligand_edges = context["ligand_layout"]["edges"]
+    pocket_edges = context["edges"] + n_atoms
+
+    expected = reference_edges(
+        xh_atoms[:, :3], xh_residues[:, :3], mask_atoms, mask_residues
+    )
+    assert torch.equal(ligand_edges, torch.cat(expected[:3], dim=1))
+    assert torch.equal(pocket_edges, expected[3])
+    # the cutoff removes some, but not all pocket-pocket edges
+    dense = (mask_residues[:, None] == mask_residues[None, :]).sum()
+    assert len(mask_residues) < pocket_edges.size(1) < dense
+
+
+def test_pocket_edges_follow_translated_pocket(batch):
+    xh_atoms, xh_residues, mask_atoms, mask_residues = batch
+    dynamics = make_dynamics()
+    edges = dynamics.get_pocket_context(xh_residues, mask_residues)["edges"]
+
+    # sampling only translates each pocket, which keeps the cached graph valid
+    shifted = xh_residues.clone()
+    shifted[:, :3] += torch.randn(3, 3)[mask_residues] * 10
+    edges_shifted = dynamics.get_pocket_context(shifted, mask_residues)["edges"]
+    assert torch.equal(edges, edges_shifted)
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"update_pocket_coords": False},
+    {"update_pocket_coords": False, "sin_encoding": True},
+    {"update_pocket_coords": True, "edge_max_neighbors": 2},
+])
+def test_forward_with_precomputed_context(batch, kwargs):
+    xh_atoms, xh_residues, mask_atoms, mask_residues = batch
+    dynamics = make_dynamics(**kwargs)
+    t = torch.full((3, 1), 0.3)
+
+    with torch.no_grad():
+        out = dynamics(xh_atoms, xh_residues, t, mask_atoms, mask_residues)
+        context = dynamics.get_pocket_context(
+            xh_residues, mask_residues, mask_atoms
+        )
+        out_context = dynamics(
+            xh_atoms, xh_residues, t, mask_atoms, mask_residues, context
+        )
+    assert torch.allclose(out_context, out, atol=1e-6)
+
+
+@pytest.mark.parametrize("edge_cutoff", [None, CUTOFF])
+def test_edge_cache_is_reused_across_forward_calls(batch, edge_cutoff):
+    xh_atoms, xh_residues, mask_atoms, mask_residues = batch
+    dynamics = make_dynamics(edge_cutoff=edge_cutoff, sin_encoding=True)
+    cache = dynamics.edge_cache
+    t = torch.full((3, 1), 0.3)
+
+    with torch.no_grad():
+        expected = dynamics(xh_atoms, xh_residues, t, mask_atoms, mask_residues)
+        # nothing is looked up or stored outside of a sampling chain
+        assert cache.stats() == {"edge_cache_hits": 0, "edge_cache_misses": 0,
+                                 "edge_cache_size": 0}
+
+        # the joint model calls forward without a pocket context at every step
+        with cache.enabled():
+            for step in range(3):
+                dynamics(xh_atoms, xh_residues, t * step, mask_atoms,
+                               mask_residues)
+            assert torch.allclose(
+                dynamics(xh_atoms, xh_residues, t, mask_atoms, mask_residues),
+                expected, atol=1e-6,
+            )
+            n_entries = 2 if edge_cutoff is None else 1
+            assert cache.stats() == {"edge_cache_hits": 3 * n_entries,
+                                     "edge_cache_misses": n_entries,
+                                     "edge_cache_size": n_entries}
+    assert cache.stats()["edge_cache_size"] == 0
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("openbabel")
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+from analysis.molecule_builder import build_molecule, process_molecule
+from analysis.postprocessing import (
+    PoolPostProcessor,
+    PostProcessor,
+    ThreadPostProcessor,
+    get_postprocessor,
+    mol_from_block,
+    mol_to_block,
+)
+from constants import dataset_params
+
+DATASET_INFO = dataset_params["crossdock"]
+PROCESS_KWARGS = dict(sanitize=True, largest_frag=True, relax_iter=20)
+
+
+def embed_point_cloud(smiles, seed=0):
+    """Coordinates and atom types of the embedded heavy atoms of a molecule"""
+    encoder = {a: i for i, a in enumerate(DATASET_INFO["atom_decoder"])}
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    AllChem.EmbedMolecule(mol, randomSeed=seed)
+    mol = Chem.RemoveHs(mol)
+    return (
+        torch.tensor(mol.GetConformer().GetPositions(), dtype=torch.float32),
+        torch.tensor([encoder[a.GetSymbol()] for a in mol.GetAtoms()]),
+    )
+
+
+@pytest.fixture(scope="module")
+def point_clouds():
+    """Embedded heavy atoms of a few molecules and one random point cloud
+    that does not pass the filters."""
+    clouds = [embed_point_cloud(smiles, seed=i) for i, smiles in enumerate(
+        ["CCO", "c1ccccc1", "CC(=O)N", "OCC(F)Cl", "CC(C)(C)S", "O=C=O"])]
+    rng = np.random.default_rng(0)
+    clouds.append((torch.tensor(rng.normal(size=(6, 3)) * 0.8,
+                                dtype=torch.float32),
+                   torch.tensor(rng.integers(0, 3, size=6))))
+    return clouds
+
+
+def concat(point_clouds):
+    x = torch.cat([pos for pos, _ in point_clouds])
+    atom_type = torch.cat([types for _, types in point_clouds])
+    lig_mask = torch.repeat_interleave(
+        torch.arange(len(point_clouds)),
+        torch.tensor([len(pos) for pos, _ in point_clouds]))
+    return x, atom_type, lig_mask
+
+
+def assert_same_molecules(mols, expected):
+    assert len(mols) == len(expected)
+    for mol, ref in zip(mols, expected):
+        assert (mol is None) == (ref is None)
+        if ref is None:
+            continue
+        assert Chem.MolToMolBlock(mol) == Chem.MolToMolBlock(ref)
+        assert mol.GetNumConformers() == ref.GetNumConformers()
+        for conf, ref_conf in zip(mol.GetConformers(), ref.GetConformers()):
+            assert np.array_equal(conf.GetPositions(), ref_conf.GetPositions())
+        assert get_props(mol) == get_props(ref)
+
+
+def get_props(mol):
+    props = mol.GetPropsAsDict(includePrivate=True, includeComputed=True)
+    # the names of the computed properties are an RDKit vector
+    return {key: value if isinstance(value, (str, int, float)) else list(value)
+            for key, value in props.items()}
+
+
+def test_blocks_keep_conformers_and_properties():
+    mol = Chem.AddHs(Chem.MolFromSmiles("CCO"))
+    AllChem.EmbedMultipleConfs(mol, numConfs=2, randomSeed=0)
+    mol.SetProp("_Name", "ethanol")
+    mol.SetDoubleProp("score", -7.5)
+
+    assert_same_molecules([mol_from_block(mol_to_block(mol))], [mol])
+    assert mol_from_block(mol_to_block(None)) is None
+
+
+def test_pool_matches_serial_postprocessing(point_clouds):
+    raw = [build_molecule(pos, types, DATASET_INFO, add_coords=True)
+           for pos, types in point_clouds]
+    processed = [process_molecule(mol, **PROCESS_KWARGS) for mol in raw]
+    # some, but not all molecules pass the filters
+    assert 0 < sum(mol is None for mol in processed) < len(processed)
+
+    with PostProcessor() as serial:
+        serial_result = serial.submit(*concat(point_clouds), DATASET_INFO,
+                                      **PROCESS_KWARGS).get()
+    with ThreadPostProcessor() as thread:
+        thread_result = thread.submit(*concat(point_clouds), DATASET_INFO,
+                                      **PROCESS_KWARGS).get()
+    with PoolPostProcessor(2, chunksize=2) as pool:
+        pending = pool.submit(*concat(point_clouds), DATASET_INFO,
+                              **PROCESS_KWARGS)
+        pool_result = pending.get()
+        assert pending.ready()
+
+    for result in [serial_result, thread_result, pool_result]:
+        assert_same_molecules(result[0], raw)
+        assert_same_molecules(result[1], processed)
+
+
+def test_get_postprocessor():
+    assert type(get_postprocessor(0)) is PostProcessor
+    assert type(get_postprocessor(1)) is PostProcessor
+    with get_postprocessor(0, background=True) as postprocessor:
+        assert isinstance(postprocessor, ThreadPostProcessor)
+    with get_postprocessor(2) as postprocessor:
+        assert isinstance(postprocessor, PoolPostProcessor)
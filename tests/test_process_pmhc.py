@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+from itertools import islice
+
+import numpy as np
+import pytest
+import torch
+
+import process_pmhc
+from benchmark import random_pmhc_pdb
+from process_pmhc import iter_pmhc_structures, list_structures
+from test_dataset_pmhc import write_hdf5
+
+
+@pytest.fixture
+def pdb_strings():
+    rng = np.random.default_rng(0)
+    return {f"complex_{i}": random_pmhc_pdb(20 + 5 * i, 9, rng) for i in range(5)}
+
+
+@pytest.fixture
+def pdb_dir(pdb_strings, tmp_path):
+    """Two structures as pdb files, the others in one hdf5 file."""
+    pdb_dir = tmp_path / "structures"
+    pdb_dir.mkdir()
+    names = list(pdb_strings)
+    for name in names[:2]:
+        (pdb_dir / f"{name}.pdb").write_text(pdb_strings[name])
+    write_hdf5(pdb_dir / "structures.hdf5",
+               {name: pdb_strings[name] for name in names[2:]})
+    return pdb_dir
+
+
+@pytest.fixture
+def count_parsed(monkeypatch):
+    """Counts the structures parsed in this process (use n_workers=1)."""
+    parsed = []
+    parse = process_pmhc.parse_pmhc_pdb_string
+
+    def counting_parse(pdb_string, *args, **kwargs):
+        parsed.append(pdb_string)
+        return parse(pdb_string, *args, **kwargs)
+
+    monkeypatch.setattr(process_pmhc, "parse_pmhc_pdb_string", counting_parse)
+    return parsed
+
+
+def assert_samples_equal(samples, expected):
+    assert [s[0] for s in samples] == [s[0] for s in expected]
+    for (_, peptide, mhc), (_, ref_peptide, ref_mhc) in zip(samples, expected):
+        for part, ref in [(peptide, ref_peptide), (mhc, ref_mhc)]:
+            assert torch.equal(part["x"], ref["x"])
+            assert part["types"] == ref["types"]
+            assert part["size"] == ref["size"]
+
+
+def test_cache_is_keyed_by_content(pdb_dir, pdb_strings, tmp_path, count_parsed):
+    cache_dir = tmp_path / "cache"
+    structures = list_structures(pdb_dir)
+    expected = list(iter_pmhc_structures(structures, atom_level=False))
+    count_parsed.clear()
+
+    samples = list(iter_pmhc_structures(structures, atom_level=False,
+                                        cache_dir=cache_dir))
+    assert_samples_equal(samples, expected)
+    assert len(count_parsed) == len(pdb_strings)
+    assert len(list(cache_dir.glob("*.npz"))) == len(pdb_strings)
+
+    # cached structures are not parsed again
+    count_parsed.clear()
+    samples = list(iter_pmhc_structures(structures, atom_level=False,
+                                        cache_dir=cache_dir))
+    assert_samples_equal(samples, expected)
+    assert count_parsed == []
+
+    # the key is the content, renamed files are still cached
+    (pdb_dir / "complex_0.pdb").rename(pdb_dir / "renamed.pdb")
+    samples = list(iter_pmhc_structures(list_structures(pdb_dir),
+                                        atom_level=False, cache_dir=cache_dir))
+    assert count_parsed == []
+    assert samples[1][0] == "renamed"
+    assert torch.equal(samples[1][1]["x"], expected[0][1]["x"])
+
+    # ... but other processing options are not
+    list(iter_pmhc_structures(structures[2:3], atom_level=True,
+                              cache_dir=cache_dir))
+    assert count_parsed == [pdb_strings["complex_2"]]
+
+
+def test_only_new_structures_are_parsed(pdb_dir, pdb_strings, tmp_path,
+                                        count_parsed):
+    cache_dir = tmp_path / "cache"
+
+    # an interrupted run keeps the structures finished so far
+    samples = iter_pmhc_structures(list_structures(pdb_dir), atom_level=False,
+                                   cache_dir=cache_dir)
+    list(islice(samples, 2))
+    samples.close()
+    assert len(list(cache_dir.glob("*.npz"))) == 2
+
+    # the re-run only parses the remaining and the added structures
+    new_pdb = random_pmhc_pdb(30, 10, np.random.default_rng(1))
+    (pdb_dir / "complex_new.pdb").write_text(new_pdb)
+    count_parsed.clear()
+    samples = list(iter_pmhc_structures(list_structures(pdb_dir),
+                                        atom_level=False, cache_dir=cache_dir))
+    assert sorted(count_parsed) == sorted(
+        [pdb_strings[f"complex_{i}"] for i in range(2, 5)] + [new_pdb])
+    assert [s[0] for s in samples] == [
+        "complex_0", "complex_1", "complex_new",
+        "complex_2", "complex_3", "complex_4"]
+
+
+def test_workers_keep_order_and_close_files(pdb_dir, tmp_path, monkeypatch):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("workers must inherit the patched close_hdf5_handles")
+
+    # every process records the number of files it closes
+    log_file = tmp_path / "closed.txt"
+    close = process_pmhc.close_hdf5_handles
+
+    def logging_close():
+        with open(log_file, "a") as f:
+            f.write(f"{os.getpid()} {len(process_pmhc._hdf5_handles)}\n")
+        close()
+
+    monkeypatch.setattr(process_pmhc, "close_hdf5_handles", logging_close)
+
+    structures = list_structures(pdb_dir) * 4
+    expected = list(iter_pmhc_structures(structures, atom_level=False))
+    log_file.unlink()
+
+    samples = list(iter_pmhc_structures(structures, atom_level=False,
+                                        n_workers=2,
+                                        cache_dir=tmp_path / "cache"))
+    assert_samples_equal(samples, expected)
+
+    closed = dict(line.split() for line in log_file.read_text().splitlines())
+    assert closed.pop(str(os.getpid())) == "0"
+    # both workers closed the hdf5 file on exit (if they had read from it)
+    assert len(closed) == 2
+    assert "1" in closed.values() and set(closed.values()) <= {"0", "1"}
+    assert process_pmhc._hdf5_handles == {}
@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from equivariant_diffusion.dynamics import radius_graph
+
+
+def reference_radius_graph(x, batch_mask, cutoff, max_neighbors=None):
+    """Dense version of the GPU path, usable on any device."""
+    dist = torch.cdist(x, x)
+    adj = (dist <= cutoff) & (batch_mask[:, None] == batch_mask[None, :])
+    if max_neighbors is not None:
+        dist = dist.masked_fill(~adj, float("inf"))
+        k = min(max_neighbors + 1, len(x))
+        knn = dist.topk(k, dim=1, largest=False).indices
+        adj = adj & torch.zeros_like(adj).scatter_(1, knn, True)
+    return torch.stack(torch.where(adj), dim=0)
+
+
+def edge_set(edges):
+    return set(map(tuple, edges.t().tolist()))
+
+
+@pytest.fixture
+def boundary_batch():
+    # neighbours at exactly the cutoff distance (exactly representable)
+    x = torch.tensor(
+        [[0.0, 0.0, 0.0], [2.0, 0.0, 0.0], [0.0, 2.0, 0.0], [4.0, 0.0, 0.0],
+         [0.0, 0.0, 0.0], [0.0, 0.0, 2.0], [0.0, 0.0, 2.5]]
+    )
+    batch_mask = torch.tensor([0, 0, 0, 0, 1, 1, 1])
+    return x, batch_mask, 2.0
+
+
+@pytest.mark.parametrize("max_neighbors", [None, 1, 2])
+def test_cutoff_is_inclusive_on_cpu(boundary_batch, max_neighbors):
+    x, batch_mask, cutoff = boundary_batch
+    edges = radius_graph(x, batch_mask, cutoff, max_neighbors)
+    expected = reference_radius_graph(x, batch_mask, cutoff, max_neighbors)
+    if max_neighbors is None:
+        assert edge_set(edges) == edge_set(expected)
+    else:
+        # ties between equidistant neighbours may be broken differently,
+        # but every node keeps the same number of neighbours
+        assert torch.equal(torch.bincount(edges[0], minlength=len(x)),
+                           torch.bincount(expected[0], minlength=len(x)))
+    assert (0, 1) in edge_set(edges) and (4, 5) in edge_set(edges)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize("max_neighbors", [None, 3])
+def test_cpu_and_gpu_graphs_agree(boundary_batch, max_neighbors):
+    x, batch_mask, cutoff = boundary_batch
+    edges_cpu = radius_graph(x, batch_mask, cutoff, max_neighbors)
+    edges_gpu = radius_graph(x.cuda(), batch_mask.cuda(), cutoff, max_neighbors)
+    assert edge_set(edges_cpu) == edge_set(edges_gpu.cpu())
+
+
+@pytest.mark.parametrize("max_neighbors", [None, 2, 50])
+def test_batched_graph_matches_reference(max_neighbors):
+    g = torch.Generator().manual_seed(0)
+    batch_mask = torch.tensor([0] * 30 + [1] * 3 + [2] * 1 + [3] * 20)
+    # samples overlap in space, edges must not cross sample boundaries
+    x = torch.randn(len(batch_mask), 3, generator=g) * 3
+    edges = radius_graph(x, batch_mask, 2.5, max_neighbors)
+    expected = reference_radius_graph(x, batch_mask, 2.5, max_neighbors)
+    assert torch.equal(edges, expected)
+
+
+def test_empty_graph():
+    edges = radius_graph(torch.zeros(0, 3), torch.zeros(0, dtype=torch.long), 1.0)
+    assert edges.shape == (2, 0)
@@ -0,0 +1,222 @@
+import pytest
+import torch
+from torch_scatter import scatter_mean
+
+from equivariant_diffusion.conditional_model import ConditionalDDPM
+from equivariant_diffusion.en_diffusion import PredefinedNoiseSchedule
+
+N_DIMS = 3
+N_TYPES = 4
+DATA_STD = 0.7
+
+
+class GaussianDynamics(torch.nn.Module):
+    """
+    Exact noise prediction for COM-free Gaussian data with standard deviation
+    DATA_STD, so the probability flow ODE has a closed-form solution. `offset`
+    adds a constant (pure COM) component to the prediction, which sampling
+    has to project out.
+    """
+    update_pocket_coords = False
+
+    def __init__(self, gamma, offset=0.0):
+        super().__init__()
+        self.gamma = gamma
+        self.offset = offset
+
+    def forward(self, z_lig, xh_pocket, t, lig_mask, pocket_mask,
+                pocket_context=None):
+        gamma_t = self.gamma(t)[lig_mask]
+        alpha2, sigma2 = torch.sigmoid(-gamma_t), torch.sigmoid(gamma_t)
+        x = z_lig[:, :N_DIMS]
+        x = x - scatter_mean(x, lig_mask, dim=0)[lig_mask]
+        eps = x * sigma2.sqrt() / (alpha2 * DATA_STD**2 + sigma2)
+        return eps + self.offset
+
+    def get_pocket_context(self, xh_pocket, pocket_mask, lig_mask,
+                           check_nan=True):
+        return None
+
+
+def make_ddpm(timesteps=100, offset=0.0):
+    ddpm = ConditionalDDPM(
+        dynamics=GaussianDynamics(None),
+        atom_nf=N_TYPES,
+        residue_nf=N_TYPES,
+        n_dims=N_DIMS,
+        size_histogram=[[1]],
+        timesteps=timesteps,
+        noise_schedule="polynomial_2",
+        noise_precision=1e-4,
+        loss_type="l2",
+    )
+    ddpm.dynamics = GaussianDynamics(ddpm.gamma, offset)
+    return ddpm
+
+
+def make_batch(n_samples=3, n_lig=5, n_pocket=7, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    lig_mask = torch.arange(n_samples).repeat_interleave(n_lig)
+    pocket_mask = torch.arange(n_samples).repeat_interleave(n_pocket)
+    z_x = torch.randn(len(lig_mask), N_DIMS, generator=g)
+    z_x = z_x - scatter_mean(z_x, lig_mask, dim=0)[lig_mask]
+    z = torch.cat([z_x, torch.eye(N_TYPES)[lig_mask % N_TYPES]], dim=1)
+    xh_pocket = torch.cat(
+        [torch.randn(len(pocket_mask), N_DIMS, generator=g),
+         torch.eye(N_TYPES)[pocket_mask % N_TYPES]], dim=1
+    )
+    return z, xh_pocket, lig_mask, pocket_mask
+
+
+@pytest.mark.parametrize("spacing", ["uniform", "quadratic", "logsnr"])
+@pytest.mark.parametrize("timesteps", [1, 7, 30, 333, 999, 1000])
+def test_schedule_is_monotone_with_requested_length(spacing, timesteps):
+    ddpm = make_ddpm(timesteps=1000)
+    schedule = ddpm.get_sampling_schedule(timesteps, spacing)
+    assert len(schedule) == timesteps + 1
+    assert schedule[0] == 0 and schedule[-1] == 1000
+    assert all(s < t for s, t in zip(schedule[:-1], schedule[1:]))
+
+
+def test_schedule_keeps_exact_grids():
+    ddpm = make_ddpm(timesteps=1000)
+    assert ddpm.get_sampling_schedule(10) == list(range(0, 1001, 100))
+    assert ddpm.get_sampling_schedule(1000) == list(range(1001))
+
+
+@pytest.mark.parametrize("timesteps", [0, 1001])
+def test_schedule_rejects_impossible_lengths(timesteps):
+    with pytest.raises(ValueError):
+        make_ddpm(timesteps=1000).get_sampling_schedule(timesteps)
+
+
+def assert_table_matches_coefficients(ddpm, schedule):
+    table = ddpm.gamma.transition_table(schedule)
+    assert table.dtype == ddpm.gamma.gamma.dtype
+    s = torch.tensor(schedule[:-1]).unsqueeze(1) / ddpm.T
+    t = torch.tensor(schedule[1:]).unsqueeze(1) / ddpm.T
+    expected = ddpm.transition_coefficients(
+        s.to(table.dtype), t.to(table.dtype), torch.zeros(len(s), 1)
+    )
+    for i, name in enumerate(PredefinedNoiseSchedule.TRANSITION_COEFFICIENTS):
+        assert torch.allclose(table[:, i], expected[name].squeeze(1),
+                              rtol=1e-5, atol=1e-6), name
+
+
+def test_transition_table_matches_per_step_coefficients():
+    ddpm = make_ddpm(timesteps=1000)
+    for spacing in ("uniform", "logsnr"):
+        assert_table_matches_coefficients(
+            ddpm, ddpm.get_sampling_schedule(50, spacing)
+        )
+
+
+def test_transition_table_follows_gamma():
+    ddpm = make_ddpm(timesteps=100)
+    schedule = ddpm.get_sampling_schedule(20)
+    table = ddpm.gamma.transition_table(schedule)
+    assert ddpm.gamma.transition_table(schedule) is table
+
+    other = PredefinedNoiseSchedule("cosine", 100, 1e-4)
+    ddpm.gamma.load_state_dict(other.state_dict())
+    assert not torch.allclose(ddpm.gamma.transition_table(schedule), table)
+    assert_table_matches_coefficients(ddpm, schedule)
+
+    ddpm.gamma.double()
+    assert_table_matches_coefficients(ddpm, schedule)
+
+
+@pytest.mark.parametrize("s, t", [(0, 1), (40, 41), (10, 60), (99, 100)])
+def test_ddim_with_eta_one_is_ddpm_posterior(s, t):
+    ddpm = make_ddpm()
+    z, xh_pocket, lig_mask, pocket_mask = make_batch()
+    s_array = torch.full((3, 1), s / ddpm.T)
+    t_array = torch.full((3, 1), t / ddpm.T)
+
+    torch.manual_seed(1)
+    z_ddpm, pocket_ddpm = ddpm.sample_p_zs_given_zt(
+        s_array, t_array, z, xh_pocket, lig_mask, pocket_mask
+    )
+    torch.manual_seed(1)
+    z_ddim, pocket_ddim = ddpm.sample_p_zs_given_zt_ddim(
+        s_array, t_array, z, xh_pocket, lig_mask, pocket_mask, eta=1.0
+    )
+    assert torch.allclose(z_ddim, z_ddpm, atol=1e-5)
+    assert torch.allclose(pocket_ddim, pocket_ddpm, atol=1e-5)
+
+
+def test_ddim_with_eta_zero_is_deterministic():
+    ddpm = make_ddpm()
+    z, xh_pocket, lig_mask, pocket_mask = make_batch()
+    s_array, t_array = torch.full((3, 1), 0.2), torch.full((3, 1), 0.7)
+    out = []
+    for seed in (1, 2):
+        torch.manual_seed(seed)
+        out.append(ddpm.sample_p_zs_given_zt_ddim(
+            s_array, t_array, z, xh_pocket, lig_mask, pocket_mask, eta=0.0
+        )[0])
+    assert torch.equal(out[0], out[1])
+
+
+def solve(ddpm, sampler, timesteps, z, xh_pocket, lig_mask, pocket_mask):
+    """Deterministic reverse chain from t=T to t=0, as in sample_given_pocket."""
+    schedule = ddpm.get_sampling_schedule(timesteps, "logsnr")
+    n_samples = int(lig_mask.max()) + 1
+    history = []
+    for s in reversed(range(timesteps)):
+        s_array = torch.full((n_samples, 1), schedule[s] / ddpm.T)
+        t_array = torch.full((n_samples, 1), schedule[s + 1] / ddpm.T)
+        if sampler == "ddim":
+            z, xh_pocket = ddpm.sample_p_zs_given_zt_ddim(
+                s_array, t_array, z, xh_pocket, lig_mask, pocket_mask, eta=0.0
+            )
+        else:
+            z, xh_pocket = ddpm.sample_p_zs_given_zt_dpm_solver(
+                s_array, t_array, z, xh_pocket, lig_mask, pocket_mask, history,
+                order=min(int(sampler[-1]), s + 1),
+            )
+    return z[:, :N_DIMS]
+
+
+def exact_solution(ddpm, z):
+    """Probability flow ODE for Gaussian data only rescales z_T."""
+    def variance(t):
+        gamma = ddpm.gamma(torch.tensor([[t]]))
+        return torch.sigmoid(-gamma) * DATA_STD**2 + torch.sigmoid(gamma)
+    return z[:, :N_DIMS] * (variance(0.0) / variance(1.0)).sqrt()
+
+
+@pytest.mark.parametrize("sampler", ["dpm2", "dpm3"])
+def test_dpm_solver_matches_ode_reference(sampler):
+    ddpm = make_ddpm(timesteps=1000)
+    z, xh_pocket, lig_mask, pocket_mask = make_batch()
+    exact = exact_solution(ddpm, z)
+
+    reference = solve(ddpm, "ddim", 1000, z, xh_pocket, lig_mask, pocket_mask)
+    assert torch.allclose(reference, exact, atol=5e-3)
+
+    errors = {}
+    for timesteps in (20, 40):
+        x = solve(ddpm, sampler, timesteps, z, xh_pocket, lig_mask, pocket_mask)
+        ddim = solve(ddpm, "ddim", timesteps, z, xh_pocket, lig_mask,
+                     pocket_mask)
+        errors[timesteps] = (x - exact).abs().max()
+        # multistep solvers beat first order DDIM at the same step count
+        assert errors[timesteps] < (ddim - exact).abs().max() / 5
+    assert torch.allclose(x, reference, atol=1e-2)
+    # at least second order convergence
+    assert errors[40] < errors[20] / 3
+
+
+@pytest.mark.parametrize("sampler", ["ddim", "dpm2", "dpm3"])
+def test_solution_stays_com_free(sampler):
+    # the constant offset of the predictions is a pure COM component, it must
+    # not leak into the COM-free solution through the multistep history
+    z, xh_pocket, lig_mask, pocket_mask = make_batch()
+    x, x_offset = [
+        solve(make_ddpm(timesteps=1000, offset=offset), sampler, 20, z,
+              xh_pocket, lig_mask, pocket_mask)
+        for offset in (0.0, 0.3)
+    ]
+    assert scatter_mean(x_offset, lig_mask, dim=0).abs().max() < 1e-5
+    assert torch.allclose(x_offset, x, atol=1e-5)
@@ -0,0 +1,91 @@
+import importlib.util
+from argparse import Namespace
+from pathlib import Path
+
+import pytest
+import torch
+
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("openbabel")
+from constants import dataset_params
+from test_postprocessing import embed_point_cloud
+
+# test.py would be shadowed by the test package of the standard library
+spec = importlib.util.spec_from_file_location(
+    "test_script", Path(__file__).resolve().parents[1] / "test.py")
+test_script = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(test_script)
+
+DATASET_INFO = dataset_params["crossdock"]
+TEMPLATES = [embed_point_cloud(smiles) for smiles in ["CCO", "CC(=O)N", "CCCS"]]
+
+
+class FakeModel:
+    """Samples noisy copies of a few molecules (and some random point
+    clouds that do not pass the filters) with the global torch RNG."""
+    dataset_info = DATASET_INFO
+
+    def generate_ligands(self, pdb_file, n_samples, pocket_ids,
+                         postprocessor, wait, sanitize, relax_iter,
+                         largest_frag, **kwargs):
+        assert not wait
+        x, atom_type, lig_mask = [], [], []
+        for i, template in enumerate(torch.randint(-2, 3, (n_samples,))):
+            if template < 0:
+                pos, types = torch.randn(5, 3) * 0.7, torch.randint(0, 3, (5,))
+            else:
+                pos, types = TEMPLATES[template]
+                pos = pos + torch.randn(pos.shape) * 0.02
+            x.append(pos)
+            atom_type.append(types)
+            lig_mask.append(torch.full((len(pos),), i))
+        return postprocessor.submit(
+            torch.cat(x), torch.cat(atom_type), torch.cat(lig_mask),
+            self.dataset_info, add_hydrogens=False, sanitize=sanitize,
+            relax_iter=relax_iter, largest_frag=largest_frag)
+
+
+@pytest.fixture
+def test_files(tmp_path):
+    test_dir = tmp_path / "test_set"
+    test_dir.mkdir()
+    files = []
+    for name in ["1abc_pocket", "2def_pocket", "3ghi_pocket"]:
+        (test_dir / f"{name}.sdf").touch()
+        (test_dir / f"{name}.txt").write_text("A:1 A:2")
+        files.append(test_dir / f"{name}.sdf")
+    return files
+
+
+def run(test_files, outdir, n_workers):
+    for subdir in ["raw", "processed", "pocket_times"]:
+        Path(outdir, subdir).mkdir(parents=True)
+    args = Namespace(
+        outdir=outdir, n_samples=5, batch_size=8, all_frags=False,
+        sanitize=True, relax=False, fix_n_nodes=False, resamplings=1,
+        jump_length=1, skip_existing=False, n_workers=n_workers,
+        max_pending=2, validity_margin=1.2,
+    )
+    torch.manual_seed(0)
+    return test_script.sample_test_set(FakeModel(), test_files, args)
+
+
+def test_output_does_not_depend_on_workers(test_files, tmp_path):
+    times = run(test_files, tmp_path / "serial", n_workers=0)
+    assert sorted(times) == sorted(str(f) for f in test_files)
+    run(test_files, tmp_path / "pool", n_workers=2)
+
+    n_raw = []
+    for sdf_file in test_files:
+        for subdir in ["raw", "processed"]:
+            serial = tmp_path / "serial" / subdir / f"{sdf_file.stem}_gen.sdf"
+            pool = tmp_path / "pool" / subdir / f"{sdf_file.stem}_gen.sdf"
+            assert serial.read_text() == pool.read_text()
+        processed = (tmp_path / "serial" / "processed" /
+                     f"{sdf_file.stem}_gen.sdf").read_text()
+        raw = (tmp_path / "serial" / "raw" / f"{sdf_file.stem}_gen.sdf").read_text()
+        assert processed.count("$$$$") == 5
+        n_raw.append(raw.count("$$$$"))
+    # the first batch of 6 molecules was not enough for some pockets
+    assert max(n_raw) > 6
+
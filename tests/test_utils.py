@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import torch
+
+import utils
+
+
+def kabsch_rmsd(x_ref, x):
+    """Per-sample reference: RMSD after optimal superposition of x onto x_ref"""
+    p, q = x - x.mean(0), x_ref - x_ref.mean(0)
+    U, _, Vt = np.linalg.svd(p.T @ q)
+    d = np.sign(np.linalg.det(Vt.T @ U.T))
+    R = Vt.T @ np.diag([1, 1, d]) @ U.T
+    return np.sqrt((((R @ p.T).T - q) ** 2).sum(1).mean())
+
+
+def random_batch(n_batch, rng):
+    sizes = rng.integers(3, 15, size=n_batch)
+    batch_mask = torch.repeat_interleave(torch.arange(n_batch),
+                                         torch.from_numpy(sizes))
+    x_true = torch.from_numpy(rng.normal(size=(len(batch_mask), 3)) * 4)
+    # rotated and shifted noisy copies, and a few reflected ones
+    x_pred = []
+    for i, x in enumerate(utils.batch_to_list(x_true, batch_mask)):
+        R = torch.from_numpy(np.linalg.qr(rng.normal(size=(3, 3)))[0])
+        if i % 5 == 0:
+            R = R * torch.tensor([1.0, 1.0, -1.0])
+        x_pred.append(x @ R.T + torch.from_numpy(rng.normal(size=3))
+                      + torch.from_numpy(rng.normal(size=x.shape)) * 0.5)
+    return x_true, torch.cat(x_pred), batch_mask
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_batch_rmsd_matches_per_sample(shuffle):
+    x_true, x_pred, batch_mask = random_batch(50, np.random.default_rng(0))
+    pairs = [(x.numpy(), y.numpy()) for x, y in zip(
+        utils.batch_to_list(x_true, batch_mask),
+        utils.batch_to_list(x_pred, batch_mask))]
+    expected = np.array([np.sqrt(((x - y) ** 2).sum(1).mean()) for x, y in pairs])
+    expected_aligned = np.array([kabsch_rmsd(x, y) for x, y in pairs])
+    # every sample is superimposed on its reference
+    assert (expected_aligned < expected).all()
+
+    if shuffle:
+        # nodes are assigned to samples by batch_mask, not by their order
+        perm = torch.from_numpy(np.random.default_rng(1).permutation(
+            len(batch_mask)))
+        x_true, x_pred, batch_mask = x_true[perm], x_pred[perm], batch_mask[perm]
+
+    for dtype, tol in [(torch.float64, 1e-10), (torch.float32, 1e-4)]:
+        rmsd = utils.batch_rmsd(x_true.to(dtype), x_pred.to(dtype), batch_mask)
+        aligned = utils.batch_rmsd(x_true.to(dtype), x_pred.to(dtype),
+                                   batch_mask, n_batch=50, align=True)
+        assert rmsd.dtype == aligned.dtype == dtype
+        np.testing.assert_allclose(rmsd.numpy(), expected, rtol=tol)
+        np.testing.assert_allclose(aligned.numpy(), expected_aligned, rtol=tol)
+
+
+def test_kabsch_align_recovers_rigid_motion():
+    x_ref, _, batch_mask = random_batch(10, np.random.default_rng(2))
+    R = torch.from_numpy(np.linalg.qr(np.random.default_rng(3).normal(
+        size=(3, 3)))[0])
+    if torch.linalg.det(R) < 0:
+        R = -R
+    x = x_ref @ R.T + torch.tensor([1.0, -2.0, 3.0], dtype=torch.float64)
+    aligned = utils.batch_kabsch_align(x_ref, x, batch_mask)
+    assert torch.allclose(aligned, x_ref, atol=1e-10)
+
+
+def test_extended_samples_are_consecutive():
+    rng = np.random.default_rng(4)
+    sizes = torch.tensor([3, 5, 4])
+    mask = torch.repeat_interleave(torch.arange(3), sizes)
+    batch = {"x": torch.from_numpy(rng.normal(size=(12, 3))),
+             "one_hot": torch.eye(4)[rng.integers(0, 4, size=12)],
+             "size": sizes, "mask": mask}
+    n_samples = 4
+    extended = utils.extend_batch_n_samples(batch, n_samples)
+
+    # sample j is a copy of complex j // n_samples, which the per-complex
+    # RMSD statistics (reshape(-1, n_samples)) rely on
+    x_list = utils.batch_to_list(batch["x"], mask)
+    for j, x in enumerate(utils.batch_to_list(extended["x"], extended["mask"])):
+        assert torch.equal(x, x_list[j // n_samples])
+    assert extended["size"].tolist() == [3] * 4 + [5] * 4 + [4] * 4
+
+
+def test_per_complex_rmsd_statistics(tmp_path):
+    pytest.importorskip("pytorch_lightning")
+    from types import SimpleNamespace
+
+    from lightning_modules import LigandPocketDDPM
+
+    module = SimpleNamespace(outdir=tmp_path)
+    rmsd = torch.tensor([1.0, 2.0, 3.0, 4.0, 0.5, 6.0])
+    metrics = LigandPocketDDPM.rmsd_peptide_sample(module, rmsd, rmsd / 2,
+                                                   n_samples=3)
+    assert metrics["sample_rmsd"] == pytest.approx(16.5 / 6)
+    assert metrics["complex_min_rmsd"] == pytest.approx((1.0 + 0.5) / 2)
+    assert metrics["complex_mean_rmsd"] == pytest.approx((2.0 + 3.5) / 2)
+    assert metrics["complex_min_aligned_rmsd"] == pytest.approx(0.75 / 2)
+    assert np.load(tmp_path / "rmsd_per_peptide.npy").tolist() == rmsd.tolist()
+
+    with pytest.raises(AssertionError, match="per complex"):
+        LigandPocketDDPM.rmsd_peptide_sample(module, rmsd, rmsd, n_samples=4)
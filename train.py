@@ -95,6 +95,8 @@ if __name__ == "__main__":
         mode=args.mode,
         node_histogram=histogram,
         pocket_representation=args.pocket_representation,
+        edge_budget=args.__dict__.get("edge_budget"),
+        hdf5_params=args.__dict__.get("hdf5_params"),
     )
 
     logger = pl.loggers.WandbLogger(
@@ -127,6 +129,8 @@ if __name__ == "__main__":
         accelerator="gpu",
         devices=args.gpus,
         strategy=("ddp" if args.gpus > 1 else None),
+        # LigandPocketDDPM.get_dataloader shards the samplers across ranks
+        replace_sampler_ddp=False,
     )
 
     trainer.fit(model=pl_module, ckpt_path=ckpt_path)
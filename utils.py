@@ -125,8 +125,9 @@ def batch_to_list(data, batch_mask):
     #     data_list.append(data[batch_mask == i])
     # return data_list
 
-    # make sure batch_mask is increasing
-    idx = torch.argsort(batch_mask)
+    # make sure batch_mask is increasing, a stable sort keeps the order of
+    # the nodes within every sample
+    idx = torch.argsort(batch_mask, stable=True)
     batch_mask = batch_mask[idx]
     data = data[idx]
 
@@ -177,6 +178,65 @@ def extend_batch_n_samples(batch, n_samples):
     return new_batch
 
 
+def batch_kabsch_align(x_ref, x, batch_mask, n_batch=None):
+    """
+    Superimpose every sample of x onto the corresponding sample of x_ref
+    (Kabsch algorithm) for the whole batch at once.
+
+    x_ref: (n_nodes, 3) reference coordinates
+    x: (n_nodes, 3) coordinates to align, same batch_mask as x_ref
+    batch_mask: (n_nodes,) sample index of every node
+    n_batch: number of samples, inferred from batch_mask if None
+    """
+    if n_batch is None:
+        n_batch = int(batch_mask.max()) + 1
+    counts = torch.zeros(n_batch, device=x.device, dtype=x.dtype).index_add_(
+        0, batch_mask, torch.ones_like(x[:, 0]))[:, None]
+    com_ref = torch.zeros(n_batch, 3, device=x.device, dtype=x.dtype).index_add_(
+        0, batch_mask, x_ref) / counts
+    com = torch.zeros(n_batch, 3, device=x.device, dtype=x.dtype).index_add_(
+        0, batch_mask, x) / counts
+    p = x - com[batch_mask]
+    q = x_ref - com_ref[batch_mask]
+
+    # per-sample covariance matrices and optimal rotations (in double
+    # precision because of the SVD)
+    H = torch.zeros(n_batch, 3, 3, device=x.device, dtype=torch.float64)
+    H.index_add_(0, batch_mask, (p[:, :, None] * q[:, None, :]).double())
+    U, _, Vh = torch.linalg.svd(H)
+    V, Ut = Vh.transpose(1, 2), U.transpose(1, 2)
+    # avoid reflections
+    d = torch.sign(torch.linalg.det(V @ Ut))
+    D = torch.diag_embed(torch.stack([torch.ones_like(d), torch.ones_like(d), d], 1))
+    R = (V @ D @ Ut).to(x.dtype)
+
+    return (R[batch_mask] @ p[:, :, None]).squeeze(-1) + com_ref[batch_mask]
+
+
+def batch_rmsd(x_true, x_pred, batch_mask, n_batch=None, align=False):
+    """
+    RMSD between corresponding samples of two batches of point clouds with
+    identical batch masks. Stays on the device of the inputs.
+
+    x_true: (n_nodes, 3) reference coordinates
+    x_pred: (n_nodes, 3) generated coordinates
+    batch_mask: (n_nodes,) sample index of every node
+    n_batch: number of samples, inferred from batch_mask if None
+    align: superimpose x_pred onto x_true before computing the RMSD
+    Returns a (n_batch,) tensor.
+    """
+    if n_batch is None:
+        n_batch = int(batch_mask.max()) + 1
+    if align:
+        x_pred = batch_kabsch_align(x_true, x_pred, batch_mask, n_batch)
+    counts = torch.zeros(n_batch, device=x_true.device).index_add_(
+        0, batch_mask, torch.ones_like(batch_mask, dtype=torch.float))
+    sq_dist = ((x_true - x_pred) ** 2).sum(1)
+    msd = torch.zeros(n_batch, device=x_true.device, dtype=sq_dist.dtype)
+    msd.index_add_(0, batch_mask, sq_dist)
+    return torch.sqrt(msd / counts)
+
+
     
 
 